@@ -0,0 +1 @@
+"""Benchmarks do bot e os objetos do Discord simulados que eles (e os testes) usam."""
@@ -0,0 +1,412 @@
+"""
+Benchmarks do bot, rodados com ele desligado: python bot.py.py benchmark <alvo>.
+Cada função recebe o módulo do bot ('modulo') e mede as funções e classes dele, sem conectar ao Discord.
+"""
+import asyncio
+import functools
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.discord_falso import AutorFalso, CanalFalso, ContextoFalso
+
+# Estado do módulo trocado durante o benchmark de comandos. As travas e as filas ficam presas ao loop em
+# que foram usadas: cada asyncio.run precisa das suas, senão o segundo tamanho de --fichas encontra uma
+# trava do loop anterior e quebra com "bound to a different event loop".
+ESTADO_COMANDOS = (
+    "armazenamento", "cache_fichas", "persistencia", "agendador_fichas", "despachante", "registro_eventos",
+    "indice_mensagens", "ranking_fichas", "travas_usuarios", "_travas_guilds", "_guilds_preparadas",
+    "_trava_recalculo", "_trava_reconciliacao", "_fichas_renderizadas",
+)
+
+
+def ficha_aleatoria(modulo, rng):
+    """Ficha com valores plausíveis, para os benchmarks."""
+    ficha = modulo.Ficha(pontos=rng.randint(0, 35))
+    for i in range(len(modulo.atributos_validos)):
+        ficha.pts_gastos[i] = rng.randint(0, 30)
+        ficha.ranks[i] = rng.choice(list(modulo.nomes_rank))
+    for i in range(len(modulo.bonus_validos)):
+        ficha.bonus[i] = rng.randint(0, 5)
+    modulo.atualizar_status(ficha)
+    ficha.ficha_channel_id = rng.getrandbits(60)
+    ficha.ficha_message_id = rng.getrandbits(60)
+    return ficha
+
+
+def medir_memoria(criar):
+    """Bytes alocados pelos objetos que 'criar' retorna (que ficam vivos durante a medição)."""
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    objetos = criar()
+    depois = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objetos
+    return depois - antes
+
+
+def _cronometrado(funcao, tempos, nome):
+    """Envolve 'funcao' somando o tempo gasto em tempos[nome]."""
+    def cronometrada(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            return funcao(*args, **kwargs)
+        finally:
+            tempos[nome] += time.perf_counter() - inicio
+    return cronometrada
+
+
+def _percentil(valores_ordenados, percentil):
+    if not valores_ordenados:
+        return 0.0
+    return valores_ordenados[min(len(valores_ordenados) - 1, int(len(valores_ordenados) * percentil))]
+
+
+async def benchmark_comandos(modulo, quantidade_fichas, quantidade_comandos, concorrencia, backend, latencia_discord):
+    """
+    Roda comandos simulados (criar, add, remover, setrank, addbonus, ficha) sobre 'quantidade_fichas'
+    fichas já existentes, com 'concorrencia' comandos ao mesmo tempo, em um diretório temporário.
+    Retorna latências, vazão e o tempo gasto em atualizar_status, renderizar_ficha e salvar_dados.
+    """
+    m = modulo
+    rng = random.Random(quantidade_fichas)
+    originais = {nome: getattr(m, nome) for nome in ESTADO_COMANDOS}
+    funcoes = {nome: getattr(m, nome) for nome in ("atualizar_status", "renderizar_ficha", "salvar_dados")}
+    get_channel = m.bot.get_channel
+    pasta = tempfile.TemporaryDirectory()
+    novos = {}
+    try:
+        novos["armazenamento"] = armazenamento = m.ArmazenamentoPorGuild(backend, pasta.name)
+        for inicio in range(0, quantidade_fichas, m.LOTE_RECALCULO):
+            lote = {}
+            for user_id in range(inicio, min(inicio + m.LOTE_RECALCULO, quantidade_fichas)):
+                modelo = ficha_aleatoria(m, rng)
+                modelo.ficha_channel_id = modelo.ficha_message_id = None
+                lote[m.chave_ficha(None, user_id)] = json.dumps(modelo.para_dict(), separators=(",", ":"))
+            armazenamento.gravar(lote)
+        novos.update({
+            "cache_fichas": m.CacheFichas(m.LIMITE_CACHE_FICHAS, m.TTL_CACHE_FICHAS),
+            "persistencia": m.PersistenciaAssincrona(m.JANELA_SALVAMENTO),
+            "agendador_fichas": m.AgendadorFichas(m.JANELA_ATUALIZACAO_FICHA, m.EDICOES_POR_CANAL),
+            # Os canais falsos não têm rate limit: a rota nunca enche
+            "despachante": m.DespachanteDiscord(
+                quantidade_comandos + 1, m.JANELA_CHAMADAS_ROTA, m.TENTATIVAS_DISCORD, m.ESPERA_BASE_DISCORD
+            ),
+            "registro_eventos": m.RegistroEventos(
+                os.path.join(pasta.name, m.EVENTOS_DIR), m.JANELA_EVENTOS, m.EVENTOS_LIMITE_BYTES
+            ),
+            "indice_mensagens": m.IndiceMensagensFicha(),
+            "ranking_fichas": m.RankingFichas(),
+            "travas_usuarios": m.TravasPorUsuario(m.LIMITE_TRAVAS_USUARIOS),
+            "_travas_guilds": {},
+            "_guilds_preparadas": set(),
+            "_trava_recalculo": asyncio.Lock(),
+            "_trava_reconciliacao": asyncio.Lock(),
+            "_fichas_renderizadas": {},
+        })
+        for nome, valor in novos.items():
+            setattr(m, nome, valor)
+        m.carregar_dados()
+
+        canais = {canal_id: CanalFalso(canal_id, latencia_discord) for canal_id in range(1, 21)}
+        m.bot.get_channel = canais.get
+        tempos = dict.fromkeys(list(funcoes) + ["gravacao"], 0.0)
+        for nome, funcao in funcoes.items():
+            setattr(m, nome, _cronometrado(funcao, tempos, nome))
+        armazenamento.gravar = _cronometrado(armazenamento.gravar, tempos, "gravacao")
+
+        novos_ids = itertools.count(quantidade_fichas)
+        def sortear_comando():
+            sorteio = rng.random()
+            user_id = rng.randrange(quantidade_fichas) if quantidade_fichas else next(novos_ids)
+            atributo = rng.choice(m.atributos_validos)
+            if sorteio < 0.05 or not quantidade_fichas:
+                return m.criar, next(novos_ids), ()
+            if sorteio < 0.40:
+                return m.add, user_id, (atributo, rng.randint(1, 3))
+            if sorteio < 0.60:
+                return m.remover, user_id, (atributo, rng.randint(1, 3))
+            if sorteio < 0.70:
+                return m.setrank, user_id, (atributo, rng.choice(list(m.rank_limits)))
+            if sorteio < 0.80:
+                return m.addbonus, user_id, (rng.choice(m.bonus_validos), rng.randint(1, 3))
+            return m.ficha, user_id, ()
+
+        latencias = {}
+        fila = [sortear_comando() for _ in range(quantidade_comandos)]
+        async def trabalhador():
+            while fila:
+                comando, user_id, argumentos = fila.pop()
+                ctx = ContextoFalso(AutorFalso(user_id), canais[user_id % len(canais) + 1])
+                inicio = time.perf_counter()
+                await comando.callback(ctx, *argumentos)
+                latencias.setdefault(comando.name, []).append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(trabalhador() for _ in range(concorrencia)))
+        duracao_comandos = time.perf_counter() - inicio
+        # Espera as edições agendadas, as confirmações na fila e a última gravação
+        while m.agendador_fichas.profundidade() or m.despachante.profundidade():
+            await asyncio.sleep(0.05)
+        await m.persistencia.descarregar()
+        await m.registro_eventos.descarregar()
+        duracao_total = time.perf_counter() - inicio
+
+        todas = sorted(itertools.chain.from_iterable(latencias.values()))
+        resultado = {
+            "fichas": quantidade_fichas,
+            "comandos": quantidade_comandos,
+            "concorrencia": concorrencia,
+            "backend": backend,
+            "latencia_discord_ms": latencia_discord * 1000,
+            "comandos_por_segundo": quantidade_comandos / duracao_comandos,
+            "duracao_s": duracao_total,
+            "latencia_ms": {"p50": _percentil(todas, 0.50) * 1000, "p99": _percentil(todas, 0.99) * 1000},
+            "por_comando": {
+                nome: {
+                    "quantidade": len(valores),
+                    "p50_ms": _percentil(sorted(valores), 0.50) * 1000,
+                    "p99_ms": _percentil(sorted(valores), 0.99) * 1000,
+                }
+                for nome, valores in latencias.items()
+            },
+            "tempo_s": tempos,
+            "mensagens_enviadas": sum(canal.envios for canal in canais.values()),
+            "mensagens_editadas": sum(canal.edicoes for canal in canais.values()),
+            "mensagens_por_comando": sum(canal.envios + canal.edicoes for canal in canais.values()) / quantidade_comandos,
+            "escritas_realizadas": m.persistencia.escritas_realizadas,
+            "eventos_gravados": m.registro_eventos.gravados,
+        }
+        print(
+            f"{quantidade_fichas} fichas: {resultado['comandos_por_segundo']:.0f} comandos/s, "
+            f"p50 {resultado['latencia_ms']['p50']:.2f} ms, p99 {resultado['latencia_ms']['p99']:.2f} ms, "
+            f"{resultado['mensagens_por_comando']:.2f} mensagens/comando, "
+            + ", ".join(f"{nome} {segundos:.2f}s" for nome, segundos in tempos.items())
+        )
+        return resultado
+    finally:
+        for nome in ("armazenamento", "registro_eventos"):
+            if nome in novos:
+                novos[nome].fechar()
+        for nome, valor in itertools.chain(originais.items(), funcoes.items()):
+            setattr(m, nome, valor)
+        m.bot.get_channel = get_channel
+        pasta.cleanup()
+
+
+def renderizar_ficha_anterior(modulo, user_id, user):
+    """Renderização anterior aos modelos pré-compilados, a referência do benchmark de renderização."""
+    m = modulo
+    status = dict(zip(m.atributos_validos, user.status))
+    pts_gastos = dict(zip(m.atributos_validos, user.pts_gastos))
+    ranks = {attr: m.nomes_rank[numero] for attr, numero in zip(m.atributos_validos, user.ranks)}
+    bonus = dict(zip(m.bonus_validos, user.bonus))
+
+    # Calcula os status derivados (Locomoção, PR, Kritos)
+    loc = m.calcular_locomocao(status["VEL"], bonus.get("LOCOMOCAO", 0))
+    pr = m.calcular_pr(status["RES"], bonus.get("PR", 0))
+    kritos = m.calcular_kritos(status["MAG"], bonus.get("KRITOS", 0)) # Usando status["MAG"] aqui
+
+    # Constrói a seção de Atributos Base
+    texto_atributos_base = ""
+    # Explicitamente lista apenas os atributos que NÃO são HP, DEF, DMG para esta seção
+    atributos_para_listar_base = [attr for attr in m.atributos_validos if attr not in ["HP", "DEF", "DMG"]]
+    for attr in atributos_para_listar_base:
+        texto_atributos_base += f"• {attr} ({ranks[attr]}): {status[attr]} [Gastos: {pts_gastos[attr]}]\n"
+
+    # Constrói a seção de Status de Combate (agora incluindo os ranks)
+    texto_status_combate = (
+        f"• Vitalidade (HP) ({ranks['HP']}): {status['HP']} [Gastos: {pts_gastos['HP']}]\n"
+        f"• Defesa (DEF) ({ranks['DEF']}): {status['DEF']} [Gastos: {pts_gastos['DEF']}]\n"
+        f"• Dano (DMG) ({ranks['DMG']}): {status['DMG']} [Gastos: {pts_gastos['DMG']}]\n"
+    )
+
+    # Constrói a seção de Status Gerais (os que são calculados)
+    texto_status_gerais = (
+        f"• Kritos: {kritos}\n"
+        f"• Pontos de Resistência (PR): {pr}\n"
+        f"• Locomoção: {loc} metros\n"
+    )
+
+    # Constrói a mensagem da ficha completa
+    return (
+        f"<@{user_id}>\n"
+        "# :bar_chart: Ficha de Atributos\n\n"
+        f"```\nPontos Livres: {user.pontos}\nPontos Gastos: {sum(pts_gastos.values())}\n```\n"
+        
+        "## :muscle: Atributos Base\n"
+        f"```\n{texto_atributos_base}```\n"
+        
+        "## :crossed_swords: Status de Combate\n"
+        f"```\n{texto_status_combate}```\n"
+
+        "## :brain: Status Derivados\n"
+        f"```\n{texto_status_gerais}```\n"
+    )
+
+
+def _medir_renderizacoes(renderizar, fichas, preparar=None, alterar=None, repeticoes=5):
+    """
+    Renderizações por segundo de todas as 'fichas', chamando 'alterar(ficha)' antes de cada uma, se informado.
+    Fica com a melhor de 'repeticoes' passadas (cada uma depois de 'preparar()'), para reduzir o ruído da máquina.
+    """
+    melhor = float("inf")
+    for _ in range(repeticoes):
+        if preparar:
+            preparar()
+        inicio = time.perf_counter()
+        for user_id, ficha in fichas:
+            if alterar:
+                alterar(ficha)
+            renderizar(user_id, ficha)
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return len(fichas) / melhor
+
+
+def benchmark_renderizacao(modulo, quantidades):
+    """
+    Compara a renderização anterior com a pré-compilada: fichas diferentes (sem nenhuma seção guardada)
+    e fichas já renderizadas de novo depois de mudar só o bônus de PR (um comando seguido da edição da ficha).
+    """
+    m = modulo
+    rng = random.Random(0)
+    i_pr = m.indice_atributo["PR"]
+
+    def sem_secoes_guardadas():
+        m._texto_secao.cache_clear()
+        m._texto_derivados.cache_clear()
+
+    def mudar_pr(ficha):
+        ficha.bonus[i_pr] += 1
+
+    anterior = functools.partial(renderizar_ficha_anterior, m)
+
+    for quantidade in quantidades:
+        fichas = [(str(rng.getrandbits(60)), ficha_aleatoria(m, rng)) for _ in range(quantidade)]
+        for user_id, ficha in fichas:
+            assert m.renderizar_ficha(user_id, ficha) == renderizar_ficha_anterior(m, user_id, ficha)
+        # As fichas editadas em sequência são as que cabem no cache de seções, como as ativas em um servidor
+        ativas = fichas[:m.LIMITE_SECOES_RENDERIZADAS // 2]
+
+        def renderizar_ativas():
+            for user_id, ficha in ativas:
+                m.renderizar_ficha(user_id, ficha)
+
+        resultados = {
+            "anterior": _medir_renderizacoes(anterior, fichas),
+            "pré-compilada": _medir_renderizacoes(m.renderizar_ficha, fichas, sem_secoes_guardadas),
+            "anterior, só PR mudou": _medir_renderizacoes(anterior, ativas, alterar=mudar_pr),
+            "pré-compilada, só PR mudou": _medir_renderizacoes(m.renderizar_ficha, ativas, renderizar_ativas, mudar_pr),
+            "embed, só PR mudou": _medir_renderizacoes(m.renderizar_ficha_embed, ativas, renderizar_ativas, mudar_pr),
+        }
+        print(f"{quantidade} fichas: " + ", ".join(f"{nome} {valor:.0f}/s" for nome, valor in resultados.items()))
+
+
+def benchmark_memoria(modulo, quantidades):
+    """Compara a memória por ficha entre o formato em dicionários (o do JSON) e a Ficha compacta."""
+    rng = random.Random(0)
+    for quantidade in quantidades:
+        modelos = [ficha_aleatoria(modulo, rng).para_dict() for _ in range(quantidade)]
+        # Cópias novas, para medir só o que cada formato aloca
+        em_dicts = medir_memoria(lambda: [json.loads(json.dumps(dados)) for dados in modelos])
+        em_fichas = medir_memoria(lambda: [modulo.Ficha.de_dict(dados) for dados in modelos])
+        print(
+            f"{quantidade} fichas: dicionários {em_dicts / quantidade:.0f} bytes/ficha "
+            f"({em_dicts / 2**20:.1f} MiB), Ficha {em_fichas / quantidade:.0f} bytes/ficha "
+            f"({em_fichas / 2**20:.1f} MiB), {em_dicts / em_fichas:.1f}x menor."
+        )
+
+
+def benchmark_carregamento(modulo, quantidades):
+    """
+    Tempo para ler um snapshot com 'quantidade' fichas (10% delas sem 'bonus', do formato antigo): do JSON,
+    conferindo as fichas e gerando o snapshot binário, e depois do binário, mais o de usar todas as fichas lidas.
+    """
+    rng = random.Random(0)
+    for quantidade in quantidades:
+        with tempfile.TemporaryDirectory() as pasta:
+            caminho = os.path.join(pasta, "fichas.json")
+            fichas = {}
+            for _ in range(quantidade):
+                dados = ficha_aleatoria(modulo, rng).para_dict()
+                if rng.random() < 0.1:
+                    del dados["bonus"]
+                fichas[str(rng.getrandbits(60))] = dados
+            with open(caminho, "w") as f:
+                json.dump(fichas, f, indent=4)
+            del fichas
+
+            tempos = {}
+            for formato in ("JSON", "binário"):
+                leitor = modulo.ArmazenamentoJSON(caminho, os.path.join(pasta, "fichas.journal"))
+                inicio = time.perf_counter()
+                leitor.carregar()
+                tempos[formato] = time.perf_counter() - inicio
+            inicio = time.perf_counter()
+            for user_id in leitor.listar_ids():
+                modulo.Ficha.de_dict(leitor.obter(user_id))
+            tempos["binário + uso de todas"] = tempos["binário"] + time.perf_counter() - inicio
+        print(
+            f"{quantidade} fichas: "
+            + ", ".join(f"{nome} {segundos:.2f}s ({quantidade / segundos:.0f} fichas/s)" for nome, segundos in tempos.items())
+        )
+
+
+def benchmark_ranking(modulo, quantidades, consultas):
+    """
+    Compara o !top (10 primeiros) e o !rank pelos índices ordenados com a varredura de todas as fichas a cada
+    consulta, e mede a montagem dos índices e a atualização deles depois de uma alteração de ficha.
+    """
+    m = modulo
+    rng = random.Random(0)
+    for quantidade in quantidades:
+        fichas = {user_id: ficha_aleatoria(m, rng) for user_id in range(quantidade)}
+        inicio = time.perf_counter()
+        ranking = m.RankingGuild({user_id: m.valores_ranking(user.status, user.bonus) for user_id, user in fichas.items()})
+        montagem = time.perf_counter() - inicio
+        atributos = [rng.randrange(len(m.bonus_validos)) for _ in range(consultas)]
+        alvos = [rng.randrange(quantidade) for _ in range(consultas)]
+        varreduras = max(1, consultas // 100) # A varredura é lenta demais para repetir todas as consultas
+
+        def top_varredura(i):
+            ordenadas = sorted((-m.valores_ranking(user.status, user.bonus)[i], user_id) for user_id, user in fichas.items())
+            return [(user_id, -negado) for negado, user_id in ordenadas[:10]]
+
+        def rank_varredura(user_id):
+            todos = [m.valores_ranking(user.status, user.bonus) for user in fichas.values()]
+            meus = m.valores_ranking(fichas[user_id].status, fichas[user_id].bonus)
+            return [(valor, 1 + sum(1 for valores in todos if valores[i] > valor)) for i, valor in enumerate(meus)]
+
+        for i, user_id in zip(atributos[:varreduras], alvos[:varreduras]):
+            assert top_varredura(i) == [(user_id_top, valor) for _, user_id_top, valor in ranking.top(i, 10)]
+            assert rank_varredura(user_id) == ranking.posicoes(user_id)
+
+        def medir(funcao, argumentos):
+            inicio = time.perf_counter()
+            for argumento in argumentos:
+                funcao(argumento)
+            return (time.perf_counter() - inicio) / len(argumentos)
+
+        def alterar(user_id):
+            user = fichas[user_id]
+            user.pts_gastos[rng.randrange(len(m.atributos_validos))] += 1
+            m.atualizar_status(user)
+            ranking.atualizar(user_id, m.valores_ranking(user.status, user.bonus))
+
+        tempos = {
+            "!top varredura": medir(top_varredura, atributos[:varreduras]),
+            "!top índice": medir(lambda i: ranking.top(i, 10), atributos),
+            "!rank varredura": medir(rank_varredura, alvos[:varreduras]),
+            "!rank índice": medir(ranking.posicoes, alvos),
+            "alteração + atualização do índice": medir(alterar, alvos),
+        }
+        print(
+            f"{quantidade} fichas: índices montados em {montagem:.2f}s, "
+            + ", ".join(f"{nome} {segundos * 1e6:.1f} µs" for nome, segundos in tempos.items())
+            + f"; !top {tempos['!top varredura'] / tempos['!top índice']:.0f}x e "
+            f"!rank {tempos['!rank varredura'] / tempos['!rank índice']:.0f}x mais rápidos."
+        )
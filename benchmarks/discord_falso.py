@@ -0,0 +1,70 @@
+"""
+Objetos do Discord simulados, para rodar os comandos do bot sem conexão (nos benchmarks e nos testes).
+Só têm o que os comandos usam: enviar, editar, buscar e apagar mensagens, com uma latência opcional.
+"""
+import asyncio
+import itertools
+
+
+class MensagemFalsa:
+    _ids = itertools.count(1)
+
+    def __init__(self, canal, content=None):
+        self.id = next(self._ids)
+        self.channel = canal
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel.simular_latencia()
+        self.channel.edicoes += 1
+        self.content = content
+        return self
+
+    async def delete(self):
+        await self.channel.simular_latencia()
+        self.channel.mensagens.pop(self.id, None)
+
+
+class CanalFalso:
+    def __init__(self, canal_id, latencia):
+        self.id = canal_id
+        self.latencia = latencia
+        self.mensagens = {}
+        self.envios = 0
+        self.edicoes = 0
+
+    async def simular_latencia(self):
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+
+    async def send(self, content=None, **kwargs):
+        await self.simular_latencia()
+        self.envios += 1
+        mensagem = MensagemFalsa(self, content)
+        self.mensagens[mensagem.id] = mensagem
+        return mensagem
+
+    def get_partial_message(self, message_id):
+        return self.mensagens.get(message_id) or MensagemFalsa(self)
+
+    async def fetch_message(self, message_id):
+        await self.simular_latencia()
+        return self.get_partial_message(message_id)
+
+
+class AutorFalso:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.mention = f"<@{user_id}>"
+        self.display_name = f"jogador{user_id}"
+
+
+class ContextoFalso:
+    def __init__(self, autor, canal):
+        self.author = autor
+        self.channel = canal
+        self.guild = None
+        self.interaction = None
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
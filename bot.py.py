@@ -1,223 +1,2827 @@
 import os
 import discord
 from discord.ext import commands
+from discord import app_commands
 import json
+import asyncio
+import signal
+import sqlite3
+import threading
+import time
+import sys
+import argparse
+import contextlib
+import random
+import itertools
+import bisect
+import heapq
+import struct
+import zlib
+import hashlib
+import gzip
+import datetime
+import functools
+import operator
+import logging
+import typing
+from array import array
+from collections import OrderedDict, deque
+
+try:
+    import numpy as np
+except ImportError: # NumPy é opcional: sem ele o recálculo em lote calcula uma ficha por vez
+    np = None
 
 # --- Configurações Iniciais ---
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Para listar os membros de um cargo no !addpontos @cargo. É uma intent privilegiada, então só é pedida com
+# FICHAS_INTENT_MEMBROS=1 (e "Server Members Intent" ativada no portal); sem ela, o alvo @cargo é recusado
+intents.members = os.getenv("FICHAS_INTENT_MEMBROS", "0") == "1"
+
+class FichaBot(commands.AutoShardedBot):
+    """Bot de fichas. Garante que nenhuma alteração pendente se perca ao desligar."""
+
+    async def setup_hook(self):
+        # Desliga de forma ordenada (gravando as fichas pendentes) também ao receber SIGTERM
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except (NotImplementedError, RuntimeError):
+            pass # Windows não suporta add_signal_handler
+        metricas.instalar_contador_rate_limit()
+        # Lê as fichas uma única vez, antes de conectar: as reconexões não descartam o que está em memória
+        inicio = time.perf_counter()
+        quantidade = await asyncio.to_thread(carregar_dados) # Lê os arquivos fora do loop do bot
+        duracao = time.perf_counter() - inicio
+        print(f"{quantidade} fichas carregadas em {duracao:.2f}s ({quantidade / duracao if duracao else 0:.0f} fichas/s).")
+        await sincronizar_comandos_barra()
+        self.servidor_metricas = await iniciar_exportador_metricas(METRICAS_PORTA) if METRICAS_PORTA else None
+
+    async def close(self):
+        # Grava tudo que já foi confirmado no chat antes de desconectar
+        await persistencia.descarregar()
+        print(persistencia.resumo())
+        print(agendador_fichas.resumo())
+        print(despachante.resumo())
+        print(cache_fichas.resumo())
+        await registro_eventos.descarregar()
+        print(registro_eventos.resumo())
+        registro_eventos.fechar()
+        armazenamento.fechar()
+        if getattr(self, "servidor_metricas", None):
+            self.servidor_metricas.close()
+        await super().close()
+
+# Shards conectados por este processo (ex: "0,1") e o total de shards, para dividir as guilds entre vários
+# processos do bot; cada processo só abre as fichas das guilds dos seus shards. Vazio: um processo com todos.
+SHARD_IDS = [int(shard) for shard in os.getenv("FICHAS_SHARDS", "").split(",") if shard.strip()] or None
+SHARD_COUNT = int(os.getenv("FICHAS_TOTAL_SHARDS", "0")) or None
+
+bot = FichaBot(command_prefix="!", intents=intents, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+
+# Pasta com as fichas de cada guild: <guild_id>.json (+ .journal) ou <guild_id>.db, conforme FICHAS_BACKEND
+FICHAS_DIR = "fichas"
+
+# Nome do arquivo onde as fichas eram salvas antes de serem separadas por guild
+FICHA_FILE = "fichas.json"
+
+# Journal com as alterações feitas desde o último snapshot salvo em FICHA_FILE
+JOURNAL_FILE = "fichas.journal"
+
+# Tamanho do journal (em bytes) a partir do qual ele é compactado em um novo snapshot
+JOURNAL_LIMITE_BYTES = 1024 * 1024
+
+# Janela (em segundos) em que alterações seguidas são juntadas em uma única escrita em disco
+JANELA_SALVAMENTO = 0.25
+
+# Espera máxima (em segundos) antes de tentar de novo uma gravação que falhou; a espera começa no dobro
+# de JANELA_SALVAMENTO e dobra a cada falha seguida
+ESPERA_MAXIMA_GRAVACAO = 60.0
+
+# Onde as fichas são guardadas: "json" (FICHA_FILE + journal) ou "sqlite" (FICHAS_DB)
+FICHAS_BACKEND = os.getenv("FICHAS_BACKEND", "json")
+
+# Banco de dados usado pelo backend "sqlite" antes de as fichas serem separadas por guild
+FICHAS_DB = "fichas.db"
+
+# Progresso de um recálculo em lote das fichas, para retomá-lo se o bot for interrompido no meio
+RECALCULO_FILE = "recalculo.json"
+
+# Quantas fichas são recalculadas e gravadas de cada vez no recálculo em lote
+LOTE_RECALCULO = 5000
+
+# Intervalo mínimo (em segundos) entre duas edições de ficha do recálculo em lote, no geral e no mesmo canal
+INTERVALO_REEDICAO = 0.25
+INTERVALO_REEDICAO_CANAL = 1.0
+
+# Máximo de fichas mantidas em memória e tempo (em segundos) sem uso até uma ficha poder sair da memória
+LIMITE_CACHE_FICHAS = 5000
+TTL_CACHE_FICHAS = 30 * 60
+
+# Máximo de travas de usuário mantidas em memória; as ociosas usadas há mais tempo são descartadas
+LIMITE_TRAVAS_USUARIOS = 10000
+
+# Janela (em segundos) em que atualizações seguidas da mesma ficha viram uma única edição
+JANELA_ATUALIZACAO_FICHA = 0.5
+
+# Máximo de edições de ficha em andamento ao mesmo tempo em um mesmo canal
+EDICOES_POR_CANAL = 2
+
+# Chamadas ao Discord por rota (operação + canal) dentro de JANELA_CHAMADAS_ROTA segundos (o Discord
+# aceita cerca de 5 mensagens a cada 5 segundos por canal)
+CHAMADAS_POR_ROTA = 5
+JANELA_CHAMADAS_ROTA = 5.0
+
+# Tentativas de uma chamada ao Discord recusada por rate limit (429) ou erro do servidor (5xx), e a espera
+# (em segundos) antes da primeira repetição, dobrada a cada nova tentativa
+TENTATIVAS_DISCORD = 4
+ESPERA_BASE_DISCORD = 0.5
+
+# Máximo de confirmações de comandos juntadas no topo da mensagem da ficha em uma mesma edição
+CONFIRMACOES_NA_FICHA = 3
+
+# Máximo de fichas listadas pelo !top
+LIMITE_TOP = 25
+
+# Maior valor (em módulo) dos pontos livres, dos pontos gastos em cada atributo e de cada bônus de uma ficha.
+# A Ficha e o snapshot binário guardam inteiros de 32 bits: com esse teto, nem o status antes dos limites de
+# rank (o bônus mais até 9 vezes os pontos gastos) passa de 2^31
+LIMITE_VALOR_FICHA = 100_000_000
+
+# Pasta do registro de eventos (quem alterou cada ficha, quando e como): arquivos NDJSON comprimidos com gzip,
+# trocados por um novo ao passar de EVENTOS_LIMITE_BYTES, e o índice SQLite usado pelo !historico
+EVENTOS_DIR = "eventos"
+EVENTOS_LIMITE_BYTES = 16 * 1024 * 1024
+
+# Janela (em segundos) em que os eventos registrados são juntados em uma única escrita
+JANELA_EVENTOS = 1.0
+
+# Máximo de alterações listadas pelo !historico
+LIMITE_HISTORICO = 20
+
+# Hash dos comandos de barra enviados ao Discord na última sincronização; a árvore só é sincronizada de novo
+# quando os comandos mudam
+COMANDOS_BARRA_HASH_FILE = "comandos_barra.hash"
+
+# Máximo de mensagens lidas do histórico de cada canal ao conferir as mensagens de ficha depois de conectar
+LIMITE_VARREDURA_CANAL = 10000
+
+# Formato da mensagem da ficha: "texto" (blocos de código) ou "embed"
+FICHA_FORMATO = os.getenv("FICHA_FORMATO", "texto")
+
+# Máximo de textos de seção da ficha guardados; fichas que mudam só uma seção reaproveitam o texto das outras
+LIMITE_SECOES_RENDERIZADAS = 4096
+
+# Coleta de métricas (tempo dos comandos, chamadas ao Discord, gravações); FICHAS_METRICAS=0 desliga
+METRICAS_ATIVAS = os.getenv("FICHAS_METRICAS", "1") != "0"
+
+# Porta local (127.0.0.1) onde as métricas são servidas no formato do Prometheus; 0 não abre a porta
+METRICAS_PORTA = int(os.getenv("FICHAS_METRICAS_PORTA", "0"))
+
+# Limites de Rank para cada atributo
+rank_limits = {
+    "I": 1,
+    "II": 2,
+    "III": 3,
+    "IV": 4,
+    "V": 5
+}
+
+# Atributos base que o jogador pode distribuir pontos
+atributos_validos = ["DMG", "HP", "FOR", "DEF", "RES", "MAG", "INT", "AGI", "VEL"]
+
+# Atributos que podem receber bônus diretos (inclui os atributos base e os calculados)
+bonus_validos = atributos_validos + ["LOCOMOCAO", "KRITOS", "PR"]
+
+# Limites de valor para cada atributo por Rank
+atributos_com_limite = {
+    "DMG": {"I": 20, "II": 45, "III": 99, "IV": 120, "V": 200},
+    "HP": {"I": 800, "II": 1800, "III": 2750, "IV": 3200, "V": 4500},
+    "FOR": {"I": 35, "II": 80, "III": 150, "IV": 200, "V": 300},
+    "DEF": {"I": 10, "II": 25, "III": 30, "IV": 50, "V": 100},
+    "RES": {"I": 100, "II": 150, "III": 250, "IV": 325, "V": 400},
+    "MAG": {"I": 50, "II": 150, "III": 200, "IV": 350, "V": 500},
+    "INT": {"I": 90, "II": 110, "III": 125, "IV": 140, "V": 230},
+    "AGI": {"I": 100, "II": 150, "III": 200, "IV": 325, "V": 450},
+    "VEL": {"I": 50, "II": 80, "III": 100, "IV": 150, "V": 200}
+}
+
+# Quanto os pontos gastos em cada atributo (chave) rendem nos atributos do status.
+# Um valor (multiplicador, divisor) rende (pontos // divisor) * multiplicador.
+conversao_pontos = {
+    "DMG": {"DMG": 2, "FOR": 2, "MAG": 1},
+    "HP": {"HP": 5, "RES": 2},
+    "FOR": {"FOR": 4, "RES": 4, "DEF": (1, 5)},
+    "DEF": {"DEF": 1, "RES": 1},
+    "RES": {"RES": 2, "HP": 2},
+    "MAG": {"MAG": 2},
+    "INT": {"INT": 2},
+    "AGI": {"AGI": 2, "VEL": 1},
+    "VEL": {"VEL": 2, "AGI": 1},
+}
+
+
+# Posição de cada atributo nos arrays da Ficha ('atributos_validos' é o começo de 'bonus_validos')
+indice_atributo = {attr: i for i, attr in enumerate(bonus_validos)}
+
+# Nome de cada rank a partir do número guardado na Ficha (o valor em 'rank_limits')
+nomes_rank = {numero: nome for nome, numero in rank_limits.items()}
+
+class Ficha:
+    """
+    Ficha de um usuário. Os pontos gastos, o status e os ranks ficam em arrays na ordem de
+    'atributos_validos' (os bônus na ordem de 'bonus_validos'), e cada rank é o seu número em 'rank_limits'.
+    Use 'indice_atributo' para achar a posição de um atributo. 'de_dict'/'para_dict' convertem para o
+    formato salvo em JSON.
+    """
+
+    __slots__ = ("pts_gastos", "bonus", "status", "ranks", "pontos", "ficha_message_id", "ficha_channel_id")
+
+    def __init__(self, pontos=35):
+        self.pts_gastos = array("i", [0]) * len(atributos_validos)
+        self.bonus = array("i", [0]) * len(bonus_validos)
+        self.status = array("i", [0]) * len(atributos_validos)
+        self.ranks = bytearray([rank_limits["I"]]) * len(atributos_validos)
+        self.pontos = pontos
+        self.ficha_message_id = None
+        self.ficha_channel_id = None
+
+    def rank(self, atributo):
+        """Nome do rank do atributo (ex: "III")."""
+        return nomes_rank[self.ranks[indice_atributo[atributo]]]
+
+    @classmethod
+    def de_dict(cls, dados):
+        """Cria a ficha a partir do formato JSON. Fichas antigas sem algum campo (ex: 'bonus') recebem o padrão."""
+        ficha = cls(dados.get("pontos", 0))
+        pts_gastos, status, ranks, bonus = (
+            dados.get("pts_gastos", {}), dados.get("status", {}), dados.get("ranks", {}), dados.get("bonus", {})
+        )
+        for i, attr in enumerate(atributos_validos):
+            ficha.pts_gastos[i] = pts_gastos.get(attr, 0)
+            ficha.status[i] = status.get(attr, 0)
+            ficha.ranks[i] = rank_limits[ranks.get(attr, "I")]
+        for i, attr in enumerate(bonus_validos):
+            ficha.bonus[i] = bonus.get(attr, 0)
+        ficha.ficha_message_id = dados.get("ficha_message_id")
+        ficha.ficha_channel_id = dados.get("ficha_channel_id")
+        return ficha
+
+    def para_dict(self):
+        """Converte a ficha para o formato JSON salvo em disco."""
+        return {
+            "pts_gastos": dict(zip(atributos_validos, self.pts_gastos)),
+            "bonus": dict(zip(bonus_validos, self.bonus)),
+            "status": dict(zip(atributos_validos, self.status)),
+            "pontos": self.pontos,
+            "ranks": {attr: nomes_rank[numero] for attr, numero in zip(atributos_validos, self.ranks)},
+            "ficha_message_id": self.ficha_message_id,
+            "ficha_channel_id": self.ficha_channel_id,
+        }
+
+def cabe_na_ficha(*valores):
+    """Se todos os valores cabem nos campos da Ficha (até LIMITE_VALOR_FICHA em módulo)."""
+    return all(-LIMITE_VALOR_FICHA <= valor <= LIMITE_VALOR_FICHA for valor in valores)
+
+# --- Métricas ---
+# Contadores e histogramas em memória, consultados pelo !metrics e pelo exportador no formato do Prometheus.
+# Com as métricas desligadas, cada ponto medido custa só uma verificação de 'ativo'.
+BALDES_TEMPO = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BALDES_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+class _Cronometro:
+    """Mede o tempo de um bloco 'with' e o registra no histograma 'nome'."""
+
+    __slots__ = ("metricas", "nome", "rotulos", "inicio")
+
+    def __init__(self, metricas, nome, rotulos):
+        self.metricas = metricas
+        self.nome = nome
+        self.rotulos = rotulos
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, erro, rastreamento):
+        self.metricas.observar(self.nome, time.perf_counter() - self.inicio, **self.rotulos)
+        return False
+
+class _ChamadaDiscord(_Cronometro):
+    """Cronômetro de uma chamada à API do Discord que também conta as falhas e os 429 (rate limit)."""
+
+    __slots__ = ()
+
+    def __exit__(self, tipo, erro, rastreamento):
+        super().__exit__(tipo, erro, rastreamento)
+        if isinstance(erro, discord.HTTPException):
+            self.metricas.contar("discord_erros_total", status=str(erro.status), **self.rotulos)
+            if erro.status == 429:
+                self.metricas.contar("discord_rate_limit_total")
+        return False
+
+class _ContadorRateLimit(logging.Handler):
+    """Conta os 429 que o discord.py recebe e espera sozinho (ele só os registra no log 'discord.http')."""
+
+    def __init__(self, metricas):
+        super().__init__(logging.WARNING)
+        self.metricas = metricas
+
+    def emit(self, registro):
+        if "429" in registro.getMessage():
+            self.metricas.contar("discord_rate_limit_total")
+
+class Metricas:
+    """
+    Contadores e histogramas identificados por nome e rótulos (ex: comando="add").
+    Os histogramas usam baldes fixos, então o custo de cada observação não cresce com o tempo de uso.
+    """
+
+    def __init__(self, ativo):
+        self.ativo = ativo
+        self.contadores = {} # (nome, rótulos) -> valor
+        self.histogramas = {} # (nome, rótulos) -> [contagem por balde, soma, total, baldes]
+        self.coletores = [] # Funções que retornam [(nome, valor)] lidos no momento da exportação
+        self._nulo = contextlib.nullcontext()
+
+    def contar(self, nome, valor=1, **rotulos):
+        if not self.ativo:
+            return
+        chave = (nome, tuple(sorted(rotulos.items())))
+        self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, baldes=BALDES_TEMPO, **rotulos):
+        if not self.ativo:
+            return
+        chave = (nome, tuple(sorted(rotulos.items())))
+        histograma = self.histogramas.get(chave)
+        if histograma is None:
+            histograma = self.histogramas[chave] = [[0] * (len(baldes) + 1), 0.0, 0, baldes]
+        histograma[0][bisect.bisect_left(baldes, valor)] += 1
+        histograma[1] += valor
+        histograma[2] += 1
+
+    def cronometro(self, nome, **rotulos):
+        """Context manager que registra a duração do bloco em segundos no histograma 'nome'."""
+        return _Cronometro(self, nome, rotulos) if self.ativo else self._nulo
+
+    def chamada_discord(self, operacao):
+        """Context manager para uma chamada à API do Discord (ex: operacao="editar")."""
+        if not self.ativo:
+            return self._nulo
+        self.contar("discord_chamadas_total", operacao=operacao)
+        return _ChamadaDiscord(self, "discord_chamada_segundos", {"operacao": operacao})
+
+    def instalar_contador_rate_limit(self):
+        """Passa a contar os 429 que o próprio discord.py trata (e que nunca chegam aos comandos)."""
+        if self.ativo:
+            logging.getLogger("discord.http").addHandler(_ContadorRateLimit(self))
+
+    def quantil(self, nome, quantil, **rotulos):
+        """Estimativa do quantil pelo limite superior do balde onde ele cai (None se não há observações)."""
+        histograma = self.histogramas.get((nome, tuple(sorted(rotulos.items()))))
+        if not histograma or not histograma[2]:
+            return None
+        contagens, _, total, baldes = histograma
+        alvo = quantil * total
+        acumulado = 0
+        for i, contagem in enumerate(contagens):
+            acumulado += contagem
+            if acumulado >= alvo:
+                return baldes[i] if i < len(baldes) else float("inf")
+        return float("inf")
+
+    def exportar(self):
+        """Todas as métricas no formato de texto do Prometheus."""
+        linhas = []
+        tipos_vistos = set()
+
+        def tipo(nome, tipo_metrica):
+            if nome not in tipos_vistos:
+                tipos_vistos.add(nome)
+                linhas.append(f"# TYPE fichas_{nome} {tipo_metrica}")
+
+        def rotulos_texto(rotulos):
+            if not rotulos:
+                return ""
+            return "{" + ",".join(f'{chave}="{valor}"' for chave, valor in rotulos) + "}"
+
+        for (nome, rotulos), valor in sorted(self.contadores.items()):
+            tipo(nome, "counter")
+            linhas.append(f"fichas_{nome}{rotulos_texto(rotulos)} {valor}")
+        for (nome, rotulos), (contagens, soma, total, baldes) in sorted(self.histogramas.items(), key=lambda item: item[0]):
+            tipo(nome, "histogram")
+            acumulado = 0
+            for limite, contagem in zip(list(baldes) + ["+Inf"], contagens):
+                acumulado += contagem
+                linhas.append(f"fichas_{nome}_bucket{rotulos_texto(rotulos + (('le', limite),))} {acumulado}")
+            linhas.append(f"fichas_{nome}_sum{rotulos_texto(rotulos)} {soma}")
+            linhas.append(f"fichas_{nome}_count{rotulos_texto(rotulos)} {total}")
+        for coletor in self.coletores:
+            for nome, valor in coletor():
+                tipo(nome, "gauge")
+                linhas.append(f"fichas_{nome} {valor}")
+        return "\n".join(linhas) + "\n"
+
+metricas = Metricas(METRICAS_ATIVAS)
+
+async def _responder_metricas(leitor, escritor):
+    """Atende uma requisição HTTP do Prometheus (qualquer caminho) com as métricas atuais."""
+    try:
+        while (await leitor.readline()) not in (b"\r\n", b"\n", b""):
+            pass # Ignora a linha da requisição e os cabeçalhos
+        corpo = metricas.exportar().encode()
+        escritor.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(corpo)}\r\nConnection: close\r\n\r\n".encode()
+            + corpo
+        )
+        await escritor.drain()
+    except ConnectionError:
+        pass
+    finally:
+        escritor.close()
+
+async def iniciar_exportador_metricas(porta):
+    """Serve as métricas em http://127.0.0.1:<porta>/metrics. Retorna o servidor (para fechá-lo ao desligar)."""
+    servidor = await asyncio.start_server(_responder_metricas, "127.0.0.1", porta)
+    print(f"Métricas disponíveis em http://127.0.0.1:{porta}/metrics")
+    return servidor
+
+def _formatar_tempo(segundos):
+    if segundos is None:
+        return "-"
+    if segundos == float("inf"):
+        return f">{BALDES_TEMPO[-1]:g}s"
+    return f"≤{segundos * 1000:g}ms"
+
+def resumo_metricas():
+    """Texto do !metrics: latência por comando, chamadas ao Discord, 429, gravações e os resumos internos."""
+    linhas = ["Comandos (execuções, média, p50, p99):"]
+    for (nome, rotulos), (_, soma, total, _) in sorted(metricas.histogramas.items()):
+        if nome != "comando_segundos":
+            continue
+        comando = dict(rotulos)["comando"]
+        linhas.append(
+            f"  !{comando}: {total}, {soma / total * 1000:.1f}ms, "
+            f"{_formatar_tempo(metricas.quantil(nome, 0.5, **dict(rotulos)))}, "
+            f"{_formatar_tempo(metricas.quantil(nome, 0.99, **dict(rotulos)))}"
+        )
+    erros_comandos = sum(valor for (nome, _), valor in metricas.contadores.items() if nome == "comando_erros_total")
+    linhas.append(f"  Erros nos comandos: {erros_comandos}")
+
+    linhas.append("Discord (chamadas, p50, p99, erros):")
+    for (nome, rotulos), valor in sorted(metricas.contadores.items()):
+        if nome != "discord_chamadas_total":
+            continue
+        operacao = dict(rotulos)["operacao"]
+        erros = sum(
+            v for (n, r), v in metricas.contadores.items()
+            if n == "discord_erros_total" and dict(r).get("operacao") == operacao
+        )
+        linhas.append(
+            f"  {operacao}: {valor}, {_formatar_tempo(metricas.quantil('discord_chamada_segundos', 0.5, operacao=operacao))}, "
+            f"{_formatar_tempo(metricas.quantil('discord_chamada_segundos', 0.99, operacao=operacao))}, {erros}"
+        )
+    linhas.append(f"  Rate limit (429): {metricas.contadores.get(('discord_rate_limit_total', ()), 0)}")
+    linhas.append(f"  Edições evitadas (ficha sem mudança): {metricas.contadores.get(('edicoes_evitadas_total', ()), 0)}")
+
+    gravacoes = metricas.histogramas.get(("gravacao_bytes", ()))
+    if gravacoes and gravacoes[2]:
+        linhas.append(
+            f"Gravações: {gravacoes[2]}, média {gravacoes[1] / gravacoes[2] / 1024:.1f} KiB, "
+            f"p99 ≤{metricas.quantil('gravacao_bytes', 0.99) / 1024:g} KiB, "
+            f"tempo p99 {_formatar_tempo(metricas.quantil('gravacao_segundos', 0.99))}"
+        )
+    renderizacao = metricas.quantil("renderizacao_segundos", 0.99)
+    if renderizacao is not None:
+        linhas.append(f"Renderização da ficha: p99 {_formatar_tempo(renderizacao)}")
+    erros = {dict(r)["origem"]: v for (n, r), v in metricas.contadores.items() if n == "erros_total"}
+    if erros:
+        linhas.append("Erros internos: " + ", ".join(f"{origem} {valor}" for origem, valor in sorted(erros.items())))
+    linhas.extend([persistencia.resumo(), cache_fichas.resumo(), agendador_fichas.resumo(), despachante.resumo()])
+    return "\n".join(linhas)
+
+# --- Fila de Envio ao Discord ---
+# As mensagens que o bot envia e edita passam por uma fila por canal: as edições de ficha saem antes das
+# confirmações, cada rota (operação + canal) respeita CHAMADAS_POR_ROTA, e uma chamada recusada por rate
+# limit ou erro do servidor é repetida com espera crescente em vez de virar um erro no comando.
+PRIORIDADE_FICHA = 0
+PRIORIDADE_CONFIRMACAO = 1
+PRIORIDADE_EM_MASSA = 2 # Reedições do recálculo em lote, que não devem atrasar os jogadores
+
+def _espera_retry_after(erro):
+    """Segundos pedidos pelo Discord no cabeçalho Retry-After de um 429, se houver."""
+    try:
+        return float(erro.response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+class DespachanteDiscord:
+    """
+    Executa as chamadas ao Discord de cada canal uma por vez, sempre a de maior prioridade primeiro,
+    sem passar do limite de chamadas de cada rota e repetindo as que falham por rate limit ou erro 5xx.
+    """
+
+    def __init__(self, chamadas_por_rota, janela, tentativas, espera_base):
+        self.chamadas_por_rota = chamadas_por_rota
+        self.janela = janela
+        self.tentativas = tentativas
+        self.espera_base = espera_base
+        self.chamadas = 0
+        self.repetidas = 0
+        self._filas = {} # channel_id -> heap de (prioridade, ordem, operação, chamada, futuro)
+        self._trabalhadores = {} # channel_id -> tarefa que esvazia a fila do canal
+        self._rotas = {} # (operação, channel_id) -> instantes das últimas chamadas da rota
+        self._bloqueadas = {} # (operação, channel_id) -> instante até quando um 429 bloqueia a rota
+        self._ordem = itertools.count() # Desempate: mesma prioridade sai na ordem de chegada
+
+    def agendar(self, channel_id, prioridade, operacao, chamada):
+        """
+        Põe 'chamada' (função sem argumentos que retorna a corrotina da chamada ao Discord) na fila do canal.
+        Retorna um futuro com o resultado ou o erro da chamada.
+        """
+        futuro = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._filas.setdefault(channel_id, []), (prioridade, next(self._ordem), operacao, chamada, futuro))
+        if channel_id not in self._trabalhadores:
+            self._trabalhadores[channel_id] = asyncio.create_task(self._esvaziar(channel_id))
+        return futuro
+
+    async def executar(self, channel_id, prioridade, operacao, chamada):
+        """Agenda a chamada e espera o resultado (os erros que não são de rate limit chegam a quem chamou)."""
+        return await self.agendar(channel_id, prioridade, operacao, chamada)
+
+    def disparar(self, channel_id, prioridade, operacao, chamada):
+        """Agenda uma chamada cujo resultado ninguém espera; se ela falhar, o erro só é registrado."""
+        self.agendar(channel_id, prioridade, operacao, chamada).add_done_callback(self._registrar_falha)
+
+    @staticmethod
+    def _registrar_falha(futuro):
+        if not futuro.cancelled() and futuro.exception():
+            print(f"Erro ao enviar mensagem ao Discord: {futuro.exception()}")
+            metricas.contar("erros_total", origem="despachante")
+
+    def _espera_rota(self, rota):
+        """Quanto tempo falta para a rota aceitar mais uma chamada."""
+        agora = time.monotonic()
+        espera = self._bloqueadas.get(rota, 0.0) - agora
+        chamadas = self._rotas.get(rota)
+        if chamadas and len(chamadas) == self.chamadas_por_rota:
+            espera = max(espera, chamadas[0] + self.janela - agora)
+        return espera
+
+    async def _esvaziar(self, channel_id):
+        fila = self._filas[channel_id]
+        try:
+            while fila:
+                # Espera a rota da chamada mais prioritária; outra mais prioritária pode chegar durante a espera
+                espera = self._espera_rota((fila[0][2], channel_id))
+                if espera > 0:
+                    await asyncio.sleep(espera)
+                    continue
+                _, _, operacao, chamada, futuro = heapq.heappop(fila)
+                try:
+                    resultado = await self._chamar((operacao, channel_id), chamada)
+                except Exception as e:
+                    if not futuro.done():
+                        futuro.set_exception(e)
+                else:
+                    if not futuro.done():
+                        futuro.set_result(resultado)
+        finally:
+            del self._trabalhadores[channel_id]
+            if not fila:
+                del self._filas[channel_id]
+
+    async def _chamar(self, rota, chamada):
+        operacao = rota[0]
+        for tentativa in range(self.tentativas):
+            self.chamadas += 1
+            self._rotas.setdefault(rota, deque(maxlen=self.chamadas_por_rota)).append(time.monotonic())
+            try:
+                with metricas.chamada_discord(operacao):
+                    return await chamada()
+            except discord.RateLimited as e:
+                if tentativa + 1 == self.tentativas:
+                    raise
+                espera = e.retry_after
+            except discord.HTTPException as e:
+                if (e.status != 429 and e.status < 500) or tentativa + 1 == self.tentativas:
+                    raise
+                espera = _espera_retry_after(e) or self.espera_base * 2 ** tentativa
+            self.repetidas += 1
+            espera *= 1 + random.random() * 0.1 # Evita que as rotas bloqueadas voltem todas no mesmo instante
+            self._bloqueadas[rota] = time.monotonic() + espera
+            await asyncio.sleep(espera)
+
+    def profundidade(self):
+        """Quantas chamadas estão esperando na fila de algum canal."""
+        return sum(len(fila) for fila in self._filas.values())
+
+    def resumo(self):
+        return (
+            f"Envios ao Discord: {self.chamadas} chamadas, {self.repetidas} repetidas após rate limit ou erro, "
+            f"{self.profundidade()} na fila."
+        )
+
+despachante = DespachanteDiscord(CHAMADAS_POR_ROTA, JANELA_CHAMADAS_ROTA, TENTATIVAS_DISCORD, ESPERA_BASE_DISCORD)
+
+# --- Funções de Salvamento e Carregamento ---
+# Os comandos só marcam a ficha alterada; a PersistenciaAssincrona junta as alterações de uma janela
+# e as entrega ao backend de armazenamento em uma thread separada.
+def chave_ficha(guild, user_id):
+    """
+    Chave da ficha de 'user_id' em uma guild ("guild_id:user_id"; guild None = mensagens diretas).
+    Cada servidor tem as suas fichas; é essa chave que o cache, as travas e a persistência usam.
+    """
+    return f"{guild.id if guild else 0}:{user_id}"
+
+# Guild das chaves das fichas do formato antigo (sem guild) que ainda não foram adotadas por nenhuma guild.
+# Com ela, essas fichas entram no recálculo, na reconstrução e no índice de mensagens antes de serem usadas
+GUILD_LEGADO = -1
+
+def separar_chave(chave):
+    """Retorna (guild_id, user_id) de uma chave de ficha."""
+    guild_id, _, user_id = chave.partition(":")
+    return int(guild_id), user_id
+
+def guild_deste_processo(guild_id):
+    """Indica se a guild está em um dos shards deste processo (as mensagens diretas ficam no shard 0)."""
+    return SHARD_IDS is None or (guild_id >> 22) % SHARD_COUNT in SHARD_IDS
+
+def _escrever_atomico(caminho, conteudo):
+    """
+    Escreve o arquivo em um temporário e o renomeia por cima do original, para nunca deixá-lo pela metade.
+    'conteudo' é um texto ou um iterável de partes do texto.
+    """
+    temporario = caminho + ".tmp"
+    with open(temporario, "w") as f:
+        if isinstance(conteudo, str):
+            f.write(conteudo)
+        else:
+            f.writelines(conteudo)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporario, caminho)
+
+def _aplicar_journal(dados, caminho):
+    """
+    Reaplica sobre 'dados' as alterações registradas em um arquivo de journal.
+    Uma última linha cortada (queda no meio da escrita) é removida do arquivo: senão a próxima gravação
+    seria colada nela, e a linha resultante, ilegível, esconderia essa gravação na próxima leitura.
+    """
+    if not os.path.exists(caminho):
+        return
+    fim_valido = 0 # Posição logo depois da última linha completa
+    cortada = False
+    with open(caminho, "rb") as f:
+        for linha in f:
+            try:
+                if not linha.endswith(b"\n"):
+                    raise ValueError("linha sem o fim")
+                registro = json.loads(linha)
+            except ValueError:
+                cortada = True
+                continue
+            if cortada:
+                # Uma linha ilegível no meio (ex: um journal gravado antes desta correção): só ela se perde
+                print(f"Registro ilegível ignorado no meio de {caminho}.")
+                cortada = False
+            fim_valido = f.tell()
+            if registro["op"] == "set":
+                dados[registro["id"]] = registro["ficha"]
+            else:
+                dados.pop(registro["id"], None)
+    if cortada:
+        print(f"Registro incompleto removido do final de {caminho}.")
+        with open(caminho, "r+b") as f:
+            f.truncate(fim_valido)
+            os.fsync(f.fileno())
+
+def validar_ficha(dados):
+    """
+    Confere uma ficha lida do JSON e completa os campos que faltam nas fichas antigas (ex: 'bonus').
+    Retorna (ficha completa, se faltava algum campo). Levanta ValueError se algum valor é inválido.
+    """
+    if not isinstance(dados, dict):
+        raise ValueError("a ficha não é um objeto")
+    ficha = {}
+    migrada = False
+    for campo, nomes, padrao in (
+        ("pts_gastos", atributos_validos, 0), ("bonus", bonus_validos, 0),
+        ("status", atributos_validos, 0), ("ranks", atributos_validos, "I"),
+    ):
+        valores = dados.get(campo, {})
+        if not isinstance(valores, dict):
+            raise ValueError(f"'{campo}' não é um objeto")
+        ficha[campo] = completos = {nome: valores.get(nome, padrao) for nome in nomes}
+        migrada = migrada or len(valores) < len(nomes) or campo not in dados
+        if campo == "ranks":
+            if not all(rank in rank_limits for rank in completos.values()):
+                raise ValueError(f"rank inválido em {completos}")
+        elif not all(type(valor) is int for valor in completos.values()):
+            raise ValueError(f"valor não inteiro em '{campo}'")
+        elif not cabe_na_ficha(*completos.values()):
+            # Ex: um bônus dado antes de existir o limite, que estouraria os arrays da Ficha no próximo comando
+            raise ValueError(f"valor fora do limite de {LIMITE_VALOR_FICHA} em '{campo}'")
+    ficha["pontos"] = dados.get("pontos", 0)
+    ficha["ficha_message_id"] = dados.get("ficha_message_id")
+    ficha["ficha_channel_id"] = dados.get("ficha_channel_id")
+    if type(ficha["pontos"]) is not int:
+        raise ValueError("'pontos' não é inteiro")
+    if not cabe_na_ficha(ficha["pontos"]):
+        raise ValueError(f"'pontos' fora do limite de {LIMITE_VALOR_FICHA}")
+    if not all(ficha[campo] is None or type(ficha[campo]) is int for campo in ("ficha_message_id", "ficha_channel_id")):
+        raise ValueError("ID de mensagem ou canal inválida")
+    return ficha, migrada or "pontos" not in dados
+
+# Snapshot binário: o snapshot JSON em registros de tamanho fixo, na ordem de 'atributos_validos' e
+# 'bonus_validos'. Cada registro é o ID do usuário, os pontos gastos, os bônus, o status, os ranks (o número
+# em 'rank_limits'), os pontos livres e as IDs da mensagem e do canal da ficha (0 quando não há).
+# O cabeçalho guarda o tamanho e a data do JSON de origem: se o JSON mudar, o binário é refeito a partir dele.
+_REGISTRO_FICHA = struct.Struct(
+    f"<Q{len(atributos_validos)}i{len(bonus_validos)}i{len(atributos_validos)}i{len(atributos_validos)}BiQQ"
+)
+_CABECALHO_BINARIO = struct.Struct("<8sIqqI") # Marca, formato dos registros, tamanho e data do JSON, fichas
+_MARCA_BINARIO = b"FICHABIN"
+_FORMATO_BINARIO = zlib.crc32(repr((atributos_validos, bonus_validos, rank_limits, _REGISTRO_FICHA.format)).encode())
+
+# Onde cada parte da ficha começa dentro de um registro
+_R_PTS = 1
+_R_BONUS = _R_PTS + len(atributos_validos)
+_R_STATUS = _R_BONUS + len(bonus_validos)
+_R_RANKS = _R_STATUS + len(atributos_validos)
+_R_PONTOS = _R_RANKS + len(atributos_validos)
+
+def _registro_da_ficha(user_id, dados):
+    """Registro do snapshot binário de uma ficha no formato JSON (já completa)."""
+    return _REGISTRO_FICHA.pack(
+        int(user_id),
+        *(dados["pts_gastos"][attr] for attr in atributos_validos),
+        *(dados["bonus"][attr] for attr in bonus_validos),
+        *(dados["status"][attr] for attr in atributos_validos),
+        *(rank_limits[dados["ranks"][attr]] for attr in atributos_validos),
+        dados["pontos"],
+        dados["ficha_message_id"] or 0,
+        dados["ficha_channel_id"] or 0,
+    )
+
+def _ficha_do_registro(registro):
+    """Converte um registro do snapshot binário de volta para o formato JSON."""
+    return {
+        "pts_gastos": dict(zip(atributos_validos, registro[_R_PTS:_R_BONUS])),
+        "bonus": dict(zip(bonus_validos, registro[_R_BONUS:_R_STATUS])),
+        "status": dict(zip(atributos_validos, registro[_R_STATUS:_R_RANKS])),
+        "pontos": registro[_R_PONTOS],
+        "ranks": {attr: nomes_rank[numero] for attr, numero in zip(atributos_validos, registro[_R_RANKS:_R_PONTOS])},
+        "ficha_message_id": registro[-2] or None,
+        "ficha_channel_id": registro[-1] or None,
+    }
+
+def _ficha_guardada(user_id, ficha, texto=None):
+    """
+    Forma em que o ArmazenamentoJSON guarda uma ficha (no formato JSON) na memória: o registro do snapshot
+    binário, bem menor que os dicionários, ou o texto JSON dela ('texto', se já serializada) se não cabe nele.
+    """
+    try:
+        return _registro_da_ficha(user_id, ficha)
+    except (KeyError, TypeError, AttributeError, ValueError, struct.error):
+        return texto if texto is not None else json.dumps(ficha, separators=(",", ":"))
+
+def _ficha_da_memoria(guardada):
+    """Converte uma ficha guardada por _ficha_guardada de volta para o formato JSON."""
+    if type(guardada) is bytes:
+        return _ficha_do_registro(_REGISTRO_FICHA.unpack(guardada))
+    return json.loads(guardada)
+
+def _snapshot_json(fichas):
+    """Partes do snapshot JSON das fichas ((user_id, ficha), uma de cada vez), igual ao json.dumps com indent=4."""
+    vazio = True
+    yield "{"
+    for user_id, ficha in fichas:
+        yield ("\n" if vazio else ",\n") + f"    {json.dumps(user_id)}: " + json.dumps(ficha, indent=4).replace("\n", "\n    ")
+        vazio = False
+    yield "}" if vazio else "\n}"
+
+class ArmazenamentoFichas:
+    """
+    Interface dos backends de armazenamento das fichas.
+    As fichas chegam em 'gravar' já serializadas em JSON; 'gravar' é chamado fora do loop do bot.
+    """
+
+    # Se 'obter' só lê da memória: nesse caso o cache lê as fichas direto no loop, sem passar por uma thread
+    leitura_em_memoria = False
+
+    def carregar(self):
+        """Lê o que o backend precisa ter em memória desde o início e retorna quantas fichas foram lidas."""
+        raise NotImplementedError
+
+    def obter(self, user_id):
+        """Lê uma ficha que ainda não está em memória. Retorna None se ela não existir."""
+        raise NotImplementedError
+
+    def listar_ids(self):
+        """Retorna os IDs de todas as fichas guardadas, carregadas ou não."""
+        raise NotImplementedError
+
+    def adotada(self, user_id):
+        """Indica se a ficha lida por 'obter' ainda precisa ser gravada para ficar no lugar certo."""
+        return False
+
+    def listar_mensagens(self):
+        """Retorna (user_id, channel_id, message_id) de todas as fichas com mensagem registrada."""
+        raise NotImplementedError
+
+    def gravar(self, lote):
+        """Grava um lote {user_id: ficha em JSON}; None no lugar da ficha apaga o registro."""
+        raise NotImplementedError
+
+    def fechar(self):
+        """Libera os recursos do backend."""
+
+class ArmazenamentoJSON(ArmazenamentoFichas):
+    """
+    Fichas em um snapshot JSON mais um journal com uma linha por alteração.
+    Cada gravação só acrescenta as fichas alteradas ao journal; o snapshot inteiro só é reescrito
+    quando o journal passa de JOURNAL_LIMITE_BYTES.
+    O snapshot também é guardado no formato binário (em 'caminho'.bin), que é o lido no início enquanto
+    o JSON não mudar. Em memória cada ficha fica como o registro binário dela (ou o texto JSON, se não cabe
+    no registro), convertida para o formato JSON só quando é lida.
+    """
+
+    leitura_em_memoria = True
+
+    def __init__(self, caminho, journal):
+        self.caminho = caminho
+        self.binario = caminho + ".bin"
+        self.journal = journal
+        self.journal_compactando = journal + ".compactando"
+        self._fichas = {} # O arquivo inteiro fica em memória (registros ou textos JSON); é daqui que 'obter' lê
+
+    def _ler_snapshot(self):
+        if not os.path.exists(self.caminho):
+            return {}
+        origem = os.stat(self.caminho)
+        dados = self._ler_binario(origem)
+        if dados is not None:
+            return dados
+        try:
+            with open(self.caminho, "r") as f:
+                lidos = json.load(f)
+        except json.JSONDecodeError:
+            # Guarda o arquivo à parte em vez de deixar a próxima compactação sobrescrevê-lo
+            print(f"Erro ao ler o arquivo {self.caminho}. Uma cópia foi guardada em {self.caminho}.corrompido.")
+            os.replace(self.caminho, self.caminho + ".corrompido")
+            return {}
+        # Confere, completa e converte para o binário todas as fichas em uma só passada
+        dados, registros, invalidas, migradas = {}, [], {}, 0
+        for user_id, ficha in lidos.items():
+            try:
+                # Uma ficha completa vira o registro direto; o empacotamento já confere os tipos
+                registro = _registro_da_ficha(user_id, ficha)
+                if not cabe_na_ficha(
+                    ficha["pontos"], *ficha["pts_gastos"].values(), *ficha["bonus"].values(), *ficha["status"].values()
+                ):
+                    raise ValueError("valor fora do limite") # validar_ficha diz qual
+            except (KeyError, TypeError, AttributeError, ValueError, struct.error):
+                # Ficha antiga ou com algum valor inválido: confere campo a campo e completa o que falta
+                try:
+                    ficha, migrada = validar_ficha(ficha)
+                except ValueError as e:
+                    print(f"Ficha {user_id} de {self.caminho} ignorada: {e}")
+                    invalidas[user_id] = ficha
+                    continue
+                migradas += migrada
+                try:
+                    registro = _registro_da_ficha(user_id, ficha)
+                except (ValueError, struct.error):
+                    registro = None # Ex: uma ID que não é numérica
+            dados[user_id] = registro if registro is not None else json.dumps(ficha, separators=(",", ":"))
+            registros.append(registro)
+        if migradas:
+            print(f"{migradas} fichas antigas de {self.caminho} completadas com os campos que faltavam.")
+        if invalidas:
+            # Fora do snapshot, a próxima compactação apagaria essas fichas; a cópia fica para conserto manual
+            _escrever_atomico(self.caminho + ".invalidas", json.dumps(invalidas, indent=4))
+            print(f"{len(invalidas)} fichas inválidas guardadas em {self.caminho}.invalidas.")
+        self._escrever_binario(registros, origem)
+        return dados
+
+    def _ler_binario(self, origem):
+        """Fichas do snapshot binário, ou None se ele não existe ou não foi gerado a partir do JSON atual."""
+        try:
+            with open(self.binario, "rb") as f:
+                conteudo = f.read()
+            marca, formato, tamanho, data, quantidade = _CABECALHO_BINARIO.unpack_from(conteudo)
+        except (OSError, struct.error):
+            return None
+        if (
+            marca != _MARCA_BINARIO or formato != _FORMATO_BINARIO
+            or (tamanho, data) != (origem.st_size, origem.st_mtime_ns)
+            or len(conteudo) != _CABECALHO_BINARIO.size + quantidade * _REGISTRO_FICHA.size
+        ):
+            return None
+        tamanho = _REGISTRO_FICHA.size
+        return {
+            str(int.from_bytes(conteudo[inicio:inicio + 8], "little")): conteudo[inicio:inicio + tamanho]
+            for inicio in range(_CABECALHO_BINARIO.size, len(conteudo), tamanho)
+        }
+
+    def _escrever_binario(self, registros, origem):
+        """Grava o snapshot binário com os registros das fichas do JSON descrito por 'origem' (o os.stat dele)."""
+        if None in registros:
+            # O JSON continua sendo lido normalmente, só sem o atalho do binário
+            print(f"Snapshot binário de {self.caminho} não gerado: há fichas que não cabem no formato binário.")
+            return
+        cabecalho = _CABECALHO_BINARIO.pack(_MARCA_BINARIO, _FORMATO_BINARIO, origem.st_size, origem.st_mtime_ns, len(registros))
+        temporario = self.binario + ".tmp"
+        with open(temporario, "wb") as f:
+            f.write(cabecalho)
+            f.writelines(registros)
+        os.replace(temporario, self.binario)
+
+    def carregar(self):
+        dados = self._ler_snapshot()
+        # O journal de uma compactação interrompida vem antes do journal atual
+        _aplicar_journal(dados, self.journal_compactando)
+        _aplicar_journal(dados, self.journal)
+        for user_id, ficha in dados.items():
+            if type(ficha) is dict: # Reaplicada do journal
+                dados[user_id] = _ficha_guardada(user_id, ficha)
+        self._fichas = dados
+        return len(dados)
+
+    def obter(self, user_id):
+        guardada = self._fichas.get(user_id)
+        return _ficha_da_memoria(guardada) if guardada is not None else None
+
+    def listar_ids(self):
+        return list(self._fichas)
+
+    def listar_mensagens(self):
+        mensagens = []
+        for user_id, guardada in self._fichas.items():
+            if type(guardada) is bytes:
+                message_id, channel_id = _REGISTRO_FICHA.unpack(guardada)[-2:]
+            else:
+                dados = json.loads(guardada)
+                message_id, channel_id = dados.get("ficha_message_id"), dados.get("ficha_channel_id")
+            if channel_id and message_id:
+                mensagens.append((user_id, channel_id, message_id))
+        return mensagens
+
+    def gravar(self, lote):
+        linhas = []
+        for user_id, dados in lote.items():
+            if dados is not None:
+                linhas.append(f'{{"op":"set","id":{json.dumps(user_id)},"ficha":{dados}}}\n')
+                self._fichas[user_id] = _ficha_guardada(user_id, json.loads(dados), dados)
+            else:
+                linhas.append(f'{{"op":"del","id":{json.dumps(user_id)}}}\n')
+                self._fichas.pop(user_id, None)
+        with open(self.journal, "a") as f:
+            f.writelines(linhas)
+            f.flush()
+            os.fsync(f.fileno())
+            tamanho = f.tell()
+        if tamanho >= JOURNAL_LIMITE_BYTES:
+            self.compactar()
+
+    def compactar(self):
+        """Incorpora o journal a um novo snapshot, lendo tudo do disco (as gravações são sequenciais)."""
+        if os.path.exists(self.journal_compactando):
+            # Uma compactação anterior falhou: junta o journal atual ao pendente em vez de sobrescrevê-lo
+            with open(self.journal, "r") as origem, open(self.journal_compactando, "a") as destino:
+                destino.write(origem.read())
+            os.remove(self.journal)
+        else:
+            os.replace(self.journal, self.journal_compactando)
+        dados = self._ler_snapshot()
+        _aplicar_journal(dados, self.journal_compactando)
+        for user_id, ficha in dados.items():
+            if type(ficha) is dict: # Reaplicada do journal
+                dados[user_id] = _ficha_guardada(user_id, ficha)
+        # Cada ficha é convertida só na hora de ser escrita, sem montar todas em dicionários ao mesmo tempo
+        _escrever_atomico(self.caminho, _snapshot_json((user_id, _ficha_da_memoria(ficha)) for user_id, ficha in dados.items()))
+        registros = [ficha if type(ficha) is bytes else None for ficha in dados.values()]
+        self._escrever_binario(registros, os.stat(self.caminho))
+        # Só descarta o journal antigo depois que o snapshot novo já está no lugar
+        os.remove(self.journal_compactando)
+
+class ArmazenamentoSQLite(ArmazenamentoFichas):
+    """
+    Fichas em um banco SQLite (modo WAL), uma linha por usuário.
+    Nada é carregado no início: cada ficha é lida no primeiro acesso (fora do loop do bot, pelo
+    CacheFichas.obter_sem_bloquear), e cada gravação só toca as linhas dos usuários alterados.
+    """
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self._trava = threading.Lock() # A mesma conexão é usada pelo loop e pela thread de gravação
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self.conexao.execute("PRAGMA journal_mode=WAL")
+        self.conexao.execute("PRAGMA synchronous=NORMAL")
+        self.conexao.execute("CREATE TABLE IF NOT EXISTS fichas (user_id TEXT PRIMARY KEY, dados TEXT NOT NULL)")
+        self.conexao.commit()
+
+    def carregar(self):
+        return 0
+
+    def obter(self, user_id):
+        with self._trava:
+            linha = self.conexao.execute("SELECT dados FROM fichas WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def listar_ids(self):
+        with self._trava:
+            return [linha[0] for linha in self.conexao.execute("SELECT user_id FROM fichas")]
+
+    def listar_mensagens(self):
+        # Lê só as IDs de dentro do JSON, sem trazer as fichas inteiras para o Python
+        with self._trava:
+            return self.conexao.execute(
+                "SELECT user_id, json_extract(dados, '$.ficha_channel_id'), json_extract(dados, '$.ficha_message_id') "
+                "FROM fichas WHERE json_extract(dados, '$.ficha_message_id') IS NOT NULL "
+                "AND json_extract(dados, '$.ficha_channel_id') IS NOT NULL"
+            ).fetchall()
+
+    def gravar(self, lote):
+        alteradas = [(user_id, dados) for user_id, dados in lote.items() if dados is not None]
+        apagadas = [(user_id,) for user_id, dados in lote.items() if dados is None]
+        with self._trava, self.conexao:
+            self.conexao.executemany("INSERT OR REPLACE INTO fichas (user_id, dados) VALUES (?, ?)", alteradas)
+            self.conexao.executemany("DELETE FROM fichas WHERE user_id = ?", apagadas)
+
+    def fechar(self):
+        with self._trava:
+            self.conexao.close()
+
+class ArmazenamentoPorGuild(ArmazenamentoFichas):
+    """
+    Uma partição (um backend "json" ou "sqlite" próprio) por guild, em 'diretorio'. As chaves das fichas
+    são as de chave_ficha. Cada partição só é aberta quando alguma ficha da guild é usada, e só as guilds
+    dos shards deste processo são listadas.
+    Uma ficha do formato antigo (sem guild) passa para a guild em que o jogador a usar primeiro: 'obter' só
+    a lê, e ela é gravada na partição (e apagada do formato antigo) junto com as outras alterações.
+    Até lá, ela é listada (e pode ser lida e gravada) com a chave da guild GUILD_LEGADO.
+    """
+
+    def __init__(self, backend, diretorio, legado=None):
+        self.backend = backend
+        self.diretorio = diretorio
+        self.legado = legado # Backend com as fichas antigas, ou None
+        self._particoes = {} # guild_id -> backend aberto
+        # As partições já estão abertas quando os comandos da guild leem (ver preparar_guild)
+        self.leitura_em_memoria = backend == "json" and (legado is None or legado.leitura_em_memoria)
+        self._adotadas = {} # user_id no formato antigo -> chave da guild que o adotou, até a próxima gravação
+        # Criação de partições e gravações uma de cada vez (o journal não aceita duas escritas simultâneas)
+        self._trava = threading.RLock()
+
+    def _particao(self, guild_id):
+        particao = self._particoes.get(guild_id)
+        if particao is not None:
+            return particao
+        with self._trava:
+            if guild_id not in self._particoes:
+                os.makedirs(self.diretorio, exist_ok=True)
+                base = os.path.join(self.diretorio, str(guild_id))
+                if self.backend == "sqlite":
+                    particao = ArmazenamentoSQLite(base + ".db")
+                else:
+                    particao = ArmazenamentoJSON(base + ".json", base + ".journal")
+                particao.carregar()
+                self._particoes[guild_id] = particao
+            return self._particoes[guild_id]
+
+    def particao_aberta(self, guild_id):
+        return guild_id in self._particoes
+
+    def abrir_particao(self, guild_id):
+        """Abre a partição da guild (se ainda não estiver aberta) e retorna as mensagens de ficha dela."""
+        return [
+            (f"{guild_id}:{user_id}", channel_id, message_id)
+            for user_id, channel_id, message_id in self._particao(guild_id).listar_mensagens()
+        ]
+
+    def listar_guilds(self):
+        """Guilds deste processo com fichas em disco (ou com a partição já aberta)."""
+        guilds = set(self._particoes)
+        if os.path.isdir(self.diretorio):
+            for nome in os.listdir(self.diretorio):
+                base = nome.split(".", 1)[0]
+                if base.isdigit():
+                    guilds.add(int(base))
+        return sorted(guild_id for guild_id in guilds if guild_deste_processo(guild_id))
+
+    def carregar(self):
+        # As partições abertas são fechadas e relidas do disco no próximo acesso
+        self._fechar_particoes()
+        self._adotadas.clear()
+        return self.legado.carregar() if self.legado else 0
+
+    def obter(self, chave):
+        guild_id, user_id = separar_chave(chave)
+        if guild_id == GUILD_LEGADO:
+            return self.legado.obter(user_id) if self.legado else None
+        particao = self._particao(guild_id)
+        dados = particao.obter(user_id)
+        if dados is None and self.legado and self._adotadas.get(user_id, chave) == chave:
+            # Uma ficha antiga adotada por outra guild e ainda não gravada não é adotada de novo
+            dados = self.legado.obter(user_id)
+            if dados is not None:
+                self._adotadas[user_id] = chave
+        return dados
+
+    def adotada(self, chave):
+        return self._adotadas.get(separar_chave(chave)[1]) == chave
+
+    def listar_fichas(self, guild_id):
+        """Retorna (user_id, ficha) de todas as fichas guardadas na partição da guild."""
+        particao = self._particao(guild_id)
+        fichas = ((user_id, particao.obter(user_id)) for user_id in particao.listar_ids())
+        return [(user_id, dados) for user_id, dados in fichas if dados is not None]
+
+    def listar_ids(self, guild_id=None):
+        # Com 'guild_id', só as fichas dessa guild, sem abrir as partições das outras
+        guilds = self.listar_guilds() if guild_id is None else [guild_id]
+        ids = [
+            f"{guild}:{user_id}" for guild in guilds if guild != GUILD_LEGADO
+            for user_id in self._particao(guild).listar_ids()
+        ]
+        if self.legado and guild_id in (None, GUILD_LEGADO):
+            ids.extend(f"{GUILD_LEGADO}:{user_id}" for user_id in self.legado.listar_ids() if user_id not in self._adotadas)
+        return ids
+
+    def listar_mensagens(self):
+        mensagens = [mensagem for guild_id in list(self._particoes) for mensagem in self.abrir_particao(guild_id)]
+        if self.legado:
+            mensagens.extend(
+                (f"{GUILD_LEGADO}:{user_id}", channel_id, message_id)
+                for user_id, channel_id, message_id in self.legado.listar_mensagens()
+            )
+        return mensagens
+
+    def gravar(self, lote):
+        por_guild = {}
+        for chave, dados in lote.items():
+            guild_id, user_id = separar_chave(chave)
+            por_guild.setdefault(guild_id, {})[user_id] = dados
+        with self._trava:
+            antigas = por_guild.pop(GUILD_LEGADO, None)
+            if antigas and self.legado:
+                # Uma ficha antiga já adotada (ou sendo adotada) por uma guild não volta para o formato antigo
+                self.legado.gravar({
+                    user_id: dados for user_id, dados in antigas.items()
+                    if user_id not in self._adotadas and self.legado.obter(user_id) is not None
+                })
+            for guild_id, lote_guild in por_guild.items():
+                self._particao(guild_id).gravar(lote_guild)
+            # As fichas antigas adotadas já estão na partição: saem do formato antigo
+            adotadas = [separar_chave(chave)[1] for chave in lote if self.adotada(chave)]
+            if adotadas:
+                self.legado.gravar(dict.fromkeys(adotadas))
+                for user_id in adotadas:
+                    del self._adotadas[user_id]
+
+    def _fechar_particoes(self):
+        with self._trava:
+            for particao in self._particoes.values():
+                particao.fechar()
+            self._particoes = {}
+
+    def fechar(self):
+        self._fechar_particoes()
+        if self.legado:
+            self.legado.fechar()
+
+def criar_armazenamento(backend):
+    """
+    Cria o armazenamento das fichas por guild com o backend configurado em FICHAS_BACKEND.
+    As fichas antigas (FICHA_FILE ou FICHAS_DB) só são lidas se esses arquivos existirem. Com vários
+    processos, as do JSON só são adotadas pelo processo do shard 0, já que o journal não aceita dois escritores.
+    """
+    if backend not in ("json", "sqlite"):
+        raise ValueError(f"Backend de armazenamento desconhecido: {backend}")
+    legado = None
+    if backend == "sqlite" and os.path.exists(FICHAS_DB):
+        legado = ArmazenamentoSQLite(FICHAS_DB)
+    elif backend == "json" and guild_deste_processo(0) and (os.path.exists(FICHA_FILE) or os.path.exists(JOURNAL_FILE)):
+        legado = ArmazenamentoJSON(FICHA_FILE, JOURNAL_FILE)
+    return ArmazenamentoPorGuild(backend, FICHAS_DIR, legado)
+
+armazenamento = criar_armazenamento(FICHAS_BACKEND)
+
+class CacheFichas:
+    """
+    Fichas em memória, por ID de usuário, lidas do armazenamento no primeiro acesso.
+    Quando passa de 'limite', as fichas usadas há mais tempo saem da memória; as paradas há mais de
+    'ttl' segundos saem mesmo abaixo do limite. Fichas com gravação pendente ou com a trava do usuário
+    em uso ficam até a gravação terminar, guardadas à parte para não serem conferidas de novo a cada acesso.
+    """
+
+    def __init__(self, limite, ttl):
+        self.limite = limite
+        self.ttl = ttl
+        self.acertos = 0
+        self.falhas = 0
+        self.despejos = 0
+        self._fichas = OrderedDict() # user_id -> [ficha, último acesso], da usada há mais tempo para a mais recente
+        self._retidas = {} # Fichas que não podiam sair da memória no despejo; voltam à fila depois de uma gravação
+        self._leituras = {} # user_id -> futuro da leitura em andamento no armazenamento
+        self._a_ler = [] # Leituras pedidas que ainda não foram para a thread
+        self._tarefa_leitura = None
+
+    def obter(self, user_id):
+        """Retorna a ficha de 'user_id', lendo do armazenamento se preciso, ou None se ela não existir."""
+        entrada = self._fichas.get(user_id)
+        if entrada is None:
+            entrada = self._retidas.pop(user_id, None)
+            if entrada is not None:
+                self._fichas[user_id] = entrada
+        if entrada is not None:
+            self.acertos += 1
+            entrada[1] = time.monotonic()
+            self._fichas.move_to_end(user_id)
+            self._despejar()
+            return entrada[0]
+        self.falhas += 1
+        # Uma gravação pendente é mais nova que o que está no armazenamento
+        conhecida, ficha = persistencia.consultar(user_id)
+        if not conhecida:
+            return self._guardar_lida(user_id, armazenamento.obter(user_id))
+        if ficha is not None:
+            self._guardar(user_id, ficha)
+        return ficha
+
+    def _guardar_lida(self, user_id, dados):
+        """Põe no cache uma ficha lida do armazenamento e a retorna (None se ela não existe)."""
+        if dados is None:
+            return None
+        ficha = Ficha.de_dict(dados)
+        self._guardar(user_id, ficha)
+        if armazenamento.adotada(user_id):
+            # Uma ficha do formato antigo vai para a partição da guild na próxima gravação e deixa de ser
+            # listada com a chave de GUILD_LEGADO
+            chave_antiga = f"{GUILD_LEGADO}:{separar_chave(user_id)[1]}"
+            indice_mensagens.registrar(chave_antiga, None, None)
+            self.apagar(chave_antiga)
+            salvar_dados(user_id, ficha)
+        return ficha
+
+    def _em_memoria(self, user_id):
+        return user_id in self._fichas or user_id in self._retidas or persistencia.consultar(user_id)[0]
+
+    async def obter_sem_bloquear(self, user_id):
+        """
+        Como obter, mas uma ficha que não está em memória é lida do armazenamento em uma thread separada
+        (no SQLite, a leitura espera a gravação em andamento). É a forma usada pelos comandos.
+        """
+        if self._em_memoria(user_id) or armazenamento.leitura_em_memoria:
+            return self.obter(user_id)
+        dados = await self._ler(user_id)
+        # Enquanto a ficha era lida, outro comando pode tê-la posto em memória, alterado ou apagado
+        if self._em_memoria(user_id):
+            return self.obter(user_id)
+        self.falhas += 1
+        return self._guardar_lida(user_id, dados)
+
+    async def _ler(self, user_id):
+        """Lê uma ficha do armazenamento; leituras pedidas ao mesmo tempo vão juntas, em uma única ida à thread."""
+        futuro = self._leituras.get(user_id)
+        if futuro is None:
+            futuro = self._leituras[user_id] = asyncio.get_running_loop().create_future()
+            self._a_ler.append(user_id)
+            if self._tarefa_leitura is None or self._tarefa_leitura.done():
+                self._tarefa_leitura = asyncio.create_task(self._ler_pedidas())
+        return await asyncio.shield(futuro)
+
+    async def _ler_pedidas(self):
+        while self._a_ler:
+            lote, self._a_ler = self._a_ler, []
+            try:
+                lidas = await asyncio.to_thread(lambda: [armazenamento.obter(user_id) for user_id in lote])
+            except Exception as e:
+                lidas = [e] * len(lote)
+            for user_id, dados in zip(lote, lidas):
+                futuro = self._leituras.pop(user_id)
+                if isinstance(dados, Exception):
+                    futuro.set_exception(dados)
+                else:
+                    futuro.set_result(dados)
+
+    async def carregar_varias(self, user_ids):
+        """
+        Lê de uma vez, em uma thread separada, as fichas de 'user_ids' que não estão em memória, para as
+        passadas por muitas fichas. Retorna, na mesma ordem, os IDs das fichas que existem.
+        """
+        faltando = [user_id for user_id in user_ids if not self._em_memoria(user_id)]
+        if armazenamento.leitura_em_memoria:
+            lidas = [armazenamento.obter(user_id) for user_id in faltando]
+        else:
+            lidas = await asyncio.to_thread(lambda: [armazenamento.obter(user_id) for user_id in faltando]) if faltando else []
+        for user_id, dados in zip(faltando, lidas):
+            if dados is not None and not self._em_memoria(user_id):
+                self.falhas += 1
+                self._guardar_lida(user_id, dados)
+        existentes = []
+        for user_id in user_ids:
+            entrada = self._fichas.get(user_id) or self._retidas.get(user_id)
+            if entrada is not None or persistencia.consultar(user_id)[1] is not None:
+                existentes.append(user_id)
+        return existentes
+
+    def criar(self, user_id, ficha):
+        """Coloca uma ficha nova no cache (ela vai para o armazenamento por 'salvar_dados')."""
+        self._guardar(user_id, ficha)
+
+    def apagar(self, user_id):
+        self._fichas.pop(user_id, None)
+        self._retidas.pop(user_id, None)
+        _fichas_renderizadas.pop(user_id, None)
+
+    def listar_ids(self, guild_id=None):
+        """
+        IDs de todas as fichas existentes, em memória, pendentes de gravação ou só no armazenamento.
+        Com 'guild_id', só as fichas dessa guild. Lê o armazenamento aqui mesmo: no loop do bot, use
+        listar_ids_sem_bloquear.
+        """
+        return self._juntar_ids(armazenamento.listar_ids(guild_id), *self._ids_em_memoria(guild_id))
+
+    async def listar_ids_sem_bloquear(self, guild_id=None):
+        """Como listar_ids, mas lê o armazenamento em uma thread separada."""
+        # O cache e as gravações pendentes mudam a cada comando: são copiados aqui, no loop, e só a
+        # listagem do armazenamento vai para a thread
+        em_memoria, pendentes = self._ids_em_memoria(guild_id)
+        armazenados = await asyncio.to_thread(armazenamento.listar_ids, guild_id)
+        return self._juntar_ids(armazenados, em_memoria, pendentes)
+
+    def _ids_em_memoria(self, guild_id):
+        """IDs das fichas em memória e as gravações pendentes, {user_id: False se a ficha foi apagada}."""
+        prefixo = "" if guild_id is None else f"{guild_id}:"
+        em_memoria = {user_id for user_id in itertools.chain(self._fichas, self._retidas) if user_id.startswith(prefixo)}
+        pendentes = {
+            user_id: ficha is not None
+            for lote in (persistencia.em_gravacao, persistencia.pendentes) # As pendentes são as mais novas
+            for user_id, ficha in lote.items() if user_id.startswith(prefixo)
+        }
+        return em_memoria, pendentes
+
+    @staticmethod
+    def _juntar_ids(armazenados, em_memoria, pendentes):
+        ids = set(armazenados) | em_memoria
+        for user_id, existe in pendentes.items():
+            if existe:
+                ids.add(user_id)
+            else:
+                ids.discard(user_id)
+        return ids
+
+    def limpar(self):
+        self._fichas.clear()
+        self._retidas.clear()
+
+    def __len__(self):
+        return len(self._fichas) + len(self._retidas)
+
+    def _guardar(self, user_id, ficha):
+        self._fichas[user_id] = [ficha, time.monotonic()]
+        self._fichas.move_to_end(user_id)
+        self._despejar()
+
+    def _despejar(self):
+        """Tira da memória as fichas expiradas e, se passar do limite, as usadas há mais tempo."""
+        excesso = len(self) - self.limite
+        expiracao = time.monotonic() - self.ttl
+        despejar = []
+        reter = []
+        for user_id, (_, acesso) in self._fichas.items():
+            if excesso <= 0 and acesso > expiracao:
+                break
+            if persistencia.consultar(user_id)[0] or travas_usuarios.em_uso(user_id):
+                reter.append(user_id) # Ainda vai ser gravada ou está sendo alterada agora
+                continue
+            despejar.append(user_id)
+            excesso -= 1
+        for user_id in despejar:
+            del self._fichas[user_id]
+            _fichas_renderizadas.pop(user_id, None)
+        # Sem isso, uma passada que altera milhares de fichas reconferiria todas as pendentes a cada acesso
+        for user_id in reter:
+            self._retidas[user_id] = self._fichas.pop(user_id)
+        self.despejos += len(despejar)
+
+    def devolver_retidas(self):
+        """Devolve à fila de despejo as fichas retidas que já foram gravadas e não estão mais travadas."""
+        liberadas = [
+            user_id for user_id in self._retidas
+            if not (persistencia.consultar(user_id)[0] or travas_usuarios.em_uso(user_id))
+        ]
+        for user_id in liberadas:
+            self._fichas[user_id] = self._retidas.pop(user_id)
+        if liberadas:
+            self._despejar()
+
+    def resumo(self):
+        return (
+            f"Cache: {len(self)} fichas em memória, {self.acertos} acertos, "
+            f"{self.falhas} falhas, {self.despejos} despejos."
+        )
+
+class PersistenciaAssincrona:
+    """
+    Grava as fichas alteradas sem travar o loop do bot.
+    Alterações feitas dentro de uma mesma janela viram uma única escrita, feita em uma thread separada.
+    """
+
+    def __init__(self, janela):
+        self.janela = janela
+        self.pendentes = {} # user_id -> ficha a gravar (None se a ficha foi apagada)
+        self.em_gravacao = {} # Lote que está sendo gravado neste momento
+        self.escritas_solicitadas = 0
+        self.escritas_realizadas = 0
+        self.falhas_seguidas = 0 # Gravações que falharam desde a última que deu certo
+        self._tarefa = None
+        self._trava = asyncio.Lock()
+
+    def marcar(self, user_id, ficha):
+        """Marca a ficha de 'user_id' como alterada (None se foi apagada) e agenda a escrita para o fim da janela."""
+        self.pendentes[user_id] = ficha
+        self.escritas_solicitadas += 1
+        self._agendar(self.janela)
+
+    def _agendar(self, espera):
+        """Agenda uma escrita para daqui a 'espera' segundos, se nenhuma outra já está agendada."""
+        if self._tarefa is None or self._tarefa.done() or self._tarefa is asyncio.current_task():
+            self._tarefa = asyncio.create_task(self._descarregar_apos_janela(espera))
+
+    def consultar(self, user_id):
+        """
+        Retorna (True, ficha) se há uma gravação pendente para 'user_id' (ficha None = apagada),
+        ou (False, None) se o armazenamento já está em dia para esse usuário.
+        """
+        for lote in (self.pendentes, self.em_gravacao):
+            if user_id in lote:
+                return True, lote[user_id]
+        return False, None
+
+    async def _descarregar_apos_janela(self, espera):
+        await asyncio.sleep(espera)
+        await self.descarregar()
+
+    async def descarregar(self):
+        """Grava imediatamente todas as alterações pendentes."""
+        async with self._trava:
+            if not self.pendentes:
+                return
+            lote, self.pendentes = self.pendentes, {}
+            self.em_gravacao = lote
+            # Serializa aqui, no loop, para gravar o estado exato do momento (as fichas continuam mudando)
+            serializado = {
+                user_id: json.dumps(ficha.para_dict(), separators=(",", ":")) if ficha is not None else None
+                for user_id, ficha in lote.items()
+            }
+            if metricas.ativo:
+                metricas.observar("gravacao_bytes", sum(len(dados) for dados in serializado.values() if dados), baldes=BALDES_BYTES)
+                metricas.observar("gravacao_fichas", len(serializado), baldes=(1, 5, 10, 50, 100, 500, 1000, 5000))
+            try:
+                with metricas.cronometro("gravacao_segundos"):
+                    await asyncio.to_thread(armazenamento.gravar, serializado)
+            except (OSError, sqlite3.Error) as e:
+                # Devolve o lote e tenta de novo mais tarde, sem passar por cima de alterações mais novas
+                self.falhas_seguidas += 1
+                espera = min(self.janela * 2 ** self.falhas_seguidas, ESPERA_MAXIMA_GRAVACAO)
+                print(f"Erro ao gravar as fichas: {e}. Nova tentativa em {espera:.1f}s.")
+                metricas.contar("erros_total", origem="gravacao")
+                self.pendentes = {**lote, **self.pendentes}
+                self._agendar(espera)
+                return
+            finally:
+                self.em_gravacao = {}
+            self.falhas_seguidas = 0
+            self.escritas_realizadas += 1
+            cache_fichas.devolver_retidas()
+            if self.pendentes:
+                # Alterações feitas durante a escrita, quando a escrita já estava agendada
+                self._agendar(self.janela)
+
+    def resumo(self):
+        """Texto com quantas gravações foram pedidas e quantas escritas em disco foram feitas de fato."""
+        proporcao = self.escritas_solicitadas / self.escritas_realizadas if self.escritas_realizadas else 0
+        return (
+            f"Persistência: {self.escritas_solicitadas} gravações solicitadas, "
+            f"{self.escritas_realizadas} escritas realizadas ({proporcao:.1f} por escrita)."
+        )
+
+class IndiceMensagensFicha:
+    """
+    Onde está a mensagem de cada ficha, agrupado por canal (channel_id -> {message_id: user_id}).
+    Montado a partir do armazenamento ao carregar e mantido em dia a cada salvar_dados, permite
+    conferir as mensagens de um canal inteiro de uma vez, sem ler as fichas uma por uma.
+    """
+
+    def __init__(self):
+        self.por_canal = {}
+        self.por_usuario = {} # user_id -> (channel_id, message_id)
+
+    def reconstruir(self, mensagens):
+        """Recria o índice a partir de (user_id, channel_id, message_id)."""
+        self.por_canal = {}
+        self.por_usuario = {}
+        for user_id, channel_id, message_id in mensagens:
+            self.registrar(user_id, channel_id, message_id)
+
+    def registrar(self, user_id, channel_id, message_id):
+        """Atualiza a mensagem de 'user_id' (channel_id/message_id None = ficha sem mensagem ou apagada)."""
+        anterior = self.por_usuario.get(user_id)
+        if anterior == (channel_id, message_id):
+            return
+        if anterior:
+            mensagens = self.por_canal[anterior[0]]
+            del mensagens[anterior[1]]
+            if not mensagens:
+                del self.por_canal[anterior[0]]
+            del self.por_usuario[user_id]
+        if channel_id and message_id:
+            self.por_canal.setdefault(channel_id, {})[message_id] = user_id
+            self.por_usuario[user_id] = (channel_id, message_id)
+
+    def resumo(self):
+        return f"Índice de mensagens: {len(self.por_usuario)} fichas com mensagem em {len(self.por_canal)} canais."
+
+indice_mensagens = IndiceMensagensFicha()
+
+persistencia = PersistenciaAssincrona(JANELA_SALVAMENTO)
+
+cache_fichas = CacheFichas(LIMITE_CACHE_FICHAS, TTL_CACHE_FICHAS)
+
+def salvar_dados(user_id, user):
+    """Marca a ficha de 'user_id' para ser gravada; user=None grava a remoção da ficha."""
+    if user is None:
+        indice_mensagens.registrar(user_id, None, None)
+    else:
+        indice_mensagens.registrar(user_id, user.ficha_channel_id, user.ficha_message_id)
+    ranking_fichas.atualizar(user_id, user)
+    persistencia.marcar(user_id, user)
+
+def carregar_dados():
+    """
+    Prepara o armazenamento; as fichas de cada guild são lidas para o cache conforme os comandos as usam.
+    Retorna quantas fichas foram lidas agora (as do formato antigo, sem guild).
+    """
+    quantidade = armazenamento.carregar()
+    cache_fichas.limpar()
+    indice_mensagens.reconstruir(armazenamento.listar_mensagens())
+    ranking_fichas.limpar()
+    _guilds_preparadas.clear() # As fichas de cada guild são abertas no primeiro comando dela
+    return quantidade
+
+def migrar_para_sqlite(origem, journal, destino):
+    """Copia todas as fichas de um snapshot JSON (com o seu journal) para um banco SQLite."""
+    inicio = time.perf_counter()
+    fichas = ArmazenamentoJSON(origem, journal)
+    quantidade = fichas.carregar()
+    banco = ArmazenamentoSQLite(destino)
+    banco.gravar({user_id: json.dumps(fichas.obter(user_id), separators=(",", ":")) for user_id in fichas.listar_ids()})
+    banco.fechar()
+    print(f"{quantidade} fichas migradas de {origem} para {destino} em {time.perf_counter() - inicio:.2f}s.")
+
+# --- Registro de Eventos ---
+# Cada alteração de ficha feita por um comando vira um evento (quando, quem, qual comando e a ficha antes e
+# depois), posto em uma fila em memória sem esperar pelo disco. Os eventos são gravados em lotes, cada lote
+# um bloco gzip próprio no fim do arquivo atual de EVENTOS_DIR, e um índice SQLite guarda o arquivo e o bloco
+# dos eventos de cada ficha: o !historico e a reconstrução leem só os blocos de que precisam.
+# O status recalculado pelo !recalcular e as IDs das mensagens de ficha não viram eventos.
+
+def _ler_bloco_eventos(caminho, deslocamento):
+    """Lê os eventos do bloco gzip que começa em 'deslocamento' no arquivo."""
+    descompressor = zlib.decompressobj(wbits=31) # Formato gzip; para no fim do bloco, sem ler os seguintes
+    partes = []
+    with open(caminho, "rb") as f:
+        f.seek(deslocamento)
+        while not descompressor.eof:
+            pedaco = f.read(64 * 1024)
+            if not pedaco:
+                break
+            partes.append(descompressor.decompress(pedaco))
+    return [json.loads(linha) for linha in b"".join(partes).splitlines()]
+
+class RegistroEventos:
+    """
+    Fila dos eventos de alteração das fichas e a gravação dela em lotes, em uma thread separada.
+    Eventos registrados dentro de uma mesma janela viram um único bloco no arquivo.
+    """
+
+    def __init__(self, diretorio, janela, limite_bytes):
+        self.diretorio = diretorio
+        self.janela = janela
+        self.limite_bytes = limite_bytes
+        self.fila = asyncio.Queue()
+        self.registrados = 0
+        self.gravados = 0
+        self.blocos = 0
+        self._nao_gravados = [] # Lote de uma gravação que falhou, gravado junto com o próximo
+        self._arquivo = None
+        self._tamanho_arquivo = 0
+        self._arquivos_criados = 0
+        self._indice = None
+        self._trava_indice = threading.Lock() # O índice é usado pela thread de gravação e pelas consultas
+        self._tarefa = None
+        self._trava = asyncio.Lock()
+
+    def registrar(self, evento):
+        """Põe o evento na fila e agenda a gravação para o fim da janela."""
+        self.fila.put_nowait(evento)
+        self.registrados += 1
+        if self._tarefa is None or self._tarefa.done():
+            self._tarefa = asyncio.create_task(self._descarregar_apos_janela())
+
+    async def _descarregar_apos_janela(self):
+        # Eventos registrados durante uma gravação não agendam outra tarefa: esta continua até a fila esvaziar
+        while not self.fila.empty():
+            await asyncio.sleep(self.janela)
+            await self.descarregar()
+
+    async def descarregar(self):
+        """Grava imediatamente todos os eventos da fila."""
+        async with self._trava:
+            lote, self._nao_gravados = self._nao_gravados, []
+            while not self.fila.empty():
+                lote.append(self.fila.get_nowait())
+            if not lote:
+                return
+            try:
+                with metricas.cronometro("eventos_gravacao_segundos"):
+                    await asyncio.to_thread(self._gravar, lote)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Erro ao gravar o registro de eventos: {e}")
+                metricas.contar("erros_total", origem="eventos")
+                self._nao_gravados = lote
+                return
+            self.gravados += len(lote)
+            self.blocos += 1
+
+    def _abrir_indice(self):
+        if self._indice is None:
+            os.makedirs(self.diretorio, exist_ok=True)
+            self._indice = sqlite3.connect(os.path.join(self.diretorio, "indice.db"), check_same_thread=False)
+            self._indice.execute("PRAGMA journal_mode=WAL")
+            self._indice.execute(
+                "CREATE TABLE IF NOT EXISTS eventos (chave TEXT NOT NULL, ts REAL NOT NULL, arquivo TEXT NOT NULL, deslocamento INTEGER NOT NULL)"
+            )
+            self._indice.execute("CREATE INDEX IF NOT EXISTS eventos_por_chave ON eventos (chave, ts)")
+            self._indice.execute("CREATE INDEX IF NOT EXISTS eventos_por_ts ON eventos (ts)")
+            self._indice.commit()
+        return self._indice
+
+    def _gravar(self, lote):
+        """Grava o lote como um bloco gzip no fim do arquivo atual e o registra no índice."""
+        bloco = gzip.compress("".join(json.dumps(evento, separators=(",", ":")) + "\n" for evento in lote).encode())
+        with self._trava_indice:
+            indice = self._abrir_indice()
+            if self._arquivo is None or self._tamanho_arquivo >= self.limite_bytes:
+                # Nome único mesmo com vários processos (shards) gravando na mesma pasta
+                self._arquivos_criados += 1
+                self._arquivo = f"eventos-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._arquivos_criados}.ndjson.gz"
+                self._tamanho_arquivo = 0
+            with open(os.path.join(self.diretorio, self._arquivo), "ab") as f:
+                deslocamento = f.tell()
+                try:
+                    indice.executemany(
+                        "INSERT INTO eventos (chave, ts, arquivo, deslocamento) VALUES (?, ?, ?, ?)",
+                        [(evento["chave"], evento["ts"], self._arquivo, deslocamento) for evento in lote],
+                    )
+                    f.write(bloco)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    indice.commit()
+                except BaseException:
+                    # Nem meio bloco no arquivo nem entradas no índice apontando para ele
+                    indice.rollback()
+                    f.truncate(deslocamento)
+                    raise
+            self._tamanho_arquivo = deslocamento + len(bloco)
+
+    def _ler_blocos(self, blocos):
+        """Eventos dos blocos (arquivo, deslocamento) indicados, lendo cada bloco uma única vez."""
+        eventos = []
+        for arquivo, deslocamento in sorted(set(blocos)):
+            eventos.extend(_ler_bloco_eventos(os.path.join(self.diretorio, arquivo), deslocamento))
+        return eventos
+
+    def historico(self, chave, quantidade):
+        """Os últimos 'quantidade' eventos da ficha 'chave', do mais novo para o mais antigo."""
+        if not os.path.exists(os.path.join(self.diretorio, "indice.db")):
+            return []
+        with self._trava_indice:
+            blocos = self._abrir_indice().execute(
+                "SELECT arquivo, deslocamento FROM eventos WHERE chave = ? ORDER BY ts DESC LIMIT ?", (chave, quantidade)
+            ).fetchall()
+        eventos = [evento for evento in self._ler_blocos(blocos) if evento["chave"] == chave]
+        eventos.sort(key=operator.itemgetter("ts"), reverse=True)
+        return eventos[:quantidade]
+
+    def eventos_entre(self, inicio, fim):
+        """Eventos com inicio < ts <= fim, na ordem em que aconteceram."""
+        if not os.path.exists(os.path.join(self.diretorio, "indice.db")):
+            return []
+        with self._trava_indice:
+            blocos = self._abrir_indice().execute(
+                "SELECT DISTINCT arquivo, deslocamento FROM eventos WHERE ts > ? AND ts <= ?", (inicio, fim)
+            ).fetchall()
+        eventos = [evento for evento in self._ler_blocos(blocos) if inicio < evento["ts"] <= fim]
+        eventos.sort(key=operator.itemgetter("ts"))
+        return eventos
+
+    def fechar(self):
+        with self._trava_indice:
+            if self._indice is not None:
+                self._indice.close()
+                self._indice = None
+
+    def resumo(self):
+        return (
+            f"Eventos: {self.registrados} registrados, {self.gravados} gravados em {self.blocos} blocos, "
+            f"{self.fila.qsize() + len(self._nao_gravados)} na fila."
+        )
+
+registro_eventos = RegistroEventos(EVENTOS_DIR, JANELA_EVENTOS, EVENTOS_LIMITE_BYTES)
+
+def registrar_evento(ctx, acao, user_id, antes, depois, **detalhes):
+    """
+    Registra uma alteração da ficha 'user_id' feita pelo comando 'acao' de ctx.author. 'antes' e 'depois'
+    são a ficha (no formato de para_dict) antes e depois da alteração, None se ela não existia ou foi apagada.
+    'detalhes' são os argumentos do comando, mostrados no !historico.
+    """
+    registro_eventos.registrar({
+        "ts": time.time(),
+        "chave": user_id,
+        "acao": acao,
+        "autor": ctx.author.id,
+        "detalhes": detalhes,
+        "antes": antes,
+        "depois": depois,
+    })
+
+def reconstruir_fichas(ate, snapshot, saida):
+    """
+    Reconstrói as fichas como estavam no instante 'ate' (timestamp) e as grava em 'saida' no formato
+    {"ate": ts, "fichas": {chave: ficha}}, que também serve de snapshot para outra reconstrução.
+    Parte do 'snapshot' (ou, sem ele, das fichas atuais do armazenamento) e aplica os eventos registrados
+    entre os dois instantes: para frente com a ficha depois de cada evento, para trás com a ficha antes.
+    """
+    inicio = time.perf_counter()
+    if snapshot:
+        with open(snapshot, "r") as f:
+            dados = json.load(f)
+        base, fichas = dados["ate"], dados["fichas"]
+    else:
+        base = time.time()
+        armazenamento.carregar()
+        fichas = {chave: armazenamento.obter(chave) for chave in armazenamento.listar_ids()}
+        armazenamento.fechar()
+    if ate >= base:
+        eventos, estado = registro_eventos.eventos_entre(base, ate), "depois"
+    else:
+        eventos, estado = registro_eventos.eventos_entre(ate, base)[::-1], "antes"
+    registro_eventos.fechar()
+    for evento in eventos:
+        if evento[estado] is None:
+            fichas.pop(evento["chave"], None)
+        else:
+            fichas[evento["chave"]] = evento[estado]
+    _escrever_atomico(saida, json.dumps({"ate": ate, "fichas": fichas}, separators=(",", ":")))
+    print(
+        f"{len(fichas)} fichas reconstruídas em {datetime.datetime.fromtimestamp(ate):%d/%m/%Y %H:%M:%S} "
+        f"({len(eventos)} eventos aplicados) em {time.perf_counter() - inicio:.2f}s, salvas em {saida}."
+    )
+
+# --- Funções de Cálculo e Atualização ---
+def calcular_locomocao(vel, bonus_locomocao):
+    """
+    Calcula o valor da locomoção.
+    Locomoção começa com 4 e é sempre influenciada pela VEL.
+    """
+    return 4 + (vel // 10) + bonus_locomocao
+
+def calcular_pr(res, bonus_pr):
+    """Calcula os Pontos de Resistência (PR)."""
+    return (20 + (res // 15)) + bonus_pr
+
+def calcular_kritos(mag_status, bonus_kritos):
+    """Calcula o valor de Kritos."""
+    # Kritos agora usa a MAG do status, não os pontos gastos, para refletir bônus etc.
+    return (40 + (mag_status * 2)) + bonus_kritos 
+
+
+def _compilar_conversao():
+    """
+    Compila 'conversao_pontos' em termos (origem, destino, multiplicador, divisor), com as posições dos
+    atributos em 'atributos_validos', e, se houver NumPy, em uma matriz origem x destino por divisor.
+    """
+    termos = []
+    for origem, destinos in conversao_pontos.items():
+        for destino, coeficiente in destinos.items():
+            multiplicador, divisor = coeficiente if isinstance(coeficiente, tuple) else (coeficiente, 1)
+            termos.append((atributos_validos.index(origem), atributos_validos.index(destino), multiplicador, divisor))
+
+    matrizes = []
+    if np is not None:
+        for divisor in sorted({termo[3] for termo in termos}):
+            matriz = np.zeros((len(atributos_validos), len(atributos_validos)), dtype=np.int64)
+            for origem, destino, multiplicador, d in termos:
+                if d == divisor:
+                    matriz[origem, destino] += multiplicador
+            matrizes.append((divisor, matriz))
+    return termos, matrizes
+
+_termos_conversao, _matrizes_conversao = _compilar_conversao()
+
+# Limite de cada atributo (na ordem de 'atributos_validos') indexado pelo número do rank
+_limites_por_rank = [
+    [atributos_com_limite[attr].get(nomes_rank.get(numero), 0) for numero in range(max(rank_limits.values()) + 1)]
+    for attr in atributos_validos
+]
+
+def calcular_status(pts_gastos, bonus, ranks, limitar=True):
+    """
+    Calcula o status (lista na ordem de 'atributos_validos') a partir dos arrays da Ficha, usando 'conversao_pontos'.
+    Com limitar=False não aplica os limites de rank (usado para simular uma alteração antes de aplicá-la).
+    """
+    status = list(bonus[:len(atributos_validos)])
+    for origem, destino, multiplicador, divisor in _termos_conversao:
+        status[destino] += (pts_gastos[origem] // divisor) * multiplicador
+
+    if limitar:
+        for i, limites in enumerate(_limites_por_rank):
+            limite = limites[ranks[i]]
+            if status[i] > limite:
+                status[i] = limite
+    return status
+
+def atualizar_status(user):
+    """
+    Atualiza os atributos calculados do usuário com base nos pontos gastos
+    e bônus. Aplica os limites de rank.
+    """
+    user.status[:] = array("i", calcular_status(user.pts_gastos, user.bonus, user.ranks))
+
+def recalcular_status_em_lote(fichas_por_id):
+    """
+    Recalcula o status de várias fichas {user_id: ficha} de uma vez (ex: depois de mudar
+    'atributos_com_limite'). Usa NumPy quando disponível. Retorna os IDs das fichas cujo status mudou.
+    """
+    fichas = list(fichas_por_id.values())
+    if not fichas:
+        return []
+    if np is None:
+        novos = [calcular_status(user.pts_gastos, user.bonus, user.ranks) for user in fichas]
+    else:
+        n, colunas = len(fichas), len(atributos_validos)
+        # Os arrays das fichas viram matrizes direto dos seus bytes, sem passar por listas
+        pts = np.frombuffer(b"".join(user.pts_gastos.tobytes() for user in fichas), dtype=np.int32).reshape(n, colunas)
+        bonus = np.frombuffer(b"".join(user.bonus.tobytes() for user in fichas), dtype=np.int32).reshape(n, -1)
+        ranks = np.frombuffer(b"".join(bytes(user.ranks) for user in fichas), dtype=np.uint8).reshape(n, colunas)
+        status = bonus[:, :colunas].astype(np.int64)
+        for divisor, matriz in _matrizes_conversao:
+            status += (pts.astype(np.int64) // divisor) @ matriz
+        limites = np.asarray(_limites_por_rank, dtype=np.int64)[np.arange(colunas), ranks]
+        np.minimum(status, limites, out=status)
+        novos = status.tolist()
+
+    alteradas = []
+    for user_id, user, novo in zip(fichas_por_id, fichas, novos):
+        if list(user.status) != novo:
+            alteradas.append(user_id)
+            user.status[:] = array("i", novo)
+    return alteradas
+
+# Rótulo de cada atributo na seção Status de Combate (nesta ordem); os demais ficam em Atributos Base
+rotulos_combate = {"HP": "Vitalidade (HP)", "DEF": "Defesa (DEF)", "DMG": "Dano (DMG)"}
+
+def _compilar_secao(atributos, rotulos):
+    """
+    Compila uma seção de atributos em um modelo de str.format com os rótulos já fixos, que só recebe as
+    tuplas (ranks, status, gastos) da seção, e em um itemgetter que tira essas tuplas dos arrays da Ficha.
+    Os campos do modelo são posicionais: primeiro os ranks, depois os status e por fim os gastos.
+    """
+    n = len(atributos)
+    modelo = "".join(
+        "• " + rotulos.get(attr, attr).replace("{", "{{").replace("}", "}}")
+        + f" ({{{i}}}): {{{n + i}}} [Gastos: {{{2 * n + i}}}]\n"
+        for i, attr in enumerate(atributos)
+    )
+    def preencher(r, s, g):
+        return modelo.format(*map(nomes_rank.__getitem__, r), *s, *g)
+    return preencher, operator.itemgetter(*(indice_atributo[attr] for attr in atributos))
+
+# Layout das seções de atributos montado uma vez; cada renderização só preenche os números
+_secao_base = _compilar_secao([attr for attr in atributos_validos if attr not in rotulos_combate], {})
+_secao_combate = _compilar_secao(list(rotulos_combate), rotulos_combate)
+
+@functools.lru_cache(maxsize=LIMITE_SECOES_RENDERIZADAS)
+def _texto_secao(preencher, ranks, status, pts_gastos):
+    return preencher(ranks, status, pts_gastos)
+
+@functools.lru_cache(maxsize=LIMITE_SECOES_RENDERIZADAS)
+def _texto_derivados(mag, bonus_kritos, res, bonus_pr, vel, bonus_locomocao):
+    # Calcula os status derivados (Locomoção, PR, Kritos)
+    return (
+        f"• Kritos: {calcular_kritos(mag, bonus_kritos)}\n"
+        f"• Pontos de Resistência (PR): {calcular_pr(res, bonus_pr)}\n"
+        f"• Locomoção: {calcular_locomocao(vel, bonus_locomocao)} metros\n"
+    )
+
+# Posições, nos arrays da Ficha, do status e do bônus usados por cada status derivado
+_I_MAG, _I_KRITOS, _I_RES, _I_PR, _I_VEL, _I_LOCOMOCAO = (
+    indice_atributo[attr] for attr in ("MAG", "KRITOS", "RES", "PR", "VEL", "LOCOMOCAO")
+)
+
+def _secoes_ficha(user):
+    """Textos das seções Pontos, Atributos Base, Status de Combate e Status Derivados da ficha."""
+    status, bonus, ranks, pts_gastos = user.status, user.bonus, user.ranks, user.pts_gastos
+    (preencher_base, valores_base), (preencher_combate, valores_combate) = _secao_base, _secao_combate
+    return (
+        f"```\nPontos Livres: {user.pontos}\nPontos Gastos: {sum(pts_gastos)}\n```\n",
+        _texto_secao(preencher_base, valores_base(ranks), valores_base(status), valores_base(pts_gastos)),
+        _texto_secao(preencher_combate, valores_combate(ranks), valores_combate(status), valores_combate(pts_gastos)),
+        _texto_derivados(
+            status[_I_MAG], bonus[_I_KRITOS], status[_I_RES], bonus[_I_PR], status[_I_VEL], bonus[_I_LOCOMOCAO]
+        ),
+    )
+
+def renderizar_ficha(user_id, user):
+    """
+    Monta o texto da mensagem da ficha do usuário.
+    Inclui a menção do dono da ficha no início e separa os status.
+    """
+    pontos, base, combate, derivados = _secoes_ficha(user)
+    return (
+        f"<@{user_id}>\n"
+        "# :bar_chart: Ficha de Atributos\n\n"
+        f"{pontos}"
+        "## :muscle: Atributos Base\n"
+        f"```\n{base}```\n"
+        "## :crossed_swords: Status de Combate\n"
+        f"```\n{combate}```\n"
+        "## :brain: Status Derivados\n"
+        f"```\n{derivados}```\n"
+    )
+
+def renderizar_ficha_embed(user_id, user):
+    """Mesma ficha de 'renderizar_ficha' em forma de embed (a menção vai no texto da mensagem)."""
+    pontos, base, combate, derivados = _secoes_ficha(user)
+    embed = discord.Embed(title="📊 Ficha de Atributos", description=pontos)
+    embed.add_field(name="💪 Atributos Base", value=f"```\n{base}```", inline=False)
+    embed.add_field(name="⚔️ Status de Combate", value=f"```\n{combate}```", inline=False)
+    embed.add_field(name="🧠 Status Derivados", value=f"```\n{derivados}```", inline=False)
+    return embed, hash((pontos, base, combate, derivados))
+
+def conteudo_ficha(user_id, user):
+    """
+    Argumentos de send/edit da mensagem da ficha no formato FICHA_FORMATO, e um hash do que é visível
+    (para não editar a mensagem quando nada mudou).
+    """
+    _, dono_id = separar_chave(user_id)
+    if FICHA_FORMATO == "embed":
+        embed, hash_ficha = renderizar_ficha_embed(dono_id, user)
+        return {"content": f"<@{dono_id}>", "embed": embed}, hash_ficha
+    texto = renderizar_ficha(dono_id, user)
+    return {"content": texto, "embed": None}, hash(texto)
+
+# Última versão enviada da mensagem da ficha de cada usuário: user_id -> (hash do texto, mensagem).
+# Evita editar a mensagem quando nada visível mudou e dispensa buscá-la antes de editar.
+_fichas_renderizadas = {}
+
+def _esquecer_mensagem_ficha(user_id, user):
+    """Zera as IDs da mensagem da ficha para que uma nova seja enviada no próximo comando."""
+    user.ficha_channel_id = None
+    user.ficha_message_id = None
+    _fichas_renderizadas.pop(user_id, None)
+
+def _com_confirmacoes(conteudo, confirmacoes):
+    """Põe as últimas confirmações de comandos no topo do conteúdo da mensagem da ficha."""
+    linhas = confirmacoes[-CONFIRMACOES_NA_FICHA:]
+    if len(confirmacoes) > len(linhas):
+        linhas.insert(0, f"*(+{len(confirmacoes) - len(linhas)} alterações anteriores)*")
+    return {**conteudo, "content": "\n".join(linhas) + "\n" + conteudo["content"]}
+
+def _enviar_confirmacoes(confirmacoes):
+    """Envia, uma mensagem por canal e com prioridade baixa, as confirmações que não couberam na ficha."""
+    por_canal = {}
+    for ctx, texto in confirmacoes:
+        por_canal.setdefault(ctx.channel.id, (ctx, []))[1].append(texto)
+    for channel_id, (ctx, textos) in por_canal.items():
+        despachante.disparar(channel_id, PRIORIDADE_CONFIRMACAO, "enviar", functools.partial(ctx.send, "\n".join(textos)))
+
+async def enviar_ou_atualizar_ficha(ctx, user_id, confirmacoes=()):
+    """
+    Envia ou atualiza a mensagem da ficha do usuário no canal.
+    'confirmacoes' são pares (ctx, texto) dos comandos que pediram a atualização: as do canal onde a ficha
+    está vão no topo da própria mensagem da ficha, e as dos outros canais saem em mensagens separadas.
+    Se o texto não mudou desde a última edição e não há confirmações, não faz nenhuma chamada ao Discord.
+    """
+    user = await cache_fichas.obter_sem_bloquear(user_id)
+    if user is None:
+        _enviar_confirmacoes(confirmacoes)
+        return # A ficha foi resetada enquanto a atualização esperava
+    with metricas.cronometro("renderizacao_segundos"):
+        conteudo, hash_ficha = conteudo_ficha(user_id, user)
+
+    # A ficha fica no canal da mensagem existente ou, se ainda não há mensagem, no canal do comando
+    canal_ficha = user.ficha_channel_id if user.ficha_message_id else ctx.channel.id
+    juntas = [texto for c, texto in confirmacoes if c.channel.id == canal_ficha]
+    _enviar_confirmacoes([(c, texto) for c, texto in confirmacoes if c.channel.id != canal_ficha])
+    if juntas:
+        conteudo = _com_confirmacoes(conteudo, juntas)
+
+    # Tenta editar a mensagem da ficha existente, se houver
+    try:
+        if user.ficha_channel_id and user.ficha_message_id:
+            anterior = _fichas_renderizadas.get(user_id)
+            if anterior and anterior[1].id == user.ficha_message_id:
+                if anterior[0] == hash_ficha and not juntas:
+                    metricas.contar("edicoes_evitadas_total")
+                    return # Nada mudou desde a última edição
+                mensagem = anterior[1]
+            else:
+                channel = bot.get_channel(user.ficha_channel_id)
+                # Se o canal não foi encontrado (ex: foi apagado), zera as IDs
+                mensagem = channel.get_partial_message(user.ficha_message_id) if channel else None
+            if mensagem:
+                # Edita direto pela ID, sem buscar a mensagem antes
+                await despachante.executar(user.ficha_channel_id, PRIORIDADE_FICHA, "editar", functools.partial(mensagem.edit, **conteudo))
+                _fichas_renderizadas[user_id] = (hash_ficha, mensagem)
+                return
+            _esquecer_mensagem_ficha(user_id, user)
+    except discord.NotFound:
+        # Mensagem não encontrada, então envia uma nova
+        _esquecer_mensagem_ficha(user_id, user)
+    except discord.Forbidden:
+        await ctx.send(f":x: | **{ctx.author.mention}**, **Erro:** O bot não tem permissão para editar a mensagem da ficha. Por favor, verifique as permissões no canal.")
+        pass
+    except Exception as e:
+        print(f"Erro inesperado ao tentar editar a mensagem da ficha: {e}")
+        metricas.contar("erros_total", origem="editar_ficha")
+        pass
+
+    # Se a mensagem não existe ou não pôde ser editada, envia uma nova
+    if canal_ficha != ctx.channel.id:
+        # As confirmações juntadas eram do canal da mensagem antiga; a nova vai para o canal do comando
+        conteudo, _ = conteudo_ficha(user_id, user)
+        _enviar_confirmacoes([(c, texto) for c, texto in confirmacoes if c.channel.id == canal_ficha])
+    # Direto no canal: em um comando de barra, ctx.send responderia à interação em vez de criar a mensagem da ficha
+    new_message = await despachante.executar(ctx.channel.id, PRIORIDADE_FICHA, "enviar", functools.partial(ctx.channel.send, **conteudo))
+    user.ficha_message_id = new_message.id
+    user.ficha_channel_id = new_message.channel.id
+    _fichas_renderizadas[user_id] = (hash_ficha, new_message)
+    salvar_dados(user_id, user) # Salva as IDs da nova mensagem para editá-la mesmo depois de reiniciar o bot
+
+
+class TravasPorUsuario:
+    """
+    Uma trava assíncrona por usuário: alterações na mesma ficha acontecem uma de cada vez,
+    enquanto as fichas dos outros usuários continuam sendo alteradas em paralelo.
+    """
+
+    def __init__(self, limite):
+        self.limite = limite
+        self._travas = OrderedDict() # user_id -> [trava, comandos usando ou esperando a trava]
+
+    @contextlib.asynccontextmanager
+    async def trava(self, user_id):
+        entrada = self._travas.get(user_id)
+        if entrada is None:
+            entrada = self._travas[user_id] = [asyncio.Lock(), 0]
+        self._travas.move_to_end(user_id)
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            self._descartar_ociosas()
+
+    def em_uso(self, user_id):
+        """Indica se algum comando está usando ou esperando a trava de 'user_id'."""
+        entrada = self._travas.get(user_id)
+        return entrada is not None and entrada[1] > 0
+
+    def _descartar_ociosas(self):
+        """Descarta as travas ociosas usadas há mais tempo até voltar ao limite."""
+        excesso = len(self._travas) - self.limite
+        if excesso <= 0:
+            return
+        ociosas = []
+        for user_id, (_, usos) in self._travas.items():
+            if usos == 0:
+                ociosas.append(user_id)
+                if len(ociosas) == excesso:
+                    break
+        for user_id in ociosas:
+            del self._travas[user_id]
+
+travas_usuarios = TravasPorUsuario(LIMITE_TRAVAS_USUARIOS)
+
+class AgendadorFichas:
+    """
+    Junta as atualizações de ficha pedidas em sequência para o mesmo usuário (ex: vários !add seguidos)
+    em uma única edição com o estado final. Cada ficha tem no máximo uma edição em andamento por vez,
+    e cada canal no máximo 'limite_por_canal'.
+    """
+
+    def __init__(self, janela, limite_por_canal):
+        self.janela = janela
+        self.limite_por_canal = limite_por_canal
+        self.pendentes = {} # user_id -> ctx do pedido mais recente
+        self.confirmacoes = {} # user_id -> [(ctx, texto)] dos comandos que pediram a próxima edição
+        self.solicitadas = 0
+        self.realizadas = 0
+        self.agrupadas = 0 # Pedidos absorvidos por outro pedido da mesma ficha
+        self._tarefas = {} # user_id -> tarefa que processa as atualizações da ficha
+        self._canais = {} # channel_id -> [semáforo, edições esperando ou em andamento]
+
+    def agendar(self, ctx, user_id, confirmacao=None):
+        """
+        Pede a atualização da ficha de 'user_id'; ela acontece ao fim da janela, com o estado daquele momento.
+        'confirmacao' é o texto de confirmação do comando, enviado junto com a edição.
+        """
+        self.solicitadas += 1
+        if user_id in self.pendentes:
+            self.agrupadas += 1
+        self.pendentes[user_id] = ctx
+        if confirmacao:
+            self.confirmacoes.setdefault(user_id, []).append((ctx, confirmacao))
+        if user_id not in self._tarefas:
+            self._tarefas[user_id] = asyncio.create_task(self._processar(user_id))
+
+    async def _processar(self, user_id):
+        try:
+            while user_id in self.pendentes:
+                await asyncio.sleep(self.janela)
+                ctx = self.pendentes.pop(user_id)
+                confirmacoes = self.confirmacoes.pop(user_id, [])
+                canal = self._canais.setdefault(ctx.channel.id, [asyncio.Semaphore(self.limite_por_canal), 0])
+                canal[1] += 1
+                try:
+                    async with canal[0], travas_usuarios.trava(user_id):
+                        await enviar_ou_atualizar_ficha(ctx, user_id, confirmacoes)
+                        self.realizadas += 1
+                except Exception as e:
+                    # Só esta edição se perde: os pedidos feitos enquanto ela falhava continuam na fila
+                    print(f"Erro ao atualizar a ficha de {user_id}: {e}")
+                    metricas.contar("erros_total", origem="agendador")
+                finally:
+                    canal[1] -= 1
+                    if canal[1] == 0:
+                        del self._canais[ctx.channel.id]
+        finally:
+            del self._tarefas[user_id]
+
+    def profundidade(self):
+        """Quantas fichas têm atualização esperando ou em andamento."""
+        return len(self._tarefas)
+
+    def resumo(self):
+        return (
+            f"Fichas: {self.solicitadas} atualizações pedidas, {self.realizadas} edições feitas, "
+            f"{self.agrupadas} agrupadas, {self.profundidade()} na fila."
+        )
+
+agendador_fichas = AgendadorFichas(JANELA_ATUALIZACAO_FICHA, EDICOES_POR_CANAL)
+
+def _metricas_internas():
+    """Contadores que a persistência, o cache e o agendador já mantêm, lidos no momento da exportação."""
+    return [
+        ("persistencia_gravacoes_solicitadas", persistencia.escritas_solicitadas),
+        ("persistencia_escritas_realizadas", persistencia.escritas_realizadas),
+        ("persistencia_pendentes", len(persistencia.pendentes)),
+        ("cache_fichas", len(cache_fichas)),
+        ("cache_acertos", cache_fichas.acertos),
+        ("cache_falhas", cache_fichas.falhas),
+        ("cache_despejos", cache_fichas.despejos),
+        ("agendador_atualizacoes_pedidas", agendador_fichas.solicitadas),
+        ("agendador_edicoes_feitas", agendador_fichas.realizadas),
+        ("agendador_agrupadas", agendador_fichas.agrupadas),
+        ("agendador_fila", agendador_fichas.profundidade()),
+        ("despachante_chamadas", despachante.chamadas),
+        ("despachante_repetidas", despachante.repetidas),
+        ("despachante_fila", despachante.profundidade()),
+        ("eventos_registrados", registro_eventos.registrados),
+        ("eventos_gravados", registro_eventos.gravados),
+        ("eventos_fila", registro_eventos.fila.qsize()),
+    ]
+
+metricas.coletores.append(_metricas_internas)
+
+async def _responder_interacao(ctx, texto):
+    """Responde a um comando de barra, visível só para quem o usou."""
+    try:
+        with metricas.chamada_discord("responder"):
+            await ctx.send(texto, ephemeral=True)
+    except discord.HTTPException as e:
+        print(f"Erro ao responder o comando de barra de {ctx.author.id}: {e}")
+        metricas.contar("erros_total", origem="interacao")
+
+def agendar_atualizacao_ficha(ctx, user_id, confirmacao=None):
+    """
+    Agenda a atualização da mensagem da ficha, juntando pedidos seguidos em uma única edição.
+    A confirmação do comando, se houver, sai junto com a edição em vez de em uma mensagem própria.
+    Em um comando de barra, ela é a resposta à interação, que o Discord espera em até 3 segundos.
+    """
+    if ctx.interaction is not None:
+        asyncio.create_task(_responder_interacao(ctx, confirmacao or ":scroll: | Sua ficha foi atualizada."))
+        confirmacao = None
+    agendador_fichas.agendar(ctx, user_id, confirmacao)
+
+# --- Rankings ---
+# O !top e o !rank consultam, em cada guild, as fichas já ordenadas por cada atributo de 'bonus_validos'
+# (os atributos base pelo status, e Locomoção, Kritos e PR pelo valor calculado). Os índices de uma guild
+# são montados na primeira consulta e depois acompanham cada salvar_dados, sem reordenar tudo de novo.
+
+def valores_ranking(status, bonus):
+    """Valor da ficha em cada atributo do ranking, na ordem de 'bonus_validos'."""
+    return (
+        *status,
+        calcular_locomocao(status[_I_VEL], bonus[_I_LOCOMOCAO]),
+        calcular_kritos(status[_I_MAG], bonus[_I_KRITOS]),
+        calcular_pr(status[_I_RES], bonus[_I_PR]),
+    )
+
+def _valores_ranking_dict(dados):
+    """valores_ranking de uma ficha no formato JSON."""
+    return valores_ranking(
+        [dados["status"].get(attr, 0) for attr in atributos_validos], [dados["bonus"].get(attr, 0) for attr in bonus_validos]
+    )
+
+class RankingGuild:
+    """
+    As fichas de uma guild ordenadas por cada atributo do ranking, do maior valor para o menor (no empate,
+    a menor ID primeiro). Cada atributo guarda dois arrays compactos na mesma ordem: os valores negados
+    (para ficarem em ordem crescente e servirem ao bisect) e as IDs dos usuários.
+    """
+
+    def __init__(self, valores):
+        self.valores = valores # user_id (int) -> valores_ranking da ficha
+        self._negados = []
+        self._ids = []
+        for i in range(len(bonus_validos)):
+            ordenados = sorted((-valores_ficha[i], user_id) for user_id, valores_ficha in valores.items())
+            self._negados.append(array("q", [negado for negado, _ in ordenados]))
+            self._ids.append(array("Q", [user_id for _, user_id in ordenados]))
+
+    def __len__(self):
+        return len(self.valores)
+
+    def _posicao(self, i, negado, user_id):
+        """Posição da entrada (negado, user_id) no índice do atributo 'i', existente ou não."""
+        negados = self._negados[i]
+        inicio = bisect.bisect_left(negados, negado)
+        fim = bisect.bisect_right(negados, negado, inicio)
+        return bisect.bisect_left(self._ids[i], user_id, inicio, fim)
+
+    def atualizar(self, user_id, valores):
+        """Move a ficha para as posições dos valores novos; valores=None tira a ficha do ranking."""
+        antigos = self.valores.pop(user_id, None)
+        if valores is not None:
+            self.valores[user_id] = valores
+        for i in range(len(bonus_validos)):
+            if antigos is not None and valores is not None and antigos[i] == valores[i]:
+                continue # O atributo não mudou (o caso comum: um comando muda poucos atributos)
+            if antigos is not None:
+                posicao = self._posicao(i, -antigos[i], user_id)
+                del self._negados[i][posicao]
+                del self._ids[i][posicao]
+            if valores is not None:
+                posicao = self._posicao(i, -valores[i], user_id)
+                self._negados[i].insert(posicao, -valores[i])
+                self._ids[i].insert(posicao, user_id)
+
+    def top(self, i, quantidade):
+        """As 'quantidade' primeiras fichas do atributo 'i', como (posição, user_id, valor); empatados dividem a posição."""
+        resultado = []
+        for indice, (negado, user_id) in enumerate(zip(self._negados[i][:quantidade], self._ids[i][:quantidade])):
+            posicao = resultado[-1][0] if resultado and -negado == resultado[-1][2] else indice + 1
+            resultado.append((posicao, user_id, -negado))
+        return resultado
+
+    def posicoes(self, user_id):
+        """(valor, posição) da ficha em cada atributo do ranking, ou None se ela não está no ranking."""
+        valores = self.valores.get(user_id)
+        if valores is None:
+            return None
+        # A posição é 1 + quantas fichas têm valor maior, então os empatados dividem a posição
+        return [(valor, bisect.bisect_left(self._negados[i], -valor) + 1) for i, valor in enumerate(valores)]
+
+class RankingFichas:
+    """Os RankingGuild de cada guild já consultada, atualizados a cada ficha salva."""
+
+    def __init__(self):
+        self._guilds = {} # guild_id -> RankingGuild
+        self._montagens = {} # guild_id -> tarefa que monta o ranking da guild
+        self._alteradas = {} # guild_id -> {user_id: ficha ou None} salvas enquanto o ranking é montado
 
-# Nome do arquivo onde as fichas serão salvas
-FICHA_FILE = "fichas.json"
+    def atualizar(self, chave, user):
+        """Atualiza a ficha de 'chave' (user=None se ela foi apagada) no ranking da guild, se ele já existe."""
+        guild_id, user_id = separar_chave(chave)
+        user_id = int(user_id)
+        if guild_id in self._alteradas:
+            self._alteradas[guild_id][user_id] = user
+            return
+        ranking = self._guilds.get(guild_id)
+        if ranking is not None:
+            ranking.atualizar(user_id, valores_ranking(user.status, user.bonus) if user is not None else None)
 
-# Limites de Rank para cada atributo
-rank_limits = {
-    "I": 1,
-    "II": 2,
-    "III": 3,
-    "IV": 4,
-    "V": 5
-}
+    async def obter(self, guild_id):
+        """Ranking da guild; na primeira consulta ele é montado a partir das fichas guardadas, fora do loop."""
+        if guild_id not in self._guilds:
+            if guild_id not in self._montagens:
+                self._montagens[guild_id] = asyncio.create_task(self._montar(guild_id))
+            # Um comando cancelado não cancela a montagem, que outros comandos podem estar esperando
+            await asyncio.shield(self._montagens[guild_id])
+        return self._guilds[guild_id]
 
-# Atributos base que o jogador pode distribuir pontos
-atributos_validos = ["DMG", "HP", "FOR", "DEF", "RES", "MAG", "INT", "AGI", "VEL"]
+    async def _montar(self, guild_id):
+        alteradas = self._alteradas[guild_id] = {}
+        # As alterações que ainda não chegaram ao armazenamento entram depois da leitura, como as feitas durante ela
+        for lote in (persistencia.em_gravacao, persistencia.pendentes):
+            for chave, user in lote.items():
+                guild_da_ficha, user_id = separar_chave(chave)
+                if guild_da_ficha == guild_id:
+                    alteradas[int(user_id)] = user
+        try:
+            inicio = time.perf_counter()
+            ranking = await asyncio.to_thread(self._ler_guild, guild_id)
+            for user_id, user in alteradas.items():
+                ranking.atualizar(user_id, valores_ranking(user.status, user.bonus) if user is not None else None)
+            self._guilds[guild_id] = ranking
+            metricas.observar("montagem_ranking_segundos", time.perf_counter() - inicio)
+        finally:
+            del self._alteradas[guild_id]
+            del self._montagens[guild_id]
 
-# Atributos que podem receber bônus diretos (inclui os atributos base e os calculados)
-bonus_validos = atributos_validos + ["LOCOMOCAO", "KRITOS", "PR"]
+    @staticmethod
+    def _ler_guild(guild_id):
+        return RankingGuild(
+            {int(user_id): _valores_ranking_dict(dados) for user_id, dados in armazenamento.listar_fichas(guild_id)}
+        )
 
-# Limites de valor para cada atributo por Rank
-atributos_com_limite = {
-    "DMG": {"I": 20, "II": 45, "III": 99, "IV": 120, "V": 200},
-    "HP": {"I": 800, "II": 1800, "III": 2750, "IV": 3200, "V": 4500},
-    "FOR": {"I": 35, "II": 80, "III": 150, "IV": 200, "V": 300},
-    "DEF": {"I": 10, "II": 25, "III": 30, "IV": 50, "V": 100},
-    "RES": {"I": 100, "II": 150, "III": 250, "IV": 325, "V": 400},
-    "MAG": {"I": 50, "II": 150, "III": 200, "IV": 350, "V": 500},
-    "INT": {"I": 90, "II": 110, "III": 125, "IV": 140, "V": 230},
-    "AGI": {"I": 100, "II": 150, "III": 200, "IV": 325, "V": 450},
-    "VEL": {"I": 50, "II": 80, "III": 100, "IV": 150, "V": 200}
-}
+    def limpar(self):
+        """Descarta os rankings montados (ex: depois de recarregar as fichas); cada um é remontado na próxima consulta."""
+        self._guilds.clear()
 
-# Dicionário para armazenar os dados dos usuários em memória (será carregado do arquivo)
-users = {}
+ranking_fichas = RankingFichas()
 
-# --- Funções de Salvamento e Carregamento ---
-def salvar_dados():
-    """Salva o dicionário 'users' em um arquivo JSON."""
-    with open(FICHA_FILE, "w") as f:
-        json.dump(users, f, indent=4) # indent=4 para formatação legível
+# --- Reconciliação das Mensagens de Ficha ---
+# Uma mensagem de ficha apagada (ou em um canal apagado) só seria descoberta quando o dono usasse um comando.
+# Depois de conectar, o bot confere as mensagens do índice um canal por vez, lendo o histórico do canal
+# em páginas de até 100 mensagens, em vez de buscar as mensagens uma por uma.
+_trava_reconciliacao = asyncio.Lock()
 
-def carregar_dados():
-    """Carrega o dicionário 'users' de um arquivo JSON. Retorna um dicionário vazio se o arquivo não existir ou houver erro."""
-    if os.path.exists(FICHA_FILE):
+async def _conferir_canal(channel_id, mensagens):
+    """
+    Retorna, de 'mensagens' ({message_id: user_id}), as que com certeza não existem mais no canal.
+    Mensagens que não puderam ser conferidas ficam de fora (serão descobertas no próximo comando).
+    """
+    channel = bot.get_channel(channel_id)
+    if channel is None:
         try:
-            with open(FICHA_FILE, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print(f"Erro ao ler o arquivo {FICHA_FILE}. Criando um novo.")
+            with metricas.chamada_discord("buscar_canal"):
+                channel = await bot.fetch_channel(channel_id)
+        except (discord.NotFound, discord.Forbidden):
+            return dict(mensagens) # Canal apagado ou inacessível: nenhuma das fichas pode ser editada ali
+        except discord.HTTPException as e:
+            print(f"Erro ao buscar o canal {channel_id} na reconciliação: {e}")
             return {}
-    return {}
 
-# --- Funções de Cálculo e Atualização ---
-def calcular_locomocao(vel, bonus_locomocao):
-    """
-    Calcula o valor da locomoção.
-    Locomoção começa com 4 e é sempre influenciada pela VEL.
-    """
-    return 4 + (vel // 10) + bonus_locomocao
+    restantes = set(mensagens)
+    lidas = 0
+    ultima_lida = 0
+    try:
+        with metricas.chamada_discord("historico"):
+            # O histórico vem em ordem crescente de ID a partir da mensagem de ficha mais antiga do canal
+            async for mensagem in channel.history(
+                limit=LIMITE_VARREDURA_CANAL, after=discord.Object(id=min(restantes) - 1), oldest_first=True
+            ):
+                lidas += 1
+                ultima_lida = mensagem.id
+                restantes.discard(mensagem.id)
+                if not restantes:
+                    return {}
+    except discord.HTTPException as e:
+        # Sem permissão para ler o histórico (ou falha do Discord): não dá para afirmar que algo sumiu
+        print(f"Erro ao ler o histórico do canal {channel_id} na reconciliação: {e}")
+        return {}
+    if lidas < LIMITE_VARREDURA_CANAL:
+        return {message_id: mensagens[message_id] for message_id in restantes} # O histórico inteiro foi lido
+    # A varredura parou no limite: só o trecho já lido foi conferido
+    return {message_id: mensagens[message_id] for message_id in restantes if message_id < ultima_lida}
 
-def calcular_pr(res, bonus_pr):
-    """Calcula os Pontos de Resistência (PR)."""
-    return (20 + (res // 15)) + bonus_pr
+async def _esquecer_mensagens_mortas(channel_id, mortas):
+    """Zera as IDs das fichas cujas mensagens não existem mais. Retorna quantas foram zeradas."""
+    removidas = 0
+    for message_id, user_id in mortas.items():
+        async with travas_usuarios.trava(user_id):
+            user = await cache_fichas.obter_sem_bloquear(user_id)
+            # A ficha pode ter ganhado uma mensagem nova enquanto o canal era conferido
+            if user is None or (user.ficha_channel_id, user.ficha_message_id) != (channel_id, message_id):
+                continue
+            _esquecer_mensagem_ficha(user_id, user)
+            salvar_dados(user_id, user)
+            removidas += 1
+    return removidas
 
-def calcular_kritos(mag_status, bonus_kritos):
-    """Calcula o valor de Kritos."""
-    # Kritos agora usa a MAG do status, não os pontos gastos, para refletir bônus etc.
-    return (40 + (mag_status * 2)) + bonus_kritos 
+async def reconciliar_mensagens_fichas(canais=None):
+    """
+    Confere as mensagens de ficha registradas nos canais 'canais' (None = todos do índice)
+    e esquece as que não existem mais.
+    """
+    async with _trava_reconciliacao:
+        inicio = time.perf_counter()
+        canais = [
+            (channel_id, dict(mensagens)) for channel_id, mensagens in indice_mensagens.por_canal.items()
+            if canais is None or channel_id in canais
+        ]
+        conferidas = removidas = 0
+        for channel_id, mensagens in canais:
+            mortas = await _conferir_canal(channel_id, mensagens)
+            removidas += await _esquecer_mensagens_mortas(channel_id, mortas)
+            conferidas += len(mensagens)
+        metricas.contar("mensagens_mortas_removidas_total", removidas)
+        print(
+            f"Reconciliação das fichas: {conferidas} mensagens em {len(canais)} canais conferidas, "
+            f"{removidas} referências a mensagens apagadas removidas em {time.perf_counter() - inicio:.1f}s."
+        )
 
+# Guilds cujas fichas já foram abertas e tiveram as mensagens conferidas desde o último carregar_dados
+_guilds_preparadas = set()
+_travas_guilds = {}
 
-def atualizar_status(user):
+async def _adotar_fichas_antigas_da_guild(guild_id):
     """
-    Atualiza os atributos calculados do usuário com base nos pontos gastos
-    e bônus. Aplica os limites de rank.
+    Adota de uma vez as fichas do formato antigo cuja mensagem está em um canal da guild: elas são dessa
+    guild, e assim já entram no !addpontos todos e no !top dela. As sem mensagem esperam o jogador usá-las.
     """
-    status = user["status"]
-    pts_gastos = user["pts_gastos"]
-    bonus = user.get("bonus", {attr: 0 for attr in bonus_validos})
-
-    # Zera status e aplica bônus diretos de atributos base
-    for key in atributos_validos:
-        status[key] = bonus.get(key, 0)
-
-    # Aplica os pontos gastos aos atributos, com cálculos específicos
-    for attr, pts in pts_gastos.items():
-        if attr == "DEF":
-            status["DEF"] += pts * 1
-            status["RES"] += pts * 1
-        elif attr == "RES":
-            status["RES"] += pts * 2
-            status["HP"] += pts * 2
-        elif attr == "INT":
-            status["INT"] += pts * 2
-        elif attr == "AGI":
-            status["AGI"] += pts * 2
-            status["VEL"] += pts * 1
-        elif attr == "VEL":
-            status["VEL"] += pts * 2
-            status["AGI"] += pts * 1
-        elif attr == "HP":
-            status["HP"] += pts * 5
-            status["RES"] += pts * 2
-        elif attr == "FOR":
-            status["FOR"] += pts * 4
-            status["RES"] += pts * 4
-            status["DEF"] += (pts // 5) * 1
-        elif attr == "MAG":
-            status["MAG"] += pts * 2
-        elif attr == "DMG":
-            status["DMG"] += pts * 2
-            status["FOR"] += pts * 2
-            status["MAG"] += pts * 1
-
-    # Aplica os limites de rank aos atributos
-    for attr in atributos_validos:
-        rank = user["ranks"].get(attr, "I")
-        limite = atributos_com_limite[attr][rank]
-        if status[attr] > limite:
-            status[attr] = limite
-            
-async def enviar_ou_atualizar_ficha(ctx, user_id):
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return
+    chaves = [
+        f"{guild_id}:{separar_chave(user_id)[1]}"
+        for channel_id, mensagens in list(indice_mensagens.por_canal.items())
+        if guild.get_channel_or_thread(channel_id) is not None
+        for user_id in mensagens.values() if separar_chave(user_id)[0] == GUILD_LEGADO
+    ]
+    for inicio in range(0, len(chaves), LOTE_RECALCULO):
+        await cache_fichas.carregar_varias(chaves[inicio:inicio + LOTE_RECALCULO])
+    if chaves:
+        print(f"{len(chaves)} fichas antigas com mensagem na guild {guild_id} adotadas por ela.")
+
+async def preparar_guild(guild_id):
     """
-    Envia ou atualiza a mensagem da ficha do usuário no canal.
-    Agora inclui a menção do usuário no início da ficha e separa os status.
+    No primeiro comando de uma guild, abre a partição das fichas dela fora do loop, registra as
+    mensagens de ficha no índice e as confere em segundo plano.
     """
-    user = users[user_id]
-    status = user["status"]
-    pts_gastos = user["pts_gastos"]
-    ranks = user["ranks"]
-    bonus = user.get("bonus", {attr: 0 for attr in bonus_validos})
+    if guild_id in _guilds_preparadas:
+        return
+    async with _travas_guilds.setdefault(guild_id, asyncio.Lock()):
+        if guild_id in _guilds_preparadas:
+            return
+        inicio = time.perf_counter()
+        mensagens = await asyncio.to_thread(armazenamento.abrir_particao, guild_id)
+        for user_id, channel_id, message_id in mensagens:
+            indice_mensagens.registrar(user_id, channel_id, message_id)
+        await _adotar_fichas_antigas_da_guild(guild_id)
+        _guilds_preparadas.add(guild_id)
+        metricas.observar("abertura_guild_segundos", time.perf_counter() - inicio)
+        if mensagens:
+            # Esquece as mensagens de ficha apagadas enquanto o bot estava fora, antes que os jogadores esbarrem nelas
+            asyncio.create_task(reconciliar_mensagens_fichas({channel_id for _, channel_id, _ in mensagens}))
+    _travas_guilds.pop(guild_id, None)
 
-    # Calcula os status derivados (Locomoção, PR, Kritos)
-    loc = calcular_locomocao(status["VEL"], bonus.get("LOCOMOCAO", 0))
-    pr = calcular_pr(status["RES"], bonus.get("PR", 0))
-    kritos = calcular_kritos(status["MAG"], bonus.get("KRITOS", 0)) # Usando status["MAG"] aqui
-
-    # Constrói a seção de Atributos Base
-    texto_atributos_base = ""
-    # Explicitamente lista apenas os atributos que NÃO são HP, DEF, DMG para esta seção
-    atributos_para_listar_base = [attr for attr in atributos_validos if attr not in ["HP", "DEF", "DMG"]]
-    for attr in atributos_para_listar_base:
-        texto_atributos_base += f"• {attr} ({ranks[attr]}): {status[attr]} [Gastos: {pts_gastos[attr]}]\n"
-
-    # Constrói a seção de Status de Combate (agora incluindo os ranks)
-    texto_status_combate = (
-        f"• Vitalidade (HP) ({ranks['HP']}): {status['HP']} [Gastos: {pts_gastos['HP']}]\n"
-        f"• Defesa (DEF) ({ranks['DEF']}): {status['DEF']} [Gastos: {pts_gastos['DEF']}]\n"
-        f"• Dano (DMG) ({ranks['DMG']}): {status['DMG']} [Gastos: {pts_gastos['DMG']}]\n"
-    )
+# --- Recálculo em Lote ---
+# Depois de uma mudança de balanceamento (limites de rank, fórmulas), o status guardado nas fichas fica
+# desatualizado. O recálculo passa por todas as fichas em lotes, grava só as que mudaram e depois reedita
+# as mensagens delas aos poucos. O progresso fica em RECALCULO_FILE, para continuar de onde parou: só a
+# última ficha recalculada (as fichas são percorridas em ordem) e as mensagens que ainda faltam reeditar.
+_trava_recalculo = asyncio.Lock()
 
-    # Constrói a seção de Status Gerais (os que são calculados)
-    texto_status_gerais = (
-        f"• Kritos: {kritos}\n"
-        f"• Pontos de Resistência (PR): {pr}\n"
-        f"• Locomoção: {loc} metros\n"
-    )
+def _ler_progresso_recalculo():
+    if not os.path.exists(RECALCULO_FILE):
+        return None
+    with open(RECALCULO_FILE, "r") as f:
+        progresso = json.load(f)
+    if "ids" in progresso:
+        # Arquivo de uma versão que guardava a lista inteira de fichas: vira o cursor
+        posicao = progresso.pop("posicao")
+        progresso["ultimo"] = progresso.pop("ids")[posicao - 1] if posicao else None
+    return progresso
 
-    # Constrói a mensagem da ficha completa
-    mensagem_ficha = (
-        f"{ctx.author.mention}\n"
-        "# :bar_chart: Ficha de Atributos\n\n"
-        f"```\nPontos Livres: {user['pontos']}\nPontos Gastos: {sum(pts_gastos.values())}\n```\n"
-        
-        "## :muscle: Atributos Base\n"
-        f"```\n{texto_atributos_base}```\n"
-        
-        "## :crossed_swords: Status de Combate\n"
-        f"```\n{texto_status_combate}```\n"
+def _salvar_progresso_recalculo(progresso):
+    _escrever_atomico(RECALCULO_FILE, json.dumps({
+        "ultimo": progresso["ultimo"],
+        "editar": progresso["editar"][progresso["editadas"]:], # As já reeditadas não precisam voltar
+        "editadas": 0,
+    }))
 
-        "## :brain: Status Derivados\n"
-        f"```\n{texto_status_gerais}```\n"
-    )
+def _retomar_recalculo(progresso, ids):
+    """
+    Prepara o recálculo das fichas 'ids' (todas, em memória ou só no armazenamento) em ordem estável, a partir
+    da seguinte à última já recalculada em 'progresso' (o lido de RECALCULO_FILE, ou None para começar do zero).
+    """
+    progresso = progresso or {"ultimo": None, "editar": [], "editadas": 0}
+    ordenados = sorted(ids)
+    if progresso["ultimo"] is not None:
+        # As fichas criadas depois do início do recálculo já nascem com o status atual
+        del ordenados[:bisect.bisect_right(ordenados, progresso["ultimo"])]
+    progresso["ids"] = ordenados # Só em memória: ao retomar, a ordem sai de novo das fichas guardadas
+    progresso["posicao"] = 0
+    return progresso
 
-    # Tenta editar a mensagem da ficha existente, se houver
+def _recalcular_proximo_lote(progresso):
+    """Recalcula o próximo lote de fichas do progresso e retorna as que mudaram, {user_id: ficha}."""
+    inicio = progresso["posicao"]
+    fichas = {}
+    for user_id in progresso["ids"][inicio:inicio + LOTE_RECALCULO]:
+        user = cache_fichas.obter(user_id)
+        if user is not None: # A ficha pode ter sido apagada depois que o recálculo começou
+            fichas[user_id] = user
+    alteradas = recalcular_status_em_lote(fichas)
+    progresso["posicao"] = min(inicio + LOTE_RECALCULO, len(progresso["ids"]))
+    progresso["ultimo"] = progresso["ids"][progresso["posicao"] - 1]
+    progresso["editar"].extend(alteradas)
+    return {user_id: fichas[user_id] for user_id in alteradas}
+
+def _intercalar_por_canal(user_ids):
+    """Reordena as fichas alternando entre os canais, para não concentrar edições seguidas em um só."""
+    por_canal = {}
+    for user_id in user_ids:
+        # Pelo índice de mensagens, sem ler do armazenamento as fichas que já saíram da memória
+        canal_id = indice_mensagens.por_usuario.get(user_id, (None, None))[0]
+        por_canal.setdefault(canal_id, []).append(user_id)
+    intercalados = []
+    filas = list(por_canal.values())
+    for i in range(max((len(fila) for fila in filas), default=0)):
+        intercalados.extend(fila[i] for fila in filas if i < len(fila))
+    return intercalados
+
+async def _reeditar_ficha(user_id):
+    """Edita a mensagem da ficha sem buscá-la antes. Retorna True se alguma mensagem foi editada."""
+    async with travas_usuarios.trava(user_id):
+        return await _reeditar_ficha_travada(user_id)
+
+async def _reeditar_ficha_travada(user_id):
+    user = await cache_fichas.obter_sem_bloquear(user_id)
+    if user is None:
+        return False
+    if not (user.ficha_channel_id and user.ficha_message_id):
+        return False
+    channel = bot.get_channel(user.ficha_channel_id)
     try:
-        if user.get("ficha_channel_id") and user.get("ficha_message_id"):
-            channel = bot.get_channel(user["ficha_channel_id"])
-            if channel:
-                old_message = await channel.fetch_message(user["ficha_message_id"])
-                await old_message.edit(content=mensagem_ficha)
-                return
-            else:
-                # Se o canal não foi encontrado (ex: foi apagado), zera as IDs
-                user["ficha_channel_id"] = None
-                user["ficha_message_id"] = None
+        if channel:
+            conteudo, hash_ficha = conteudo_ficha(user_id, user)
+            mensagem = channel.get_partial_message(user.ficha_message_id)
+            await despachante.executar(channel.id, PRIORIDADE_EM_MASSA, "editar", functools.partial(mensagem.edit, **conteudo))
+            _fichas_renderizadas[user_id] = (hash_ficha, mensagem)
+            return True
     except discord.NotFound:
-        # Mensagem não encontrada, então envia uma nova
-        user["ficha_channel_id"] = None
-        user["ficha_message_id"] = None
-        pass
-    except discord.Forbidden:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Erro:** O bot não tem permissão para editar a mensagem da ficha. Por favor, verifique as permissões no canal.")
-        pass
-    except Exception as e:
-        print(f"Erro inesperado ao tentar editar a mensagem da ficha: {e}")
         pass
+    except discord.HTTPException as e:
+        print(f"Erro ao reeditar a ficha de {user_id}: {e}")
+        metricas.contar("erros_total", origem="recalculo")
+        return False
+    # Canal ou mensagem não existem mais: a ficha será enviada de novo no próximo comando
+    _esquecer_mensagem_ficha(user_id, user)
+    salvar_dados(user_id, user)
+    return False
 
-    # Se a mensagem não existe ou não pôde ser editada, envia uma nova
-    new_message = await ctx.send(mensagem_ficha)
-    user["ficha_message_id"] = new_message.id
-    user["ficha_channel_id"] = new_message.channel.id
+async def reeditar_fichas(progresso, ao_avancar=None):
+    """
+    Reedita as mensagens das fichas alteradas, respeitando INTERVALO_REEDICAO no geral e por canal.
+    O progresso é salvo em RECALCULO_FILE a cada 20 fichas; se 'ao_avancar' for informado (alterações que
+    não precisam ser retomadas depois de reiniciar), ele é chamado com o progresso no lugar disso.
+    """
+    if progresso["editadas"] == 0:
+        progresso["editar"] = _intercalar_por_canal(progresso["editar"])
+    inicio = time.perf_counter()
+    editadas = 0
+    ultima_edicao = 0.0
+    ultima_por_canal = {}
+    while progresso["editadas"] < len(progresso["editar"]):
+        user_id = progresso["editar"][progresso["editadas"]]
+        canal_id = indice_mensagens.por_usuario.get(user_id, (None, None))[0]
+        agora = time.monotonic()
+        espera = max(
+            ultima_edicao + INTERVALO_REEDICAO - agora,
+            ultima_por_canal.get(canal_id, 0.0) + INTERVALO_REEDICAO_CANAL - agora,
+        )
+        if espera > 0:
+            await asyncio.sleep(espera)
+        if await _reeditar_ficha(user_id):
+            editadas += 1
+            ultima_edicao = ultima_por_canal[canal_id] = time.monotonic()
+        progresso["editadas"] += 1
+        if progresso["editadas"] % 20 == 0:
+            if ao_avancar:
+                await ao_avancar(progresso)
+            else:
+                await asyncio.to_thread(_salvar_progresso_recalculo, progresso)
+    if ao_avancar is None and os.path.exists(RECALCULO_FILE):
+        os.remove(RECALCULO_FILE)
+    duracao = time.perf_counter() - inicio
+    return editadas, editadas / duracao if duracao else 0.0
+
+async def executar_recalculo(canal=None):
+    """
+    Recalcula todas as fichas (ou retoma um recálculo interrompido) e reedita as mensagens das que mudaram.
+    Se 'canal' for informado, envia o andamento para ele.
+    """
+    async with _trava_recalculo:
+        progresso = _retomar_recalculo(
+            await asyncio.to_thread(_ler_progresso_recalculo), await cache_fichas.listar_ids_sem_bloquear()
+        )
+        inicio = time.perf_counter()
+        recalculadas = len(progresso["ids"]) - progresso["posicao"]
+        while progresso["posicao"] < len(progresso["ids"]):
+            await cache_fichas.carregar_varias(progresso["ids"][progresso["posicao"]:progresso["posicao"] + LOTE_RECALCULO])
+            for user_id, user in _recalcular_proximo_lote(progresso).items():
+                salvar_dados(user_id, user)
+            # As fichas alteradas precisam estar gravadas antes de o progresso avançar
+            await persistencia.descarregar()
+            await asyncio.to_thread(_salvar_progresso_recalculo, progresso)
+        duracao = time.perf_counter() - inicio
+        resumo = (
+            f":gear: | **{recalculadas}** fichas recalculadas "
+            f"({recalculadas / duracao if duracao else 0:.0f} fichas/s), **{len(progresso['editar'])}** com status alterado. "
+            f"Atualizando as mensagens..."
+        )
+        print(resumo)
+        if canal:
+            await canal.send(resumo)
 
+        editadas, por_segundo = await reeditar_fichas(progresso)
+        resumo = f":white_check_mark: | Recálculo concluído: **{editadas}** mensagens de ficha atualizadas ({por_segundo:.1f} edições/s)."
+        print(resumo)
+        if canal:
+            await canal.send(resumo)
+
+def recalcular_offline():
+    """
+    Recalcula todas as fichas com o bot desligado. As mensagens ficam para ser reeditadas
+    quando o bot for iniciado (o progresso fica salvo em RECALCULO_FILE).
+    """
+    carregar_dados()
+    progresso = _retomar_recalculo(_ler_progresso_recalculo(), cache_fichas.listar_ids())
+    inicio = time.perf_counter()
+    recalculadas = len(progresso["ids"]) - progresso["posicao"]
+    while progresso["posicao"] < len(progresso["ids"]):
+        alteradas = _recalcular_proximo_lote(progresso)
+        armazenamento.gravar(
+            {user_id: json.dumps(user.para_dict(), separators=(",", ":")) for user_id, user in alteradas.items()}
+        )
+        _salvar_progresso_recalculo(progresso)
+    armazenamento.fechar()
+    duracao = time.perf_counter() - inicio
+    print(
+        f"{recalculadas} fichas recalculadas ({recalculadas / duracao if duracao else 0:.0f} fichas/s), "
+        f"{len(progresso['editar'])} com status alterado. As mensagens serão atualizadas quando o bot iniciar."
+    )
 
 # --- Eventos do Bot ---
 @bot.event
 async def on_ready():
-    """Confirma que o bot está online e conectado e carrega os dados."""
+    """
+    Confirma que o bot está online e conectado. Roda de novo a cada reconexão, então não lê as fichas:
+    elas são lidas uma única vez no setup_hook.
+    """
     print(f"Bot conectado como {bot.user}")
-    global users # Declara 'users' como global para poder modificá-lo
-    users = carregar_dados()
-    print("Fichas carregadas com sucesso!")
+    # Retoma um recálculo em lote que foi interrompido (ou deixado pela ferramenta de linha de comando)
+    if os.path.exists(RECALCULO_FILE) and not _trava_recalculo.locked():
+        bot.loop.create_task(executar_recalculo())
+
+@bot.before_invoke
+async def _antes_do_comando(ctx):
+    if metricas.ativo:
+        ctx.inicio_metricas = time.perf_counter()
+    await preparar_guild(ctx.guild.id if ctx.guild else 0)
+
+@bot.after_invoke
+async def _registrar_tempo_comando(ctx):
+    # Chamado mesmo quando o comando falha; não inclui a edição da ficha, que é agendada para depois
+    if metricas.ativo and hasattr(ctx, "inicio_metricas"):
+        metricas.observar("comando_segundos", time.perf_counter() - ctx.inicio_metricas, comando=ctx.command.qualified_name)
+
+@bot.listen("on_command_error")
+async def _contar_erro_comando(ctx, error):
+    if ctx.command is not None:
+        metricas.contar("comando_erros_total", comando=ctx.command.qualified_name, erro=type(error).__name__)
+
+@bot.listen("on_raw_message_delete")
+async def _mensagem_ficha_apagada(payload):
+    """
+    Esquece a mensagem de ficha apagada à mão, para o próximo !ficha enviar uma nova (senão o hash
+    em '_fichas_renderizadas' ainda bate e nada é enviado).
+    """
+    user_id = indice_mensagens.por_canal.get(payload.channel_id, {}).get(payload.message_id)
+    if user_id is not None:
+        await _esquecer_mensagens_mortas(payload.channel_id, {payload.message_id: user_id})
+
+@bot.listen("on_raw_bulk_message_delete")
+async def _mensagens_ficha_apagadas(payload):
+    mensagens = indice_mensagens.por_canal.get(payload.channel_id, {})
+    mortas = {message_id: mensagens[message_id] for message_id in payload.message_ids if message_id in mensagens}
+    if mortas:
+        await _esquecer_mensagens_mortas(payload.channel_id, mortas)
+
+# --- Comandos de Barra ---
+# O /add, /remover, /setrank, /addbonus e /ficha são as versões de barra (comandos híbridos) dos comandos de
+# mesmo nome. Os atributos e ranks são opções fixas, então chegam sempre válidos, e a quantidade do /add e do
+# /remover é sugerida já dentro do que a ficha permite.
+escolhas_atributos = [app_commands.Choice(name=atributo, value=atributo) for atributo in atributos_validos]
+escolhas_bonus = [app_commands.Choice(name=atributo, value=atributo) for atributo in bonus_validos]
+escolhas_ranks = [app_commands.Choice(name=rank, value=rank) for rank in rank_limits]
+
+# Quantidades sugeridas antes de o jogador digitar algo (além do máximo permitido)
+QUANTIDADES_SUGERIDAS = (1, 2, 3, 5, 10, 15, 20, 25, 30, 40, 50, 75, 100, 150, 200, 250, 500, 1000)
+
+def maximo_para_adicionar(user, atributo):
+    """Maior quantidade de pontos que cabe em 'atributo' sem passar dos pontos livres nem do limite do rank."""
+    i = indice_atributo[atributo]
+    limite = atributos_com_limite[atributo][user.rank(atributo)]
+    temp_pts_gastos = array("i", user.pts_gastos)
+    # O status só cresce com os pontos: busca binária pela maior quantidade que ainda fica no limite
+    menor, maior = 0, user.pontos
+    while menor < maior:
+        meio = (menor + maior + 1) // 2
+        temp_pts_gastos[i] = user.pts_gastos[i] + meio
+        if calcular_status(temp_pts_gastos, user.bonus, user.ranks, limitar=False)[i] <= limite:
+            menor = meio
+        else:
+            maior = meio - 1
+    return menor
+
+def _sugestoes_quantidade(maximo, digitado):
+    """Até 25 quantidades entre 1 e 'maximo' que começam com o que já foi digitado, incluindo o próprio máximo."""
+    digitado = digitado.strip()
+    if maximo < 1 or (digitado and not digitado.isdigit()):
+        return []
+    if not digitado:
+        valores = [valor for valor in QUANTIDADES_SUGERIDAS if valor < maximo]
+    else:
+        # Os números que começam com 'digitado' e têm k dígitos a mais vão de digitado * 10^k a (digitado + 1) * 10^k - 1
+        valores = []
+        base, escala = int(digitado), 1
+        while 0 < base * escala <= maximo and len(valores) < 24:
+            valores.extend(range(base * escala, min((base + 1) * escala - 1, maximo) + 1)[:24 - len(valores)])
+            escala *= 10
+        valores = [valor for valor in valores if valor != maximo]
+    escolhas = [app_commands.Choice(name=str(valor), value=valor) for valor in valores[:24]]
+    if str(maximo).startswith(digitado):
+        escolhas.append(app_commands.Choice(name=f"{maximo} (máximo)", value=maximo))
+    return escolhas
+
+async def _ficha_da_interacao(interaction):
+    """A ficha de quem está digitando o comando e o atributo já escolhido nele, ou (None, None)."""
+    atributo = interaction.namespace.atributo
+    if atributo not in atributos_validos:
+        return None, None
+    await preparar_guild(interaction.guild.id if interaction.guild else 0)
+    return await cache_fichas.obter_sem_bloquear(chave_ficha(interaction.guild, interaction.user.id)), atributo
+
+async def _autocompletar_add(interaction, digitado):
+    user, atributo = await _ficha_da_interacao(interaction)
+    if user is None:
+        return []
+    return _sugestoes_quantidade(maximo_para_adicionar(user, atributo), digitado)
+
+async def _autocompletar_remover(interaction, digitado):
+    user, atributo = await _ficha_da_interacao(interaction)
+    if user is None:
+        return []
+    return _sugestoes_quantidade(user.pts_gastos[indice_atributo[atributo]], digitado)
+
+async def sincronizar_comandos_barra():
+    """
+    Envia os comandos de barra ao Discord, mas só se mudaram desde a última sincronização (o hash deles
+    fica em COMANDOS_BARRA_HASH_FILE): reiniciar o bot não sincroniza a árvore de novo.
+    """
+    if SHARD_IDS is not None and 0 not in SHARD_IDS:
+        return # Com vários processos, só o do shard 0 sincroniza
+    comandos = [comando.to_dict(bot.tree) for comando in bot.tree.get_commands()]
+    hash_comandos = hashlib.sha256(
+        json.dumps([bot.application_id, comandos], sort_keys=True, default=str).encode()
+    ).hexdigest()
+    if os.path.exists(COMANDOS_BARRA_HASH_FILE):
+        with open(COMANDOS_BARRA_HASH_FILE, "r") as f:
+            if f.read().strip() == hash_comandos:
+                return
+    try:
+        sincronizados = await bot.tree.sync()
+    except discord.HTTPException as e:
+        # O hash não é gravado: a sincronização é tentada de novo na próxima inicialização
+        print(f"Erro ao sincronizar os comandos de barra: {e}")
+        metricas.contar("erros_total", origem="sincronizacao")
+        return
+    await asyncio.to_thread(_escrever_atomico, COMANDOS_BARRA_HASH_FILE, hash_comandos)
+    print(f"{len(sincronizados)} comandos de barra sincronizados.")
 
 # --- Comandos do Bot ---
 @bot.command()
@@ -225,27 +2829,23 @@ async def criar(ctx):
     """
     Cria uma nova ficha para o usuário que usou o comando.
     """
-    user_id = str(ctx.author.id)
-    if user_id in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você **já tem** uma ficha criada. Use `!ficha` para ver ou `!resetar` para criar uma nova.")
-        return
-    
-    initial_bonus = {attr: 0 for attr in bonus_validos}
-
-    users[user_id] = {
-        "pts_gastos": {attr: 0 for attr in atributos_validos},
-        "bonus": initial_bonus,
-        "status": {attr: 0 for attr in atributos_validos},
-        "pontos": 35,
-        "ranks": {attr: "I" for attr in atributos_validos},
-        "ficha_message_id": None,
-        "ficha_channel_id": None,
-    }
-    atualizar_status(users[user_id])
-    salvar_dados() # Salva os dados após criar a ficha
-    await ctx.send(f":fire: | **Ficha Gerada para {ctx.author.mention}** com **35 pontos** para distribuir.")
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is not None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você **já tem** uma ficha criada. Use `!ficha` para ver ou `!resetar` para criar uma nova.")
+            return
 
-@bot.command()
+        user = Ficha(pontos=35)
+        cache_fichas.criar(user_id, user)
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após criar a ficha
+        registrar_evento(ctx, "criar", user_id, None, user.para_dict())
+        await ctx.send(f":fire: | **Ficha Gerada para {ctx.author.mention}** com **35 pontos** para distribuir.")
+
+@bot.hybrid_command()
+@app_commands.describe(atributo="Atributo que terá o rank alterado", rank="Novo rank do atributo")
+@app_commands.choices(atributo=escolhas_atributos, rank=escolhas_ranks)
 async def setrank(ctx, atributo: str, rank: str):
     """
     Define o rank de um atributo para o usuário.
@@ -253,151 +2853,254 @@ async def setrank(ctx, atributo: str, rank: str):
     """
     atributo = atributo.upper()
     rank = rank.upper()
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
-        return
-    if atributo not in atributos_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido**. Use: `{', '.join(atributos_validos)}`.")
-        return
-    if rank not in rank_limits:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Rank inválido**. Use: `{', '.join(rank_limits.keys())}`.")
-        return
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
+            return
+        if atributo not in atributos_validos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido**. Use: `{', '.join(atributos_validos)}`.")
+            return
+        if rank not in rank_limits:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Rank inválido**. Use: `{', '.join(rank_limits.keys())}`.")
+            return
     
-    # As linhas abaixo foram comentadas/removidas para permitir a diminuição do rank.
-    # old_rank = users[user_id]["ranks"].get(atributo, "I")
-    # if rank_limits[rank] < rank_limits[old_rank]:
-    #     await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode diminuir** o rank de **{atributo}** de **{old_rank}** para **{rank}**.")
-    #     return
-
-    users[user_id]["ranks"][atributo] = rank
-    atualizar_status(users[user_id])
-    salvar_dados() # Salva os dados após alterar o rank
-    await ctx.send(f":trophy: | **{ctx.author.mention}**, Rank do atributo **{atributo}** definido para **{rank}**.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+        # As linhas abaixo foram comentadas/removidas para permitir a diminuição do rank.
+        # old_rank = user.rank(atributo)
+        # if rank_limits[rank] < rank_limits[old_rank]:
+        #     await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode diminuir** o rank de **{atributo}** de **{old_rank}** para **{rank}**.")
+        #     return
 
-@bot.command()
+        antes = user.para_dict()
+        user.ranks[indice_atributo[atributo]] = rank_limits[rank]
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após alterar o rank
+        registrar_evento(ctx, "setrank", user_id, antes, user.para_dict(), atributo=atributo, rank=rank)
+        agendar_atualizacao_ficha(ctx, user_id, f":trophy: | **{ctx.author.mention}**, Rank do atributo **{atributo}** definido para **{rank}**.")
+
+@bot.hybrid_command()
+@app_commands.describe(atributo="Atributo que recebe os pontos", valor="Quantos pontos livres gastar nele")
+@app_commands.choices(atributo=escolhas_atributos)
+@app_commands.autocomplete(valor=_autocompletar_add)
 async def add(ctx, atributo: str, valor: int):
     """
     Adiciona pontos a um atributo do usuário.
     Ex: !add FOR 5
     """
     atributo = atributo.upper()
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
-        return
-    if atributo not in atributos_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido** para adicionar pontos. Use: `{', '.join(atributos_validos)}`.")
-        return
-    if valor <= 0:
-        await ctx.send(f":x: | **{ctx.author.mention}**, o valor a ser adicionado deve ser **positivo**.")
-        return
-    user = users[user_id]
-    if valor > user["pontos"]:
-        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem pontos suficientes. Pontos disponíveis: **{user['pontos']}**.")
-        return
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
+            return
+        if atributo not in atributos_validos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido** para adicionar pontos. Use: `{', '.join(atributos_validos)}`.")
+            return
+        if valor <= 0:
+            await ctx.send(f":x: | **{ctx.author.mention}**, o valor a ser adicionado deve ser **positivo**.")
+            return
+        if valor > user.pontos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, você não tem pontos suficientes. Pontos disponíveis: **{user.pontos}**.")
+            return
 
-    temp_pts_gastos = user["pts_gastos"].copy()
-    temp_pts_gastos[atributo] += valor
-    
-    temp_status = {attr: 0 for attr in atributos_validos}
-    temp_bonus_base = {k: v for k, v in user["bonus"].items() if k in atributos_validos}
-
-    for key in atributos_validos:
-        temp_status[key] = temp_bonus_base.get(key, 0)
-
-    for attr_calc, pts_calc in temp_pts_gastos.items():
-        if attr_calc == "DEF":
-            temp_status["DEF"] += pts_calc * 1
-            temp_status["RES"] += pts_calc * 1
-        elif attr_calc == "RES":
-            temp_status["RES"] += pts_calc * 2
-            temp_status["HP"] += pts_calc * 2
-        elif attr_calc == "INT":
-            temp_status["INT"] += pts_calc * 2
-        elif attr_calc == "AGI":
-            temp_status["AGI"] += pts_calc * 2
-            temp_status["VEL"] += pts_calc * 1
-        elif attr_calc == "VEL":
-            temp_status["VEL"] += pts_calc * 2
-            temp_status["AGI"] += pts_calc * 1
-        elif attr_calc == "HP":
-            temp_status["HP"] += pts_calc * 5
-            temp_status["RES"] += pts_calc * 2
-        elif attr_calc == "FOR":
-            temp_status["FOR"] += pts_calc * 4
-            temp_status["RES"] += pts_calc * 4
-            temp_status["DEF"] += (pts_calc // 5) * 1
-        elif attr_calc == "MAG":
-            temp_status["MAG"] += pts_calc * 2
-        elif attr_calc == "DMG":
-            temp_status["DMG"] += pts_calc * 2
-            temp_status["FOR"] += pts_calc * 2
-            temp_status["MAG"] += pts_calc * 1
-
-    rank = user["ranks"].get(atributo, "I")
-    limite = atributos_com_limite[atributo][rank]
-
-    if temp_status[atributo] > limite and atributo in atributos_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, adicionar **{valor}** pontos em **{atributo}** faria você ultrapassar o limite de **{limite}** para o seu rank **{rank}** neste atributo. Tente um valor menor ou aumente seu rank.")
-        return
+        i = indice_atributo[atributo]
+        if not cabe_na_ficha(user.pts_gastos[i] + valor):
+            await ctx.send(f":x: | **{ctx.author.mention}**, **{atributo}** não pode ter mais de **{LIMITE_VALOR_FICHA}** pontos gastos.")
+            return
+        temp_pts_gastos = array("i", user.pts_gastos)
+        temp_pts_gastos[i] += valor
+        # Simula o status com os pontos novos, sem os limites de rank, para ver se o atributo passaria do limite
+        temp_status = calcular_status(temp_pts_gastos, user.bonus, user.ranks, limitar=False)
 
-    user["pts_gastos"][atributo] += valor
-    user["pontos"] -= valor
-    atualizar_status(user)
-    salvar_dados() # Salva os dados após adicionar pontos
-    await ctx.send(f":sparkles: | **{ctx.author.mention}**, adicionado **{valor}** pontos em **{atributo}**. Pontos restantes: **{user['pontos']}**.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+        rank = user.rank(atributo)
+        limite = atributos_com_limite[atributo][rank]
 
-@bot.command()
+        if temp_status[i] > limite:
+            await ctx.send(f":x: | **{ctx.author.mention}**, adicionar **{valor}** pontos em **{atributo}** faria você ultrapassar o limite de **{limite}** para o seu rank **{rank}** neste atributo. Tente um valor menor ou aumente seu rank.")
+            return
+
+        antes = user.para_dict()
+        user.pts_gastos[i] += valor
+        user.pontos -= valor
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após adicionar pontos
+        registrar_evento(ctx, "add", user_id, antes, user.para_dict(), atributo=atributo, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":sparkles: | **{ctx.author.mention}**, adicionado **{valor}** pontos em **{atributo}**. Pontos restantes: **{user.pontos}**.")
+
+@bot.hybrid_command()
+@app_commands.describe(atributo="Atributo de onde os pontos saem", valor="Quantos pontos gastos devolver")
+@app_commands.choices(atributo=escolhas_atributos)
+@app_commands.autocomplete(valor=_autocompletar_remover)
 async def remover(ctx, atributo: str, valor: int):
     """
     Remove pontos de um atributo do usuário.
     Ex: !remover FOR 2
     """
     atributo = atributo.upper()
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
-        return
-    if atributo not in atributos_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido** para remover pontos gastos. Use: `{', '.join(atributos_validos)}`.")
-        return
-    if valor <= 0:
-        await ctx.send(f":x: | **{ctx.author.mention}**, o valor a ser removido deve ser **positivo**.")
-        return
-    user = users[user_id]
-    if valor > user["pts_gastos"][atributo]:
-        await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode remover mais** do que gastou em **{atributo}** (atualmente **{user['pts_gastos'][atributo]}**).")
-        return
-    user["pts_gastos"][atributo] -= valor
-    user["pontos"] += valor
-    atualizar_status(user)
-    salvar_dados() # Salva os dados após remover pontos
-    await ctx.send(f":scissors: | **{ctx.author.mention}**, removido **{valor}** pontos de **{atributo}**. Pontos disponíveis: **{user['pontos']}**.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
+            return
+        if atributo not in atributos_validos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido** para remover pontos gastos. Use: `{', '.join(atributos_validos)}`.")
+            return
+        if valor <= 0:
+            await ctx.send(f":x: | **{ctx.author.mention}**, o valor a ser removido deve ser **positivo**.")
+            return
+        i = indice_atributo[atributo]
+        if valor > user.pts_gastos[i]:
+            await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode remover mais** do que gastou em **{atributo}** (atualmente **{user.pts_gastos[i]}**).")
+            return
+        antes = user.para_dict()
+        user.pts_gastos[i] -= valor
+        user.pontos += valor
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após remover pontos
+        registrar_evento(ctx, "remover", user_id, antes, user.para_dict(), atributo=atributo, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":scissors: | **{ctx.author.mention}**, removido **{valor}** pontos de **{atributo}**. Pontos disponíveis: **{user.pontos}**.")
+
+def _ler_alocacoes(argumentos):
+    """
+    Lê argumentos no formato ATRIBUTO=valor (ex: FOR=10 AGI=5) em {atributo: valor}, somando atributos repetidos.
+    Retorna (alocações, None) ou (None, o motivo do erro).
+    """
+    alocacoes = {}
+    for argumento in argumentos:
+        atributo, separador, valor = argumento.partition("=")
+        atributo = atributo.upper()
+        if not separador or atributo not in atributos_validos:
+            return None, f"`{argumento}` não é válido. Use `ATRIBUTO=valor` com os atributos: `{', '.join(atributos_validos)}`"
+        try:
+            valor = int(valor)
+        except ValueError:
+            return None, f"o valor de **{atributo}** deve ser um número inteiro"
+        if valor <= 0:
+            return None, f"o valor de **{atributo}** deve ser **positivo**"
+        alocacoes[atributo] = alocacoes.get(atributo, 0) + valor
+    return alocacoes, None
+
+@bot.command()
+async def distribuir(ctx, *argumentos: str):
+    """
+    Adiciona pontos em vários atributos de uma vez, com uma única verificação dos limites de rank.
+    Ex: !distribuir FOR=10 AGI=5 VEL=5
+    """
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
+            return
+        if not argumentos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!distribuir FOR=10 AGI=5 ...`")
+            return
+        alocacoes, erro = _ler_alocacoes(argumentos)
+        if erro:
+            await ctx.send(f":x: | **{ctx.author.mention}**, {erro}.")
+            return
+        total = sum(alocacoes.values())
+        if total > user.pontos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, você não tem pontos suficientes para distribuir **{total}**. Pontos disponíveis: **{user.pontos}**.")
+            return
+        if not cabe_na_ficha(*(user.pts_gastos[indice_atributo[atributo]] + valor for atributo, valor in alocacoes.items())):
+            await ctx.send(f":x: | **{ctx.author.mention}**, nenhum atributo pode ter mais de **{LIMITE_VALOR_FICHA}** pontos gastos.")
+            return
+
+        temp_pts_gastos = array("i", user.pts_gastos)
+        for atributo, valor in alocacoes.items():
+            temp_pts_gastos[indice_atributo[atributo]] += valor
+        # Simula o status com todos os pontos novos de uma vez. O status só cresce com os pontos, então uma
+        # distribuição que passa aqui passaria também como uma sequência de !add, em qualquer ordem
+        temp_status = calcular_status(temp_pts_gastos, user.bonus, user.ranks, limitar=False)
+
+        excedidos = []
+        for atributo in alocacoes:
+            rank = user.rank(atributo)
+            limite = atributos_com_limite[atributo][rank]
+            if temp_status[indice_atributo[atributo]] > limite:
+                excedidos.append(f"**{atributo}** (limite **{limite}** no rank **{rank}**)")
+        if excedidos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, essa distribuição faria você ultrapassar o limite em {', '.join(excedidos)}. Nenhum ponto foi distribuído; tente valores menores ou aumente seus ranks.")
+            return
+
+        antes = user.para_dict()
+        user.pts_gastos[:] = temp_pts_gastos
+        user.pontos -= total
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados uma única vez para toda a distribuição
+        registrar_evento(ctx, "distribuir", user_id, antes, user.para_dict(), **alocacoes)
+        distribuicao = ", ".join(f"**{valor}** em **{atributo}**" for atributo, valor in alocacoes.items())
+        agendar_atualizacao_ficha(ctx, user_id, f":sparkles: | **{ctx.author.mention}**, distribuído {distribuicao}. Pontos restantes: **{user.pontos}**.")
 
 @bot.command()
+async def removermulti(ctx, *argumentos: str):
+    """
+    Remove pontos gastos de vários atributos de uma vez.
+    Ex: !removermulti FOR=2 AGI=1
+    """
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você precisa criar sua ficha primeiro com `!criar`.")
+            return
+        if not argumentos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!removermulti FOR=2 AGI=1 ...`")
+            return
+        alocacoes, erro = _ler_alocacoes(argumentos)
+        if erro:
+            await ctx.send(f":x: | **{ctx.author.mention}**, {erro}.")
+            return
+        excedidos = [
+            f"**{atributo}** (atualmente **{user.pts_gastos[indice_atributo[atributo]]}**)"
+            for atributo, valor in alocacoes.items() if valor > user.pts_gastos[indice_atributo[atributo]]
+        ]
+        if excedidos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode remover mais** do que gastou em {', '.join(excedidos)}. Nenhum ponto foi removido.")
+            return
+
+        antes = user.para_dict()
+        for atributo, valor in alocacoes.items():
+            user.pts_gastos[indice_atributo[atributo]] -= valor
+        user.pontos += sum(alocacoes.values())
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados uma única vez para toda a remoção
+        registrar_evento(ctx, "removermulti", user_id, antes, user.para_dict(), **alocacoes)
+        remocao = ", ".join(f"**{valor}** de **{atributo}**" for atributo, valor in alocacoes.items())
+        agendar_atualizacao_ficha(ctx, user_id, f":scissors: | **{ctx.author.mention}**, removido {remocao}. Pontos disponíveis: **{user.pontos}**.")
+
+@bot.hybrid_command()
+@app_commands.describe(atributo="Atributo ou status que recebe o bônus", valor="Valor do bônus")
+@app_commands.choices(atributo=escolhas_bonus)
 async def addbonus(ctx, atributo: str, valor: int):
     """
     Adiciona um bônus direto a um atributo ou status calculado.
     Ex: !addbonus LOCOMOCAO 1
     """
     atributo = atributo.upper()
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, crie sua ficha primeiro com `!criar`.")
-        return
-    if atributo not in bonus_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo ou status inválido** para adicionar bônus. Use: `{', '.join(bonus_validos)}`.")
-        return
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, crie sua ficha primeiro com `!criar`.")
+            return
+        if atributo not in bonus_validos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo ou status inválido** para adicionar bônus. Use: `{', '.join(bonus_validos)}`.")
+            return
+        if not cabe_na_ficha(user.bonus[indice_atributo[atributo]] + valor):
+            await ctx.send(f":x: | **{ctx.author.mention}**, o bônus em **{atributo}** deve ficar entre **-{LIMITE_VALOR_FICHA}** e **{LIMITE_VALOR_FICHA}**.")
+            return
     
-    users[user_id]["bonus"][atributo] += valor
-    atualizar_status(users[user_id])
-    salvar_dados() # Salva os dados após adicionar bônus
-    await ctx.send(f":gift: | **{ctx.author.mention}**, bônus de **+{valor}** adicionado em **{atributo}**.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+        antes = user.para_dict()
+        user.bonus[indice_atributo[atributo]] += valor
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após adicionar bônus
+        registrar_evento(ctx, "addbonus", user_id, antes, user.para_dict(), atributo=atributo, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":gift: | **{ctx.author.mention}**, bônus de **+{valor}** adicionado em **{atributo}**.")
 
 @bot.command()
 async def removerbonus(ctx, atributo: str, valor: int):
@@ -406,96 +3109,355 @@ async def removerbonus(ctx, atributo: str, valor: int):
     Ex: !removerbonus KRITOS 5
     """
     atributo = atributo.upper()
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, crie sua ficha primeiro com `!criar`.")
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, crie sua ficha primeiro com `!criar`.")
+            return
+        if atributo not in bonus_validos:
+            await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo ou status inválido** para remover bônus. Use: `{', '.join(bonus_validos)}`.")
+            return
+    
+        i = indice_atributo[atributo]
+        if user.bonus[i] - valor < 0:
+            await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode remover mais bônus** do que possui em **{atributo}** (atualmente **{user.bonus[i]}**).")
+            return
+        if not cabe_na_ficha(user.bonus[i] - valor):
+            await ctx.send(f":x: | **{ctx.author.mention}**, o bônus em **{atributo}** deve ficar entre **-{LIMITE_VALOR_FICHA}** e **{LIMITE_VALOR_FICHA}**.")
+            return
+
+        antes = user.para_dict()
+        user.bonus[i] -= valor
+        atualizar_status(user)
+        salvar_dados(user_id, user) # Salva os dados após remover bônus
+        registrar_evento(ctx, "removerbonus", user_id, antes, user.para_dict(), atributo=atributo, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":wastebasket: | **{ctx.author.mention}**, bônus de **-{valor}** removido de **{atributo}**.")
+
+# Alvo do !addpontos e do !removerpontos: um membro, ou várias fichas de uma vez (um cargo, as fichas com
+# mensagem em um canal ou "todos")
+AlvoPontos = typing.Union[discord.Member, discord.Role, discord.TextChannel, str]
+
+async def _fichas_do_alvo(ctx, alvo):
+    """
+    Chaves das fichas de um alvo em massa e a descrição dele para o resumo, ou (None, None) se 'alvo'
+    não é um cargo, um canal ou "todos".
+    """
+    if isinstance(alvo, discord.Role):
+        if not ctx.guild.chunked:
+            await ctx.guild.chunk() # Sem a lista de membros em memória, o cargo pareceria vazio
+        return [chave_ficha(ctx.guild, membro.id) for membro in alvo.members], f"cargo **{alvo.name}**"
+    if isinstance(alvo, discord.TextChannel):
+        return list(indice_mensagens.por_canal.get(alvo.id, {}).values()), f"fichas em {alvo.mention}"
+    if isinstance(alvo, str) and alvo.lower() == "todos":
+        return sorted(await cache_fichas.listar_ids_sem_bloquear(ctx.guild.id if ctx.guild else 0)), "todas as fichas"
+    return None, None
+
+async def alterar_pontos_em_massa(ctx, alvo, valor):
+    """
+    Soma 'valor' (negativo para remover) aos pontos livres de todas as fichas do alvo em uma passada, grava
+    todas em uma única escrita e reedita as mensagens delas em segundo plano, com um só resumo no chat.
+    Fichas sem pontos livres suficientes para a remoção ficam como estão.
+    """
+    if isinstance(alvo, discord.Role) and not intents.members:
+        await ctx.send(
+            f":x: | **{ctx.author.mention}**, o bot não está recebendo a lista de membros do servidor, então não "
+            "dá para saber quem tem o cargo. Quem hospeda o bot precisa ativar a \"Server Members Intent\" no portal "
+            "do Discord e iniciá-lo com `FICHAS_INTENT_MEMBROS=1`. Enquanto isso, use um canal ou `todos`."
+        )
         return
-    if atributo not in bonus_validos:
-        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo ou status inválido** para remover bônus. Use: `{', '.join(bonus_validos)}`.")
+    chaves, descricao = await _fichas_do_alvo(ctx, alvo)
+    if chaves is None:
+        await ctx.send(f":x: | **{ctx.author.mention}**, mencione um membro, um cargo ou um canal, ou use `todos`.")
         return
-    
-    if users[user_id]["bonus"][atributo] - valor < 0:
-        await ctx.send(f":x: | **{ctx.author.mention}**, você **não pode remover mais bônus** do que possui em **{atributo}** (atualmente **{users[user_id]['bonus'][atributo]}**).")
+    alteradas = []
+    sem_pontos = no_maximo = 0
+    acao = "addpontos" if valor > 0 else "removerpontos"
+    for inicio in range(0, len(chaves), LOTE_RECALCULO):
+        # As fichas de cada lote são lidas fora do loop; dentro do lote, sem disputa, a trava não cede o loop
+        for user_id in await cache_fichas.carregar_varias(chaves[inicio:inicio + LOTE_RECALCULO]):
+            async with travas_usuarios.trava(user_id):
+                user = cache_fichas.obter(user_id)
+                if user is None:
+                    continue
+                if user.pontos + valor < 0:
+                    sem_pontos += 1
+                    continue
+                if not cabe_na_ficha(user.pontos + valor):
+                    no_maximo += 1
+                    continue
+                user.pontos += valor
+                salvar_dados(user_id, user)
+                # Só os pontos mudam: a ficha de antes sai da de depois, sem converter a ficha duas vezes
+                depois = user.para_dict()
+                registrar_evento(ctx, acao, user_id, dict(depois, pontos=user.pontos - valor), depois, valor=abs(valor), alvo=descricao)
+                alteradas.append(user_id)
+    await persistencia.descarregar()
+
+    if valor > 0:
+        texto = f":moneybag: | **{valor}** pontos extras adicionados para **{len(alteradas)}** fichas ({descricao})."
+    else:
+        texto = f":dollar: | **{-valor}** pontos removidos de **{len(alteradas)}** fichas ({descricao})."
+    if sem_pontos:
+        texto += f" **{sem_pontos}** não tinham pontos livres suficientes e ficaram como estavam."
+    if no_maximo:
+        texto += f" **{no_maximo}** passariam do máximo de **{LIMITE_VALOR_FICHA}** pontos livres e ficaram como estavam."
+    com_mensagem = [user_id for user_id in alteradas if user_id in indice_mensagens.por_usuario]
+    if not com_mensagem:
+        await ctx.send(texto)
         return
+    resumo = await ctx.send(f"{texto}\n:hourglass: | Atualizando as mensagens das fichas: 0/{len(com_mensagem)}.")
+    asyncio.create_task(_reeditar_em_massa(resumo, texto, com_mensagem))
+
+async def _reeditar_em_massa(resumo, texto, user_ids):
+    """Reedita as fichas de uma alteração em massa no ritmo do recálculo, mostrando o andamento no resumo."""
+    def mostrar(linha):
+        despachante.disparar(resumo.channel.id, PRIORIDADE_CONFIRMACAO, "editar", functools.partial(resumo.edit, content=f"{texto}\n{linha}"))
 
-    users[user_id]["bonus"][atributo] -= valor
-    atualizar_status(users[user_id])
-    salvar_dados() # Salva os dados após remover bônus
-    await ctx.send(f":wastebasket: | **{ctx.author.mention}**, bônus de **-{valor}** removido de **{atributo}**.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+    async def mostrar_andamento(progresso):
+        mostrar(f":hourglass: | Atualizando as mensagens das fichas: {progresso['editadas']}/{len(user_ids)}.")
+
+    try:
+        editadas, _ = await reeditar_fichas({"editar": user_ids, "editadas": 0}, mostrar_andamento)
+        mostrar(f":white_check_mark: | **{editadas}** mensagens de ficha atualizadas.")
+    except Exception as e:
+        print(f"Erro ao atualizar as fichas de uma alteração em massa: {e}")
+        metricas.contar("erros_total", origem="em_massa")
 
 @bot.command()
 @commands.has_permissions(manage_messages=True) # Permissão para gerenciar mensagens, comum para moderadores
-async def addpontos(ctx, membro: discord.Member, valor: int):
+async def addpontos(ctx, alvo: AlvoPontos, valor: int):
     """
-    Adiciona pontos livres para um membro específico. (Comando para moderadores)
-    Uso: !addpontos @membro <valor>
+    Adiciona pontos livres para um membro, para os membros de um cargo, para as fichas com mensagem em um
+    canal ou para todas as fichas do servidor. (Comando para moderadores)
+    Uso: !addpontos <@membro | @cargo | #canal | todos> <valor>
     """
-    user_id = str(membro.id)
-    if user_id not in users:
-        await ctx.send(f":x: | O usuário **{membro.display_name}** não tem uma ficha criada.")
-        return
-    if valor <= 0:
-        await ctx.send(":x: | O valor a ser adicionado deve ser **positivo**.")
+    if not isinstance(alvo, discord.Member):
+        if valor <= 0:
+            await ctx.send(":x: | O valor a ser adicionado deve ser **positivo**.")
+            return
+        await alterar_pontos_em_massa(ctx, alvo, valor)
         return
-    users[user_id]["pontos"] += valor
-    salvar_dados() # Salva os dados após adicionar pontos
-    await ctx.send(f":moneybag: | **{valor}** pontos extras adicionados para **{membro.display_name}**. Ele(a) agora tem **{users[user_id]['pontos']}** pontos livres.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+    membro = alvo
+    user_id = chave_ficha(ctx.guild, membro.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":x: | O usuário **{membro.display_name}** não tem uma ficha criada.")
+            return
+        if valor <= 0:
+            await ctx.send(":x: | O valor a ser adicionado deve ser **positivo**.")
+            return
+        if not cabe_na_ficha(user.pontos + valor):
+            await ctx.send(f":x: | **{membro.display_name}** não pode ter mais de **{LIMITE_VALOR_FICHA}** pontos livres. Ele(a) possui **{user.pontos}**.")
+            return
+        user.pontos += valor
+        salvar_dados(user_id, user) # Salva os dados após adicionar pontos
+        depois = user.para_dict()
+        registrar_evento(ctx, "addpontos", user_id, dict(depois, pontos=user.pontos - valor), depois, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":moneybag: | **{valor}** pontos extras adicionados para **{membro.display_name}**. Ele(a) agora tem **{user.pontos}** pontos livres.")
 
 @addpontos.error
 async def addpontos_error(ctx, error):
     if isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!addpontos @membro <valor>`")
+        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!addpontos <@membro | @cargo | #canal | todos> <valor>`")
     elif isinstance(error, commands.BadArgument):
-        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro válido e forneça um número para o valor.")
+        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro, cargo ou canal válido (ou use `todos`) e forneça um número para o valor.")
     elif isinstance(error, commands.MissingPermissions):
         await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas moderadores podem adicionar pontos.")
 
 
 @bot.command()
 @commands.has_permissions(manage_messages=True) # Permissão para gerenciar mensagens, comum para moderadores
-async def removerpontos(ctx, membro: discord.Member, valor: int):
+async def removerpontos(ctx, alvo: AlvoPontos, valor: int):
     """
-    Remove pontos livres de um membro específico. (Comando para moderadores)
-    Uso: !removerpontos @membro <valor>
+    Remove pontos livres de um membro, dos membros de um cargo, das fichas com mensagem em um canal ou
+    de todas as fichas do servidor. (Comando para moderadores)
+    Uso: !removerpontos <@membro | @cargo | #canal | todos> <valor>
     """
-    user_id = str(membro.id)
-    if user_id not in users:
-        await ctx.send(f":x: | O usuário **{membro.display_name}** não tem uma ficha criada.")
-        return
-    if valor <= 0:
-        await ctx.send(":x: | O valor a ser removido deve ser **positivo**.")
+    if not isinstance(alvo, discord.Member):
+        if valor <= 0:
+            await ctx.send(":x: | O valor a ser removido deve ser **positivo**.")
+            return
+        await alterar_pontos_em_massa(ctx, alvo, -valor)
         return
+    membro = alvo
+    user_id = chave_ficha(ctx.guild, membro.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":x: | O usuário **{membro.display_name}** não tem uma ficha criada.")
+            return
+        if valor <= 0:
+            await ctx.send(":x: | O valor a ser removido deve ser **positivo**.")
+            return
     
-    if users[user_id]["pontos"] < valor:
-        await ctx.send(f":x: | **{membro.display_name}** não tem pontos suficientes para remover. Ele(a) possui **{users[user_id]['pontos']}** pontos livres.")
-        return
+        if user.pontos < valor:
+            await ctx.send(f":x: | **{membro.display_name}** não tem pontos suficientes para remover. Ele(a) possui **{user.pontos}** pontos livres.")
+            return
 
-    users[user_id]["pontos"] -= valor
-    salvar_dados() # Salva os dados após remover pontos
-    await ctx.send(f":dollar: | **{valor}** pontos removidos de **{membro.display_name}**. Ele(a) agora tem **{users[user_id]['pontos']}** pontos livres.")
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+        user.pontos -= valor
+        salvar_dados(user_id, user) # Salva os dados após remover pontos
+        depois = user.para_dict()
+        registrar_evento(ctx, "removerpontos", user_id, dict(depois, pontos=user.pontos + valor), depois, valor=valor)
+        agendar_atualizacao_ficha(ctx, user_id, f":dollar: | **{valor}** pontos removidos de **{membro.display_name}**. Ele(a) agora tem **{user.pontos}** pontos livres.")
 
 @removerpontos.error
 async def removerpontos_error(ctx, error):
     if isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!removerpontos @membro <valor>`")
+        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!removerpontos <@membro | @cargo | #canal | todos> <valor>`")
     elif isinstance(error, commands.BadArgument):
-        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro válido e forneça um número para o valor.")
+        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro, cargo ou canal válido (ou use `todos`) e forneça um número para o valor.")
     elif isinstance(error, commands.MissingPermissions):
         await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas moderadores podem remover pontos.")
 
 @bot.command()
+@commands.has_permissions(administrator=True)
+async def recalcular(ctx):
+    """
+    Recalcula o status de todas as fichas e atualiza as mensagens das que mudaram. (Comando para administradores)
+    Use depois de mudar os limites de rank ou as fórmulas dos atributos.
+    Uso: !recalcular
+    """
+    if _trava_recalculo.locked():
+        await ctx.send(f":information_source: | **{ctx.author.mention}**, já existe um recálculo em andamento.")
+        return
+    await executar_recalculo(ctx.channel)
+
+@recalcular.error
+async def recalcular_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas administradores podem recalcular as fichas.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True) # Permissão para gerenciar mensagens, comum para moderadores
+async def metrics(ctx):
+    """
+    Mostra o tempo gasto pelos comandos, as chamadas ao Discord e as gravações das fichas. (Comando para moderadores)
+    Uso: !metrics
+    """
+    if not metricas.ativo:
+        await ctx.send(f":information_source: | **{ctx.author.mention}**, as métricas estão desligadas (FICHAS_METRICAS=0).")
+        return
+    texto = resumo_metricas()
+    if len(texto) > 1900:
+        texto = texto[:1900] + "\n..." # Limite de 2000 caracteres por mensagem do Discord
+    await ctx.send(f":bar_chart: | **Métricas do bot**\n```\n{texto}\n```")
+
+@metrics.error
+async def metrics_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions):
+        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas moderadores podem ver as métricas.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True) # Permissão para gerenciar mensagens, comum para moderadores
+async def top(ctx, atributo: str, quantidade: int = 10):
+    """
+    Mostra as fichas da guild com os maiores valores em um atributo. (Comando para moderadores)
+    Uso: !top <atributo> [quantidade]
+    Ex: !top FOR ou !top KRITOS 20
+    """
+    atributo = atributo.upper()
+    if atributo not in bonus_validos:
+        await ctx.send(f":x: | **{ctx.author.mention}**, **Atributo inválido** para o ranking. Use: `{', '.join(bonus_validos)}`.")
+        return
+    quantidade = max(1, min(quantidade, LIMITE_TOP))
+    ranking = await ranking_fichas.obter(ctx.guild.id if ctx.guild else 0)
+    linhas = [f"**{posicao}.** <@{user_id}>: **{valor}**" for posicao, user_id, valor in ranking.top(indice_atributo[atributo], quantidade)]
+    if not linhas:
+        await ctx.send(f":information_source: | **{ctx.author.mention}**, ainda não há fichas neste servidor.")
+        return
+    # As menções só identificam os jogadores, sem notificá-los
+    await ctx.send(
+        f":trophy: | **Top {len(linhas)} em {atributo}** ({len(ranking)} fichas):\n" + "\n".join(linhas),
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+@top.error
+async def top_error(ctx, error):
+    if isinstance(error, commands.MissingRequiredArgument):
+        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!top <atributo> [quantidade]`")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send(f":x: | **{ctx.author.mention}**, a quantidade deve ser um número.")
+    elif isinstance(error, commands.MissingPermissions):
+        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas moderadores podem ver os rankings.")
+
+@bot.command()
+@commands.has_permissions(manage_messages=True) # Permissão para gerenciar mensagens, comum para moderadores
+async def rank(ctx, membro: discord.Member = None):
+    """
+    Mostra o valor e a posição de um membro em cada atributo do ranking da guild. (Comando para moderadores)
+    Uso: !rank [@membro] (sem membro, mostra o seu)
+    """
+    membro = membro or ctx.author
+    user_id = chave_ficha(ctx.guild, membro.id)
+    ranking = await ranking_fichas.obter(ctx.guild.id if ctx.guild else 0)
+    posicoes = ranking.posicoes(membro.id)
+    if posicoes is None:
+        # Uma ficha do formato antigo só entra na guild (e no ranking) quando é usada pela primeira vez
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":x: | O usuário **{membro.display_name}** não tem uma ficha criada.")
+            return
+        ranking_fichas.atualizar(user_id, user)
+        posicoes = ranking.posicoes(membro.id)
+    linhas = [f"**{atributo}**: {valor} (#{posicao})" for atributo, (valor, posicao) in zip(bonus_validos, posicoes)]
+    await ctx.send(f":medal: | **Ranking de {membro.display_name}** entre {len(ranking)} fichas:\n" + "\n".join(linhas))
+
+@rank.error
+async def rank_error(ctx, error):
+    if isinstance(error, commands.BadArgument):
+        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro válido.")
+    elif isinstance(error, commands.MissingPermissions):
+        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas moderadores podem ver os rankings.")
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def historico(ctx, membro: discord.Member, quantidade: int = 10):
+    """
+    Mostra as últimas alterações da ficha de um membro: quando, por quem e com qual comando. (Comando para administradores)
+    Uso: !historico @membro [quantidade]
+    """
+    quantidade = max(1, min(quantidade, LIMITE_HISTORICO))
+    user_id = chave_ficha(ctx.guild, membro.id)
+    await registro_eventos.descarregar() # Inclui os eventos que ainda estão na fila
+    eventos = await asyncio.to_thread(registro_eventos.historico, user_id, quantidade)
+    if not eventos:
+        await ctx.send(f":information_source: | Não há alterações registradas na ficha de **{membro.display_name}**.")
+        return
+    linhas = []
+    for evento in eventos:
+        detalhes = ", ".join(f"{nome} {valor}" for nome, valor in evento["detalhes"].items())
+        linhas.append(
+            f"`{datetime.datetime.fromtimestamp(evento['ts']):%d/%m/%Y %H:%M:%S}` **!{evento['acao']}** por <@{evento['autor']}>"
+            + (f": {detalhes}" if detalhes else "")
+        )
+    # As menções só identificam quem fez cada alteração, sem notificar ninguém
+    await ctx.send(
+        f":scroll: | **Últimas {len(linhas)} alterações da ficha de {membro.display_name}**:\n" + "\n".join(linhas),
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+@historico.error
+async def historico_error(ctx, error):
+    if isinstance(error, commands.MissingRequiredArgument):
+        await ctx.send(f":x: | **{ctx.author.mention}**, uso correto: `!historico @membro [quantidade]`")
+    elif isinstance(error, commands.BadArgument):
+        await ctx.send(f":x: | **{ctx.author.mention}**, por favor, mencione um membro válido e forneça um número para a quantidade.")
+    elif isinstance(error, commands.MissingPermissions):
+        await ctx.send(f":x: | **{ctx.author.mention}**, você não tem permissão para usar este comando. Apenas administradores podem ver o histórico das fichas.")
+
+@bot.hybrid_command()
 async def ficha(ctx):
     """
     Exibe a ficha do usuário que usou o comando.
     """
-    user_id = str(ctx.author.id)
-    if user_id not in users:
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    user = await cache_fichas.obter_sem_bloquear(user_id)
+    if user is None:
         await ctx.send(f":information_source: | **{ctx.author.mention}**, você não tem ficha criada. Use `!criar` para criar uma.")
         return
-    await enviar_ou_atualizar_ficha(ctx, user_id)
+    agendar_atualizacao_ficha(ctx, user_id)
 
 @bot.command()
 async def apagar(ctx):
@@ -503,71 +3465,167 @@ async def apagar(ctx):
     Apaga a mensagem da sua ficha do chat, mas mantém seus dados salvos.
     Útil se a ficha for enviada no canal errado.
     """
-    user_id = str(ctx.author.id)
-    if user_id not in users:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você não tem uma ficha criada para apagar.")
-        return
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is None:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você não tem uma ficha criada para apagar.")
+            return
 
-    user_data = users[user_id]
-    ficha_channel_id = user_data.get("ficha_channel_id")
-    ficha_message_id = user_data.get("ficha_message_id")
+        ficha_channel_id = user.ficha_channel_id
+        ficha_message_id = user.ficha_message_id
 
-    if ficha_channel_id and ficha_message_id:
-        try:
-            channel = bot.get_channel(ficha_channel_id)
-            if channel:
-                message = await channel.fetch_message(ficha_message_id)
-                await message.delete()
-                # Zera as IDs para que o bot envie uma nova ficha na próxima vez, mas os dados permanecem salvos
-                user_data["ficha_message_id"] = None
-                user_data["ficha_channel_id"] = None
-                salvar_dados() # Salva o estado atualizado (IDs zeradas)
-                await ctx.send(f":broom: | **{ctx.author.mention}**, a mensagem da sua ficha foi apagada do chat.")
-            else:
-                await ctx.send(f":x: | **{ctx.author.mention}**, não consegui encontrar o canal da sua ficha para apagar a mensagem. Seus dados continuam salvos.")
-        except discord.NotFound:
-            await ctx.send(f":x: | **{ctx.author.mention}**, a mensagem da sua ficha não foi encontrada no chat (talvez já tenha sido apagada). Seus dados continuam salvos.")
-            # Zera as IDs para que o bot envie uma nova ficha na próxima vez
-            user_data["ficha_message_id"] = None
-            user_data["ficha_channel_id"] = None
-            salvar_dados() # Salva o estado atualizado (IDs zeradas)
-        except discord.Forbidden:
-            await ctx.send(f":x: | **{ctx.author.mention}**, o bot não tem permissão para apagar mensagens neste canal. Por favor, verifique as permissões do bot.")
-        except Exception as e:
-            await ctx.send(f":x: | **{ctx.author.mention}**, ocorreu um erro ao tentar apagar sua ficha: `{e}`")
-            print(f"Erro ao apagar ficha para {ctx.author.id}: {e}")
-    else:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, não há uma mensagem de ficha registrada para você apagar. Use `!ficha` para enviá-la novamente.")
+        if ficha_channel_id and ficha_message_id:
+            try:
+                channel = bot.get_channel(ficha_channel_id)
+                if channel:
+                    with metricas.chamada_discord("apagar"):
+                        await channel.get_partial_message(ficha_message_id).delete()
+                    # Zera as IDs para que o bot envie uma nova ficha na próxima vez, mas os dados permanecem salvos
+                    _esquecer_mensagem_ficha(user_id, user)
+                    salvar_dados(user_id, user) # Salva o estado atualizado (IDs zeradas)
+                    await ctx.send(f":broom: | **{ctx.author.mention}**, a mensagem da sua ficha foi apagada do chat.")
+                else:
+                    await ctx.send(f":x: | **{ctx.author.mention}**, não consegui encontrar o canal da sua ficha para apagar a mensagem. Seus dados continuam salvos.")
+            except discord.NotFound:
+                await ctx.send(f":x: | **{ctx.author.mention}**, a mensagem da sua ficha não foi encontrada no chat (talvez já tenha sido apagada). Seus dados continuam salvos.")
+                # Zera as IDs para que o bot envie uma nova ficha na próxima vez
+                _esquecer_mensagem_ficha(user_id, user)
+                salvar_dados(user_id, user) # Salva o estado atualizado (IDs zeradas)
+            except discord.Forbidden:
+                await ctx.send(f":x: | **{ctx.author.mention}**, o bot não tem permissão para apagar mensagens neste canal. Por favor, verifique as permissões do bot.")
+            except Exception as e:
+                await ctx.send(f":x: | **{ctx.author.mention}**, ocorreu um erro ao tentar apagar sua ficha: `{e}`")
+                print(f"Erro ao apagar ficha para {ctx.author.id}: {e}")
+                metricas.contar("erros_total", origem="apagar")
+        else:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, não há uma mensagem de ficha registrada para você apagar. Use `!ficha` para enviá-la novamente.")
 
 @bot.command()
 async def resetar(ctx):
     """
     Reseta a ficha do usuário, apagando todos os dados.
     """
-    user_id = str(ctx.author.id)
-    if user_id in users:
-        # Tenta apagar a mensagem da ficha antes de resetar os dados
-        user_data = users[user_id]
-        ficha_channel_id = user_data.get("ficha_channel_id")
-        ficha_message_id = user_data.get("ficha_message_id")
+    user_id = chave_ficha(ctx.guild, ctx.author.id)
+    async with travas_usuarios.trava(user_id): # Uma alteração por vez na mesma ficha
+        user = await cache_fichas.obter_sem_bloquear(user_id)
+        if user is not None:
+            # Tenta apagar a mensagem da ficha antes de resetar os dados
+            ficha_channel_id = user.ficha_channel_id
+            ficha_message_id = user.ficha_message_id
 
-        if ficha_channel_id and ficha_message_id:
-            try:
-                channel = bot.get_channel(ficha_channel_id)
-                if channel:
-                    message = await channel.fetch_message(ficha_message_id)
-                    await message.delete()
-            except (discord.NotFound, discord.Forbidden):
-                # Ignora erros se a mensagem já não existir ou se não tiver permissão
-                pass
-            except Exception as e:
-                print(f"Erro ao tentar apagar mensagem da ficha durante reset para {ctx.author.id}: {e}")
+            if ficha_channel_id and ficha_message_id:
+                try:
+                    channel = bot.get_channel(ficha_channel_id)
+                    if channel:
+                        with metricas.chamada_discord("apagar"):
+                            await channel.get_partial_message(ficha_message_id).delete()
+                except (discord.NotFound, discord.Forbidden):
+                    # Ignora erros se a mensagem já não existir ou se não tiver permissão
+                    pass
+                except Exception as e:
+                    print(f"Erro ao tentar apagar mensagem da ficha durante reset para {ctx.author.id}: {e}")
+                    metricas.contar("erros_total", origem="resetar")
         
-        del users[user_id]
-        salvar_dados() # Salva o estado sem a ficha resetada
-        await ctx.send(f":recycle: | **{ctx.author.mention}**, sua ficha foi **resetada**.")
-    else:
-        await ctx.send(f":information_source: | **{ctx.author.mention}**, você **não possui** ficha para resetar.")
+            antes = user.para_dict()
+            cache_fichas.apagar(user_id)
+            _fichas_renderizadas.pop(user_id, None)
+            salvar_dados(user_id, None) # Salva o estado sem a ficha resetada
+            registrar_evento(ctx, "resetar", user_id, antes, None)
+            await ctx.send(f":recycle: | **{ctx.author.mention}**, sua ficha foi **resetada**.")
+        else:
+            await ctx.send(f":information_source: | **{ctx.author.mention}**, você **não possui** ficha para resetar.")
+
+# --- Ferramentas de Linha de Comando ---
+def _ler_instante(texto):
+    """Instante da linha de comando: data e hora ISO (ex: 2026-10-18T14:30) ou timestamp Unix."""
+    try:
+        return float(texto)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(texto).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"instante inválido: {texto!r} (use 2026-10-18T14:30 ou um timestamp)")
+
+def executar_cli(argumentos):
+    """Ferramentas para rodar com o bot desligado. Ex: python bot.py.py migrar"""
+    parser = argparse.ArgumentParser(prog="bot.py.py")
+    subcomandos = parser.add_subparsers(dest="comando", required=True)
+
+    migrar = subcomandos.add_parser("migrar", help=f"Copia as fichas de {FICHA_FILE} para o banco SQLite.")
+    migrar.add_argument("--origem", default=FICHA_FILE)
+    migrar.add_argument("--journal", default=JOURNAL_FILE)
+    migrar.add_argument("--destino", default=FICHAS_DB)
+
+    subcomandos.add_parser(
+        "recalcular", help="Recalcula o status de todas as fichas; as mensagens são atualizadas quando o bot iniciar."
+    )
+
+    reconstruir = subcomandos.add_parser(
+        "reconstruir", help="Reconstrói as fichas em um instante a partir de um snapshot e do registro de eventos."
+    )
+    reconstruir.add_argument("--ate", type=_ler_instante, required=True, help="Ex: 2026-10-18T14:30 ou um timestamp.")
+    reconstruir.add_argument("--snapshot", help="Saída de outra reconstrução; sem ele, parte das fichas atuais.")
+    reconstruir.add_argument("--saida", default="fichas_reconstruidas.json")
 
-# Inicia o bot com o token do ambiente
-bot.run(os.getenv("DISCORD_BOT_TOKEN"))
\ No newline at end of file
+    benchmark = subcomandos.add_parser("benchmark", help="Mede o desempenho do bot sem conectar ao Discord.")
+    benchmarks = benchmark.add_subparsers(dest="alvo", required=True)
+
+    memoria = benchmarks.add_parser("memoria", help="Memória por ficha: dicionários x Ficha.")
+    memoria.add_argument("--fichas", type=int, nargs="+", default=[10000, 100000])
+
+    renderizacao = benchmarks.add_parser("renderizacao", help="Renderizações de ficha por segundo, antes e depois dos modelos.")
+    renderizacao.add_argument("--fichas", type=int, nargs="+", default=[1000, 10000])
+
+    carregamento = benchmarks.add_parser("carregamento", help="Fichas lidas por segundo do snapshot JSON e do binário.")
+    carregamento.add_argument("--fichas", type=int, nargs="+", default=[10000, 100000])
+
+    ranking = benchmarks.add_parser("ranking", help="!top e !rank pelos índices ordenados x varredura de todas as fichas.")
+    ranking.add_argument("--fichas", type=int, nargs="+", default=[10000, 100000])
+    ranking.add_argument("--consultas", type=int, default=1000)
+
+    comandos = benchmarks.add_parser("comandos", help="Executa comandos simulados e mede latência e vazão.")
+    comandos.add_argument("--fichas", type=int, nargs="+", default=[1000, 10000, 100000])
+    comandos.add_argument("--comandos", type=int, default=20000)
+    comandos.add_argument("--concorrencia", type=int, default=50)
+    comandos.add_argument("--backend", choices=["json", "sqlite"], default=FICHAS_BACKEND)
+    comandos.add_argument("--latencia-discord", type=float, default=0.0, help="Atraso simulado das chamadas ao Discord, em ms.")
+    comandos.add_argument("--saida", default="benchmark_comandos.json")
+
+    args = parser.parse_args(argumentos)
+    if args.comando == "benchmark":
+        # Os benchmarks ficam fora do bot, em benchmarks/, e recebem este módulo para medir
+        from benchmarks import desempenho
+        modulo = sys.modules[__name__]
+    if args.comando == "migrar":
+        migrar_para_sqlite(args.origem, args.journal, args.destino)
+    elif args.comando == "recalcular":
+        recalcular_offline()
+    elif args.comando == "reconstruir":
+        reconstruir_fichas(args.ate, args.snapshot, args.saida)
+    elif args.alvo == "memoria":
+        desempenho.benchmark_memoria(modulo, args.fichas)
+    elif args.alvo == "renderizacao":
+        desempenho.benchmark_renderizacao(modulo, args.fichas)
+    elif args.alvo == "carregamento":
+        desempenho.benchmark_carregamento(modulo, args.fichas)
+    elif args.alvo == "ranking":
+        desempenho.benchmark_ranking(modulo, args.fichas, args.consultas)
+    elif args.alvo == "comandos":
+        resultados = [
+            asyncio.run(desempenho.benchmark_comandos(
+                modulo, quantidade, args.comandos, args.concorrencia, args.backend, args.latencia_discord / 1000
+            ))
+            for quantidade in args.fichas
+        ]
+        with open(args.saida, "w") as f:
+            json.dump(resultados, f, indent=4)
+        print(f"Resultados salvos em {args.saida}.")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        executar_cli(sys.argv[1:])
+    else:
+        # Inicia o bot com o token do ambiente
+        bot.run(os.getenv("DISCORD_BOT_TOKEN"))
\ No newline at end of file
@@ -0,0 +1,23 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CAMINHO_BOT = os.path.join(RAIZ, "bot.py.py")
+sys.path.insert(0, RAIZ) # Para os testes importarem o pacote benchmarks
+
+
+def carregar_bot(diretorio):
+    """Carrega o bot.py.py como módulo, com os arquivos das fichas em 'diretorio'."""
+    pytest.importorskip("discord")
+    anterior = os.getcwd()
+    os.chdir(diretorio)
+    try:
+        spec = importlib.util.spec_from_file_location("bot_fichas", CAMINHO_BOT)
+        modulo = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(modulo)
+    finally:
+        os.chdir(anterior)
+    return modulo
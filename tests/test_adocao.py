@@ -0,0 +1,99 @@
+"""
+Fichas do formato antigo (fichas.json, sem guild): listadas, recalculadas e indexadas antes de serem
+usadas, e adotadas pela guild em que o jogador as usa (ou onde está a mensagem delas).
+"""
+import asyncio
+import json
+import os
+
+import pytest
+
+from conftest import carregar_bot
+
+discord = pytest.importorskip("discord")
+
+GUILD = 111 << 22
+OUTRA_GUILD = (222 << 22) + 1
+CANAL = 5
+
+
+class GuildFalsa:
+    def __init__(self, guild_id, canais=()):
+        self.id = guild_id
+        self.canais = set(canais)
+
+    def get_channel_or_thread(self, channel_id):
+        return object() if channel_id in self.canais else None
+
+
+def ficha_antiga(pontos, mensagem=None):
+    # Status desatualizado: 10 pontos em FOR renderiam 40, e não 0
+    return {
+        "pts_gastos": {"FOR": 10}, "status": {"FOR": 0}, "ranks": {"FOR": "II"}, "pontos": pontos,
+        "ficha_message_id": mensagem, "ficha_channel_id": CANAL if mensagem else None,
+    }
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    antigas = {str(user_id): ficha_antiga(user_id) for user_id in range(1, 6)}
+    antigas["6"] = ficha_antiga(6, mensagem=900)
+    with open(tmp_path / "fichas.json", "w") as f:
+        json.dump(antigas, f)
+    modulo = carregar_bot(tmp_path)
+    modulo.carregar_dados()
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def test_fichas_antigas_listadas_e_indexadas(bot):
+    antigas = {f"{bot.GUILD_LEGADO}:{user_id}" for user_id in range(1, 7)}
+    assert bot.cache_fichas.listar_ids() == antigas
+    assert bot.indice_mensagens.por_canal == {CANAL: {900: f"{bot.GUILD_LEGADO}:6"}}
+
+
+def test_recalculo_offline_inclui_fichas_antigas(bot, tmp_path):
+    bot.recalcular_offline()
+
+    legado = bot.ArmazenamentoJSON(str(tmp_path / "fichas.json"), str(tmp_path / "fichas.journal"))
+    legado.carregar()
+    assert sorted(legado.listar_ids()) == [str(user_id) for user_id in range(1, 7)]
+    assert all(legado.obter(user_id)["status"]["FOR"] == 40 for user_id in legado.listar_ids())
+
+
+def test_ficha_adotada_pela_guild_que_a_usa(bot, tmp_path):
+    async def executar():
+        await bot.preparar_guild(GUILD)
+        chave = bot.chave_ficha(GuildFalsa(GUILD), 3)
+        user = await bot.cache_fichas.obter_sem_bloquear(chave)
+        assert user.pontos == 3
+        # Outra guild não vê a ficha que a primeira já adotou
+        await bot.preparar_guild(OUTRA_GUILD)
+        assert await bot.cache_fichas.obter_sem_bloquear(bot.chave_ficha(GuildFalsa(OUTRA_GUILD), 3)) is None
+        await bot.persistencia.descarregar()
+
+        ids = bot.cache_fichas.listar_ids()
+        assert chave in ids and f"{bot.GUILD_LEGADO}:3" not in ids
+        assert bot.armazenamento.legado.obter("3") is None
+        assert bot.armazenamento.listar_ids(GUILD) == [chave]
+
+    asyncio.run(executar())
+    assert os.path.exists(tmp_path / "fichas" / f"{GUILD}.journal")
+
+
+def test_fichas_com_mensagem_na_guild_adotadas_ao_preparar(bot, monkeypatch):
+    guilds = {GUILD: GuildFalsa(GUILD, [CANAL]), OUTRA_GUILD: GuildFalsa(OUTRA_GUILD)}
+    monkeypatch.setattr(bot.bot, "get_guild", guilds.get)
+
+    async def executar():
+        await bot.preparar_guild(OUTRA_GUILD)
+        await bot.preparar_guild(GUILD)
+        await bot.persistencia.descarregar()
+
+    asyncio.run(executar())
+    chave = f"{GUILD}:6"
+    assert bot.armazenamento.listar_ids(GUILD) == [chave]
+    assert bot.armazenamento.listar_ids(OUTRA_GUILD) == []
+    assert bot.indice_mensagens.por_canal == {CANAL: {900: chave}}
+    assert f"{bot.GUILD_LEGADO}:6" not in bot.cache_fichas.listar_ids()
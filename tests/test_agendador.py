@@ -0,0 +1,44 @@
+"""
+Agendador das edições de ficha: um erro inesperado em uma edição não derruba a tarefa que processa a ficha,
+e os pedidos feitos enquanto ela falhava ainda são atendidos.
+"""
+import asyncio
+
+import pytest
+
+from benchmarks.discord_falso import AutorFalso, CanalFalso, ContextoFalso
+from conftest import carregar_bot
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def test_erro_em_uma_edicao_nao_derruba_o_agendador(bot, monkeypatch):
+    ctx = ContextoFalso(AutorFalso(7), CanalFalso(1, 0))
+    chamadas = []
+
+    async def executar():
+        agendador = bot.AgendadorFichas(0.001, 2)
+
+        async def enviar_ou_atualizar_ficha(ctx, user_id, confirmacoes):
+            chamadas.append([texto for _, texto in confirmacoes])
+            if len(chamadas) == 1:
+                # Pedido feito durante a edição que vai falhar: fica para a próxima volta da mesma tarefa
+                agendador.agendar(ctx, user_id, "segundo")
+                raise KeyError("ficha_message_id")
+
+        monkeypatch.setattr(bot, "enviar_ou_atualizar_ficha", enviar_ou_atualizar_ficha)
+        agendador.agendar(ctx, "0:7", "primeiro")
+        while agendador.profundidade():
+            await asyncio.sleep(0.01)
+        return agendador
+
+    agendador = asyncio.run(executar())
+    assert chamadas == [["primeiro"], ["segundo"]]
+    assert agendador.realizadas == 1
+    assert not agendador.pendentes and not agendador._canais
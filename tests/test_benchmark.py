@@ -0,0 +1,31 @@
+"""
+O benchmark de comandos roda cada tamanho de --fichas em um asyncio.run próprio: as travas e filas de uma
+execução não podem vazar para a seguinte, e o estado do bot tem que voltar ao original no fim.
+"""
+import asyncio
+
+import pytest
+
+from benchmarks import desempenho
+from conftest import carregar_bot
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def test_varios_tamanhos_com_disputa_pelas_travas(bot):
+    originais = {nome: getattr(bot, nome) for nome in desempenho.ESTADO_COMANDOS}
+
+    for quantidade in (20, 40):
+        # Poucas fichas, muitos comandos ao mesmo tempo e latência no Discord: as travas ficam disputadas
+        resultado = asyncio.run(desempenho.benchmark_comandos(bot, quantidade, 300, 30, "json", 0.001))
+        assert resultado["fichas"] == quantidade
+        assert sum(comando["quantidade"] for comando in resultado["por_comando"].values()) == 300
+
+    for nome, valor in originais.items():
+        assert getattr(bot, nome) is valor, nome
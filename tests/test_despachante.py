@@ -0,0 +1,147 @@
+"""
+DespachanteDiscord: ordem por prioridade em cada canal, limite de chamadas por rota e repetição das chamadas
+recusadas por rate limit (429) ou erro do servidor (5xx); os outros erros chegam a quem chamou.
+"""
+import asyncio
+import time
+
+import pytest
+
+from conftest import carregar_bot
+
+discord = pytest.importorskip("discord")
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    modulo = carregar_bot(tmp_path_factory.mktemp("bot"))
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+class RespostaFalsa:
+    """O que o discord.HTTPException lê da resposta HTTP."""
+
+    def __init__(self, status, retry_after=None):
+        self.status = status
+        self.reason = "erro simulado"
+        self.headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+
+
+def chamada_que_falha(erros, resultado="ok"):
+    """Chamada que levanta os 'erros' em sequência (um por tentativa) e depois retorna 'resultado'."""
+    erros = list(erros)
+    tentativas = []
+
+    async def chamada():
+        tentativas.append(time.monotonic())
+        if erros:
+            raise erros.pop(0)
+        return resultado
+
+    return chamada, tentativas
+
+
+def test_chamadas_saem_por_prioridade_e_na_ordem_de_chegada(bot):
+    feitas = []
+
+    async def executar():
+        despachante = bot.DespachanteDiscord(100, 1.0, 1, 0.01)
+        liberar = asyncio.Event()
+
+        async def primeira():
+            await liberar.wait()
+            feitas.append("primeira")
+
+        def chamada(nome):
+            async def registrar():
+                feitas.append(nome)
+            return registrar
+
+        futuros = [despachante.agendar(1, bot.PRIORIDADE_FICHA, "enviar", primeira)]
+        await asyncio.sleep(0) # A primeira já está em andamento quando as outras chegam
+        for nome, prioridade in [
+            ("massa", bot.PRIORIDADE_EM_MASSA), ("confirmacao", bot.PRIORIDADE_CONFIRMACAO),
+            ("ficha 1", bot.PRIORIDADE_FICHA), ("ficha 2", bot.PRIORIDADE_FICHA),
+        ]:
+            futuros.append(despachante.agendar(1, prioridade, "enviar", chamada(nome)))
+        assert despachante.profundidade() == 4
+        liberar.set()
+        await asyncio.gather(*futuros)
+        assert despachante.profundidade() == 0
+
+    asyncio.run(executar())
+    assert feitas == ["primeira", "ficha 1", "ficha 2", "confirmacao", "massa"]
+
+
+def test_limite_de_chamadas_por_rota(bot):
+    async def executar():
+        despachante = bot.DespachanteDiscord(2, 0.2, 1, 0.01)
+        instantes = []
+
+        async def chamada():
+            instantes.append(time.monotonic())
+
+        await asyncio.gather(*(despachante.executar(1, bot.PRIORIDADE_FICHA, "enviar", chamada) for _ in range(4)))
+        # Outro canal é outra rota: não espera pela primeira
+        inicio = time.monotonic()
+        await despachante.executar(2, bot.PRIORIDADE_FICHA, "enviar", chamada)
+        assert time.monotonic() - inicio < 0.1
+        return instantes
+
+    instantes = asyncio.run(executar())
+    assert instantes[1] - instantes[0] < 0.1
+    assert instantes[2] - instantes[0] >= 0.19 # A terceira só cabe quando a primeira sai da janela
+    assert instantes[3] - instantes[1] >= 0.19
+
+
+def test_rate_limit_e_erro_do_servidor_sao_repetidos(bot):
+    chamada, tentativas = chamada_que_falha([
+        discord.RateLimited(0.05),
+        discord.HTTPException(RespostaFalsa(503), "indisponível"),
+        discord.HTTPException(RespostaFalsa(429, retry_after=0.05), "rate limit"),
+    ])
+
+    async def executar():
+        despachante = bot.DespachanteDiscord(100, 1.0, 4, 0.05)
+        resultado = await despachante.executar(1, bot.PRIORIDADE_FICHA, "editar", chamada)
+        return despachante, resultado
+
+    despachante, resultado = asyncio.run(executar())
+    assert resultado == "ok"
+    assert despachante.chamadas == 4 and despachante.repetidas == 3
+    # Espera pedida pelo Discord (retry_after / Retry-After) ou a base, com até 10% a mais
+    for anterior, seguinte in zip(tentativas, tentativas[1:]):
+        assert seguinte - anterior >= 0.05
+
+
+@pytest.mark.parametrize("erro, chamadas", [
+    (lambda: discord.HTTPException(RespostaFalsa(403), "sem permissão"), 1), # Erros do cliente não se repetem
+    (lambda: discord.HTTPException(RespostaFalsa(500), "erro interno"), 3), # Até acabarem as tentativas
+])
+def test_erros_chegam_a_quem_chamou(bot, erro, chamadas):
+    chamada, tentativas = chamada_que_falha([erro() for _ in range(5)])
+
+    async def executar():
+        despachante = bot.DespachanteDiscord(100, 1.0, 3, 0.01)
+        with pytest.raises(discord.HTTPException):
+            await despachante.executar(1, bot.PRIORIDADE_FICHA, "editar", chamada)
+        # A fila do canal continua funcionando depois do erro
+        assert await despachante.executar(1, bot.PRIORIDADE_FICHA, "editar", chamada_que_falha([])[0]) == "ok"
+
+    asyncio.run(executar())
+    assert len(tentativas) == chamadas
+
+
+def test_erro_de_chamada_disparada_so_e_registrado(bot, capsys):
+    chamada, _ = chamada_que_falha([discord.HTTPException(RespostaFalsa(404), "mensagem não existe")])
+
+    async def executar():
+        despachante = bot.DespachanteDiscord(100, 1.0, 3, 0.01)
+        despachante.disparar(1, bot.PRIORIDADE_CONFIRMACAO, "enviar", chamada)
+        while despachante.profundidade() or despachante._trabalhadores:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0) # O registro do erro roda logo depois que o futuro termina
+
+    asyncio.run(executar())
+    assert "Erro ao enviar mensagem ao Discord: 404" in capsys.readouterr().out
@@ -0,0 +1,121 @@
+"""
+Registro de eventos: gravação em blocos gzip com o índice SQLite, consultas do !historico e por intervalo,
+e a reconstrução das fichas em um instante, para frente a partir de um snapshot e para trás a partir das atuais.
+"""
+import asyncio
+import json
+import os
+
+import pytest
+
+from conftest import carregar_bot
+
+A, B = "0:1", "0:2"
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def ficha(bot, pontos):
+    return bot.Ficha(pontos).para_dict()
+
+
+def eventos_de_exemplo(bot):
+    """A é criada, alterada e apagada; B é criada e alterada. Instantes fixos, fora de ordem entre as fichas."""
+    return [
+        {"ts": 10.0, "chave": A, "acao": "criar", "autor": 1, "detalhes": {}, "antes": None, "depois": ficha(bot, 1)},
+        {"ts": 15.0, "chave": B, "acao": "criar", "autor": 2, "detalhes": {}, "antes": None, "depois": ficha(bot, 10)},
+        {"ts": 20.0, "chave": A, "acao": "add", "autor": 1, "detalhes": {}, "antes": ficha(bot, 1), "depois": ficha(bot, 2)},
+        {"ts": 25.0, "chave": B, "acao": "add", "autor": 2, "detalhes": {}, "antes": ficha(bot, 10), "depois": ficha(bot, 11)},
+        {"ts": 30.0, "chave": A, "acao": "resetar", "autor": 1, "detalhes": {}, "antes": ficha(bot, 2), "depois": None},
+    ]
+
+
+def gravar_eventos(registro, lotes):
+    """Registra e grava cada lote de eventos (cada um vira um bloco)."""
+    async def executar():
+        for lote in lotes:
+            for evento in lote:
+                registro.registrar(evento)
+            await registro.descarregar()
+
+    asyncio.run(executar())
+
+
+@pytest.fixture
+def registro(bot, tmp_path, monkeypatch):
+    # Arquivos pequenos: cada bloco começa um arquivo novo
+    registro = bot.RegistroEventos(str(tmp_path / "eventos"), 0.01, 1)
+    monkeypatch.setattr(bot, "registro_eventos", registro)
+    eventos = eventos_de_exemplo(bot)
+    gravar_eventos(registro, [eventos[:2], eventos[2:4], eventos[4:]])
+    yield registro
+    registro.fechar()
+
+
+def test_eventos_gravados_em_blocos_e_arquivos(registro, tmp_path):
+    assert (registro.gravados, registro.blocos) == (5, 3)
+    arquivos = [nome for nome in os.listdir(tmp_path / "eventos") if nome.endswith(".ndjson.gz")]
+    assert len(arquivos) == 3
+
+
+def test_historico_do_mais_novo_para_o_mais_antigo(registro):
+    assert [evento["acao"] for evento in registro.historico(A, 10)] == ["resetar", "add", "criar"]
+    assert [evento["ts"] for evento in registro.historico(A, 2)] == [30.0, 20.0]
+    assert [evento["ts"] for evento in registro.historico(B, 10)] == [25.0, 15.0]
+    assert registro.historico("0:3", 10) == []
+
+
+def test_eventos_entre_exclui_o_inicio_e_inclui_o_fim(registro):
+    assert [evento["ts"] for evento in registro.eventos_entre(15.0, 25.0)] == [20.0, 25.0]
+    assert [evento["ts"] for evento in registro.eventos_entre(0.0, 100.0)] == [10.0, 15.0, 20.0, 25.0, 30.0]
+    assert registro.eventos_entre(30.0, 100.0) == []
+
+
+def test_lote_que_falhou_vai_junto_com_o_proximo(bot, registro, monkeypatch):
+    fsync = os.fsync
+
+    def disco_cheio(fd):
+        raise OSError(28, "No space left on device")
+
+    evento = {"ts": 40.0, "chave": B, "acao": "add", "autor": 2, "detalhes": {}, "antes": None, "depois": None}
+    monkeypatch.setattr(bot.os, "fsync", disco_cheio)
+    gravar_eventos(registro, [[evento]])
+    assert registro.gravados == 5
+    assert registro.eventos_entre(30.0, 100.0) == [] # Nem meio bloco nem entrada no índice
+
+    monkeypatch.setattr(bot.os, "fsync", fsync)
+    gravar_eventos(registro, [[dict(evento, ts=50.0)]])
+    assert [evento["ts"] for evento in registro.eventos_entre(30.0, 100.0)] == [40.0, 50.0]
+
+
+def test_reconstrucao_para_tras_a_partir_das_fichas_atuais(bot, registro, tmp_path):
+    bot.armazenamento.carregar()
+    bot.armazenamento.gravar({B: json.dumps(ficha(bot, 11))}) # Estado atual: A apagada, B alterada
+
+    bot.reconstruir_fichas(22.0, None, str(tmp_path / "em_22.json"))
+    with open(tmp_path / "em_22.json") as f:
+        assert json.load(f) == {"ate": 22.0, "fichas": {A: ficha(bot, 2), B: ficha(bot, 10)}}
+
+    bot.reconstruir_fichas(5.0, None, str(tmp_path / "em_5.json"))
+    with open(tmp_path / "em_5.json") as f:
+        assert json.load(f)["fichas"] == {}
+
+
+def test_reconstrucao_para_frente_e_para_tras_a_partir_de_um_snapshot(bot, registro, tmp_path):
+    with open(tmp_path / "em_12.json", "w") as f:
+        json.dump({"ate": 12.0, "fichas": {A: ficha(bot, 1)}}, f)
+
+    bot.reconstruir_fichas(27.0, str(tmp_path / "em_12.json"), str(tmp_path / "em_27.json"))
+    with open(tmp_path / "em_27.json") as f:
+        assert json.load(f)["fichas"] == {A: ficha(bot, 2), B: ficha(bot, 11)}
+
+    # A saída de uma reconstrução serve de snapshot para outra, inclusive voltando no tempo
+    bot.reconstruir_fichas(17.0, str(tmp_path / "em_27.json"), str(tmp_path / "em_17.json"))
+    with open(tmp_path / "em_17.json") as f:
+        assert json.load(f)["fichas"] == {A: ficha(bot, 1), B: ficha(bot, 10)}
@@ -0,0 +1,115 @@
+"""
+Journal do backend JSON: reaplicação ao carregar, compactação no snapshot e recuperação de uma última
+linha cortada por uma queda no meio da escrita.
+"""
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from conftest import carregar_bot
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    modulo = carregar_bot(tmp_path_factory.mktemp("bot"))
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def ficha(bot, pontos):
+    return json.dumps(bot.Ficha(pontos).para_dict(), separators=(",", ":"))
+
+
+def abrir(bot, pasta):
+    armazenamento = bot.ArmazenamentoJSON(str(pasta / "fichas.json"), str(pasta / "fichas.journal"))
+    armazenamento.carregar()
+    return armazenamento
+
+
+def pontos(armazenamento):
+    return {user_id: armazenamento.obter(user_id)["pontos"] for user_id in sorted(armazenamento.listar_ids())}
+
+
+def test_journal_reaplicado_ao_carregar(bot, tmp_path):
+    armazenamento = abrir(bot, tmp_path)
+    armazenamento.gravar({"1": ficha(bot, 10), "2": ficha(bot, 20)})
+    armazenamento.gravar({"1": None, "2": ficha(bot, 21), "3": ficha(bot, 30)})
+
+    assert not os.path.exists(tmp_path / "fichas.json") # Ainda não houve compactação
+    assert pontos(abrir(bot, tmp_path)) == {"2": 21, "3": 30}
+
+
+def test_linha_cortada_nao_esconde_as_gravacoes_seguintes(bot, tmp_path):
+    armazenamento = abrir(bot, tmp_path)
+    armazenamento.gravar({"1": ficha(bot, 10)})
+    with open(tmp_path / "fichas.journal", "ab") as f:
+        f.write(b'{"op":"set","id":"2","ficha":{"pts_ga') # Queda no meio da escrita
+
+    depois_da_queda = abrir(bot, tmp_path)
+    assert pontos(depois_da_queda) == {"1": 10}
+    depois_da_queda.gravar({"3": ficha(bot, 30)})
+
+    assert pontos(abrir(bot, tmp_path)) == {"1": 10, "3": 30}
+    abrir(bot, tmp_path).compactar()
+    assert pontos(abrir(bot, tmp_path)) == {"1": 10, "3": 30}
+
+
+def test_linha_ilegivel_no_meio_so_perde_ela(bot, tmp_path):
+    # Journal de antes da correção: a gravação seguinte à queda foi colada na linha cortada
+    with open(tmp_path / "fichas.journal", "w") as f:
+        f.write(f'{{"op":"set","id":"1","ficha":{ficha(bot, 10)}}}\n')
+        f.write(f'{{"op":"set","id":"2","fi{{"op":"set","id":"3","ficha":{ficha(bot, 30)}}}\n')
+        f.write(f'{{"op":"set","id":"4","ficha":{ficha(bot, 40)}}}\n')
+
+    assert pontos(abrir(bot, tmp_path)) == {"1": 10, "4": 40}
+
+
+def test_compactacao_grava_snapshot_e_descarta_o_journal(bot, tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "JOURNAL_LIMITE_BYTES", 1) # Compacta a cada gravação
+    armazenamento = abrir(bot, tmp_path)
+    armazenamento.gravar({"1": ficha(bot, 10), "2": ficha(bot, 20)})
+    armazenamento.gravar({"2": None, "3": ficha(bot, 30)})
+
+    assert not os.path.exists(tmp_path / "fichas.journal")
+    assert not os.path.exists(tmp_path / "fichas.journal.compactando")
+    with open(tmp_path / "fichas.json") as f:
+        assert sorted(json.load(f)) == ["1", "3"]
+    assert os.path.exists(tmp_path / "fichas.json.bin")
+    # Lido de novo pelo snapshot binário, que tem que dar as mesmas fichas
+    assert pontos(abrir(bot, tmp_path)) == {"1": 10, "3": 30}
+
+
+def test_compactacao_interrompida_e_retomada(bot, tmp_path):
+    abrir(bot, tmp_path).gravar({"1": ficha(bot, 10)})
+    # Queda depois de renomear o journal para a compactação, antes de gravar o snapshot
+    os.replace(tmp_path / "fichas.journal", tmp_path / "fichas.journal.compactando")
+    armazenamento = abrir(bot, tmp_path)
+    armazenamento.gravar({"1": ficha(bot, 11), "2": ficha(bot, 20)})
+
+    # O journal da compactação vem antes do atual
+    assert pontos(abrir(bot, tmp_path)) == {"1": 11, "2": 20}
+    abrir(bot, tmp_path).compactar()
+    assert not os.path.exists(tmp_path / "fichas.journal.compactando")
+    assert pontos(abrir(bot, tmp_path)) == {"1": 11, "2": 20}
+
+
+def test_fichas_gravadas_ficam_compactas_na_memoria(bot, tmp_path):
+    armazenamento = abrir(bot, tmp_path)
+    fichas = {str(user_id): bot.Ficha(user_id) for user_id in range(2000)}
+    for user_id, user in fichas.items():
+        user.pts_gastos[0] = user.bonus[-1] = int(user_id)
+        user.ficha_channel_id, user.ficha_message_id = 5, 10_000 + int(user_id)
+    texto = {user_id: json.dumps(user.para_dict(), separators=(",", ":")) for user_id, user in fichas.items()}
+
+    tracemalloc.start()
+    antes = tracemalloc.get_traced_memory()[0]
+    armazenamento.gravar(texto)
+    por_ficha = (tracemalloc.get_traced_memory()[0] - antes) / len(fichas)
+    tracemalloc.stop()
+
+    # Os dicionários do JSON passam de 2,5 KB por ficha; o registro binário fica abaixo de 300 bytes
+    assert por_ficha < 400, por_ficha
+    assert all(armazenamento.obter(user_id) == json.loads(dados) for user_id, dados in texto.items())
+    assert sorted(armazenamento.listar_mensagens()) == sorted((user_id, 5, 10_000 + int(user_id)) for user_id in fichas)
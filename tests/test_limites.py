@@ -0,0 +1,91 @@
+"""
+Valores que não cabem nos inteiros de 32 bits da Ficha são recusados pelos comandos em vez de estourar
+(OverflowError) no meio da alteração.
+"""
+import asyncio
+import json
+
+import pytest
+
+from benchmarks.discord_falso import AutorFalso, CanalFalso, ContextoFalso
+from conftest import carregar_bot
+
+discord = pytest.importorskip("discord")
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+class MembroFalso(discord.Member):
+    id = None
+    display_name = None
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f"jogador{user_id}"
+
+
+def test_valores_fora_do_limite_sao_recusados(bot):
+    canal = CanalFalso(1, 0)
+    bot.bot.get_channel = {1: canal}.get
+    ctx = ContextoFalso(AutorFalso(7), canal)
+    limite = bot.LIMITE_VALOR_FICHA
+
+    async def executar():
+        bot.carregar_dados()
+        await bot.criar.callback(ctx)
+        chave = bot.chave_ficha(None, 7)
+        user = await bot.cache_fichas.obter_sem_bloquear(chave)
+
+        await bot.addbonus.callback(ctx, "FOR", 3_000_000_000)
+        await bot.removerbonus.callback(ctx, "FOR", -3_000_000_000)
+        assert user.bonus[bot.indice_atributo["FOR"]] == 0
+
+        await bot.addpontos.callback(ctx, MembroFalso(7), limite - user.pontos)
+        assert user.pontos == limite
+        await bot.addpontos.callback(ctx, MembroFalso(7), 1)
+        await bot.addpontos.callback(ctx, MembroFalso(7), 2**31)
+        assert user.pontos == limite
+
+        # Com bônus bem negativo o limite de rank não segura os pontos gastos: o teto da ficha segura
+        await bot.addbonus.callback(ctx, "DEF", -limite)
+        await bot.add.callback(ctx, "DEF", limite)
+        await bot.addpontos.callback(ctx, MembroFalso(7), 10)
+        await bot.add.callback(ctx, "DEF", 1)
+        await bot.distribuir.callback(ctx, "DEF=1", "AGI=1")
+        assert user.pts_gastos[bot.indice_atributo["DEF"]] == limite
+        assert user.pontos == 10
+
+        while bot.agendador_fichas.profundidade() or bot.despachante.profundidade():
+            await asyncio.sleep(0.01)
+        await bot.persistencia.descarregar()
+        await bot.registro_eventos.descarregar()
+        recusas = [
+            mensagem.content for mensagem in canal.mensagens.values()
+            if (mensagem.content or "").startswith(":x:") and str(limite) in mensagem.content
+        ]
+        assert len(recusas) == 6
+
+    asyncio.run(executar())
+
+
+def test_ficha_carregada_fora_do_limite_fica_de_quarentena(bot, tmp_path):
+    # Um bônus dado antes de existir o limite (o !addbonus aceitava qualquer valor)
+    fichas = {
+        "7": {"bonus": {"KRITOS": 10**10}, "pontos": 35},
+        "8": {"bonus": {"FOR": -(2**31)}, "pontos": 35},
+        "9": {"pontos": 35},
+    }
+    with open(tmp_path / "antigas.json", "w") as f:
+        json.dump(fichas, f)
+    armazenamento = bot.ArmazenamentoJSON(str(tmp_path / "antigas.json"), str(tmp_path / "antigas.journal"))
+
+    assert armazenamento.carregar() == 1
+    assert armazenamento.listar_ids() == ["9"]
+    with open(tmp_path / "antigas.json.invalidas") as f:
+        assert json.load(f) == {"7": fichas["7"], "8": fichas["8"]}
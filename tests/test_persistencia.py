@@ -0,0 +1,97 @@
+"""
+Gravação em segundo plano das fichas: uma escrita que falha é tentada de novo sozinha (com espera crescente),
+sem esperar por outro comando, e as alterações feitas durante uma escrita também chegam ao disco.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from conftest import carregar_bot
+
+
+class ArmazenamentoFalho:
+    """Armazenamento em memória cujas primeiras 'falhas' gravações levantam OSError (ex: disco cheio)."""
+
+    def __init__(self, falhas=0, atraso=0.0):
+        self.falhas = falhas
+        self.atraso = atraso
+        self.fichas = {}
+        self.tentativas = 0
+        self.gravando = threading.Event()
+
+    def gravar(self, lote):
+        self.tentativas += 1
+        self.gravando.set()
+        if self.atraso:
+            threading.Event().wait(self.atraso)
+        if self.tentativas <= self.falhas:
+            raise OSError(28, "No space left on device")
+        for user_id, dados in lote.items():
+            self.fichas[user_id] = dados
+
+    def fechar(self):
+        pass
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+async def esperar(condicao, limite=5.0):
+    fim = asyncio.get_running_loop().time() + limite
+    while not condicao():
+        assert asyncio.get_running_loop().time() < fim, "tempo esgotado"
+        await asyncio.sleep(0.01)
+
+
+def test_gravacao_que_falhou_e_repetida_sem_novo_comando(bot, monkeypatch):
+    armazenamento = ArmazenamentoFalho(falhas=3)
+    monkeypatch.setattr(bot, "armazenamento", armazenamento)
+
+    async def executar():
+        persistencia = bot.PersistenciaAssincrona(0.01)
+        persistencia.marcar("0:1", bot.Ficha(10))
+        await esperar(lambda: "0:1" in armazenamento.fichas)
+
+        assert armazenamento.tentativas == 4
+        assert persistencia.falhas_seguidas == 0 and not persistencia.pendentes
+        assert persistencia.escritas_realizadas == 1
+
+    asyncio.run(executar())
+
+
+def test_espera_entre_tentativas_cresce_ate_o_maximo(bot, monkeypatch):
+    monkeypatch.setattr(bot, "armazenamento", ArmazenamentoFalho(falhas=10))
+    monkeypatch.setattr(bot, "ESPERA_MAXIMA_GRAVACAO", 0.3)
+    esperas = []
+
+    async def executar():
+        persistencia = bot.PersistenciaAssincrona(0.05)
+        monkeypatch.setattr(persistencia, "_agendar", esperas.append) # Só anota: as tentativas são chamadas abaixo
+        persistencia.pendentes["0:1"] = bot.Ficha(10)
+        for _ in range(4):
+            await persistencia.descarregar()
+
+    asyncio.run(executar())
+    assert esperas == [0.1, 0.2, 0.3, 0.3]
+
+
+def test_alteracao_feita_durante_a_escrita_tambem_e_gravada(bot, monkeypatch):
+    armazenamento = ArmazenamentoFalho(atraso=0.2)
+    monkeypatch.setattr(bot, "armazenamento", armazenamento)
+
+    async def executar():
+        persistencia = bot.PersistenciaAssincrona(0.01)
+        persistencia.marcar("0:1", bot.Ficha(10))
+        await esperar(armazenamento.gravando.is_set)
+        persistencia.marcar("0:2", bot.Ficha(20)) # A escrita do primeiro lote ainda está em andamento
+        await esperar(lambda: "0:2" in armazenamento.fichas)
+
+        assert armazenamento.tentativas == 2
+
+    asyncio.run(executar())
@@ -0,0 +1,77 @@
+"""
+Recálculo em lote interrompido e retomado: o arquivo de progresso guarda só o cursor e as mensagens que
+faltam reeditar, e a ordem das fichas sai de novo das fichas guardadas ao retomar.
+"""
+import json
+
+import pytest
+
+from conftest import carregar_bot
+
+FICHAS = 50
+
+
+class Interrompido(Exception):
+    pass
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    modulo = carregar_bot(tmp_path)
+    monkeypatch.setattr(modulo, "LOTE_RECALCULO", 10)
+    modulo.carregar_dados()
+    fichas = {}
+    for user_id in range(FICHAS):
+        # Status desatualizado: 5 pontos em FOR dão 20, e não 0; metade das fichas tem mensagem
+        ficha = modulo.Ficha(user_id)
+        ficha.pts_gastos[modulo.indice_atributo["FOR"]] = 5
+        if user_id % 2:
+            ficha.ficha_channel_id, ficha.ficha_message_id = 5, 1000 + user_id
+        fichas[modulo.chave_ficha(None, user_id)] = json.dumps(ficha.para_dict(), separators=(",", ":"))
+    modulo.armazenamento.gravar(fichas)
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def test_recalculo_retomado_pelo_cursor(bot, monkeypatch, tmp_path):
+    salvar = bot._salvar_progresso_recalculo
+    gravados = []
+
+    def salvar_e_parar(progresso):
+        salvar(progresso)
+        with open(tmp_path / bot.RECALCULO_FILE) as f:
+            gravados.append(json.load(f))
+        if len(gravados) == 2:
+            raise Interrompido
+
+    monkeypatch.setattr(bot, "_salvar_progresso_recalculo", salvar_e_parar)
+    with pytest.raises(Interrompido):
+        bot.recalcular_offline()
+
+    ids = sorted(bot.armazenamento.listar_ids(0))
+    assert gravados[-1] == {"ultimo": ids[19], "editar": ids[:20], "editadas": 0}
+
+    monkeypatch.setattr(bot, "_salvar_progresso_recalculo", salvar)
+    calculadas = []
+    recalcular = bot.recalcular_status_em_lote
+    monkeypatch.setattr(bot, "recalcular_status_em_lote", lambda fichas: calculadas.extend(fichas) or recalcular(fichas))
+    bot.recalcular_offline()
+
+    assert calculadas == ids[20:] # Só as que faltavam
+    with open(tmp_path / bot.RECALCULO_FILE) as f:
+        assert json.load(f) == {"ultimo": ids[-1], "editar": ids, "editadas": 0}
+    bot.carregar_dados()
+    for chave in ids:
+        assert bot.armazenamento.obter(chave)["status"]["FOR"] == 20
+
+
+def test_progresso_no_formato_antigo_vira_cursor(bot, tmp_path):
+    ids = sorted(bot.armazenamento.listar_ids(0))
+    with open(tmp_path / bot.RECALCULO_FILE, "w") as f:
+        json.dump({"ids": ids, "posicao": 30, "editar": ids[:30], "editadas": 0}, f)
+
+    progresso = bot._retomar_recalculo(bot._ler_progresso_recalculo(), ids)
+    assert progresso["ultimo"] == ids[29]
+    assert progresso["ids"] == ids[30:]
+    assert progresso["editar"] == ids[:30]
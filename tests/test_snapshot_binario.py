@@ -0,0 +1,119 @@
+"""
+Snapshot binário do backend JSON: o registro de cada ficha volta igual à ficha do JSON, o binário só é usado
+enquanto foi gerado a partir do JSON atual, e um binário inválido ou ausente cai de volta no JSON.
+"""
+import json
+import os
+import random
+
+import pytest
+
+from conftest import carregar_bot
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    modulo = carregar_bot(tmp_path_factory.mktemp("bot"))
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def fichas_aleatorias(bot, quantidade, semente=0):
+    """Fichas completas no formato JSON, com valores nos extremos do que a ficha aceita."""
+    rng = random.Random(semente)
+    limite = bot.LIMITE_VALOR_FICHA
+    fichas = {}
+    for _ in range(quantidade):
+        valor = lambda: rng.choice([0, 1, -1, limite, -limite, rng.randint(-limite, limite)])
+        com_mensagem = rng.random() < 0.5
+        fichas[str(rng.getrandbits(63))] = {
+            "pts_gastos": {attr: valor() for attr in bot.atributos_validos},
+            "bonus": {attr: valor() for attr in bot.bonus_validos},
+            "status": {attr: valor() for attr in bot.atributos_validos},
+            "ranks": {attr: rng.choice(list(bot.rank_limits)) for attr in bot.atributos_validos},
+            "pontos": valor(),
+            "ficha_message_id": rng.getrandbits(64) or None if com_mensagem else None,
+            "ficha_channel_id": rng.getrandbits(64) or None if com_mensagem else None,
+        }
+    return fichas
+
+
+def escrever(pasta, fichas):
+    with open(pasta / "fichas.json", "w") as f:
+        json.dump(fichas, f, indent=4)
+
+
+def abrir(bot, pasta):
+    armazenamento = bot.ArmazenamentoJSON(str(pasta / "fichas.json"), str(pasta / "fichas.journal"))
+    armazenamento.carregar()
+    return armazenamento
+
+
+def lidas_do_binario(bot, pasta):
+    armazenamento = bot.ArmazenamentoJSON(str(pasta / "fichas.json"), str(pasta / "fichas.journal"))
+    return armazenamento._ler_binario(os.stat(pasta / "fichas.json"))
+
+
+def test_registro_ida_e_volta(bot):
+    for user_id, ficha in fichas_aleatorias(bot, 500).items():
+        registro = bot._REGISTRO_FICHA.unpack(bot._registro_da_ficha(user_id, ficha))
+        assert registro[0] == int(user_id)
+        assert bot._ficha_do_registro(registro) == ficha
+
+
+def test_snapshot_lido_do_binario_igual_ao_json(bot, tmp_path):
+    fichas = fichas_aleatorias(bot, 300, semente=1)
+    escrever(tmp_path, fichas)
+    assert lidas_do_binario(bot, tmp_path) is None
+
+    do_json = abrir(bot, tmp_path) # Gera o binário
+    binario = lidas_do_binario(bot, tmp_path)
+    assert binario is not None and sorted(binario) == sorted(fichas)
+    do_binario = abrir(bot, tmp_path)
+
+    for armazenamento in (do_json, do_binario):
+        assert {user_id: armazenamento.obter(user_id) for user_id in armazenamento.listar_ids()} == fichas
+        assert sorted(armazenamento.listar_mensagens()) == sorted(
+            (user_id, ficha["ficha_channel_id"], ficha["ficha_message_id"])
+            for user_id, ficha in fichas.items() if ficha["ficha_channel_id"] and ficha["ficha_message_id"]
+        )
+
+
+def test_binario_refeito_quando_o_json_muda(bot, tmp_path):
+    escrever(tmp_path, fichas_aleatorias(bot, 10, semente=2))
+    abrir(bot, tmp_path)
+    # O JSON foi editado à mão depois de o binário ser gerado: o binário antigo não vale mais
+    fichas = fichas_aleatorias(bot, 12, semente=3)
+    escrever(tmp_path, fichas)
+    assert lidas_do_binario(bot, tmp_path) is None
+
+    armazenamento = abrir(bot, tmp_path)
+    assert sorted(armazenamento.listar_ids()) == sorted(fichas)
+    assert sorted(lidas_do_binario(bot, tmp_path)) == sorted(fichas)
+
+
+@pytest.mark.parametrize("estragar", [
+    lambda conteudo: conteudo[:-1], # Cortado no meio do último registro
+    lambda conteudo: b"OUTRABIN" + conteudo[8:], # Marca errada
+    lambda conteudo: b"", # Vazio
+])
+def test_binario_invalido_cai_no_json(bot, tmp_path, estragar):
+    fichas = fichas_aleatorias(bot, 20, semente=4)
+    escrever(tmp_path, fichas)
+    abrir(bot, tmp_path)
+    caminho = tmp_path / "fichas.json.bin"
+    caminho.write_bytes(estragar(caminho.read_bytes()))
+
+    armazenamento = abrir(bot, tmp_path)
+    assert {user_id: armazenamento.obter(user_id) for user_id in armazenamento.listar_ids()} == fichas
+    assert lidas_do_binario(bot, tmp_path) is not None # Refeito a partir do JSON
+
+
+def test_ficha_que_nao_cabe_no_registro_fica_so_no_json(bot, tmp_path):
+    fichas = fichas_aleatorias(bot, 5, semente=5)
+    fichas["jogador antigo"] = fichas.popitem()[1] # ID que não é numérica
+    escrever(tmp_path, fichas)
+
+    armazenamento = abrir(bot, tmp_path)
+    assert not os.path.exists(tmp_path / "fichas.json.bin")
+    assert {user_id: armazenamento.obter(user_id) for user_id in armazenamento.listar_ids()} == fichas
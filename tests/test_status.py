@@ -0,0 +1,104 @@
+"""
+O calcular_status e o recalcular_status_em_lote (com e sem NumPy) têm que dar o mesmo status que o
+atualizar_status original, feito com if/elif sobre os dicionários da ficha.
+"""
+import random
+
+import pytest
+
+from conftest import carregar_bot
+
+FICHAS = 2000
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    modulo = carregar_bot(tmp_path_factory.mktemp("fichas"))
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+def atualizar_status_original(bot, user):
+    """O atualizar_status de antes da tabela 'conversao_pontos', sobre a ficha no formato JSON."""
+    status = user["status"]
+    pts_gastos = user["pts_gastos"]
+    bonus = user.get("bonus", {attr: 0 for attr in bot.bonus_validos})
+
+    for key in bot.atributos_validos:
+        status[key] = bonus.get(key, 0)
+
+    for attr, pts in pts_gastos.items():
+        if attr == "DEF":
+            status["DEF"] += pts * 1
+            status["RES"] += pts * 1
+        elif attr == "RES":
+            status["RES"] += pts * 2
+            status["HP"] += pts * 2
+        elif attr == "INT":
+            status["INT"] += pts * 2
+        elif attr == "AGI":
+            status["AGI"] += pts * 2
+            status["VEL"] += pts * 1
+        elif attr == "VEL":
+            status["VEL"] += pts * 2
+            status["AGI"] += pts * 1
+        elif attr == "HP":
+            status["HP"] += pts * 5
+            status["RES"] += pts * 2
+        elif attr == "FOR":
+            status["FOR"] += pts * 4
+            status["RES"] += pts * 4
+            status["DEF"] += (pts // 5) * 1
+        elif attr == "MAG":
+            status["MAG"] += pts * 2
+        elif attr == "DMG":
+            status["DMG"] += pts * 2
+            status["FOR"] += pts * 2
+            status["MAG"] += pts * 1
+
+    for attr in bot.atributos_validos:
+        rank = user["ranks"].get(attr, "I")
+        limite = bot.atributos_com_limite[attr][rank]
+        if status[attr] > limite:
+            status[attr] = limite
+
+
+def fichas_aleatorias(bot, semente):
+    """Fichas com pontos, bônus (inclusive negativos) e ranks sorteados, e o status esperado de cada uma."""
+    rng = random.Random(semente)
+    fichas, esperados = {}, {}
+    for user_id in range(FICHAS):
+        ficha = bot.Ficha(pontos=0)
+        for i in range(len(bot.atributos_validos)):
+            ficha.pts_gastos[i] = rng.choice([0, rng.randint(0, 20), rng.randint(0, 500)])
+            ficha.ranks[i] = rng.choice(list(bot.nomes_rank))
+        for i in range(len(bot.bonus_validos)):
+            ficha.bonus[i] = rng.randint(-20, 50)
+        dados = ficha.para_dict()
+        atualizar_status_original(bot, dados)
+        esperados[user_id] = [dados["status"][attr] for attr in bot.atributos_validos]
+        # Parte das fichas já está com o status certo: só as outras devem aparecer como alteradas
+        if rng.random() < 0.3:
+            ficha.status[:] = bot.array("i", esperados[user_id])
+        fichas[user_id] = ficha
+    return fichas, esperados
+
+
+def test_calcular_status_igual_ao_original(bot):
+    fichas, esperados = fichas_aleatorias(bot, 1)
+    for user_id, ficha in fichas.items():
+        assert bot.calcular_status(ficha.pts_gastos, ficha.bonus, ficha.ranks) == esperados[user_id]
+
+
+@pytest.mark.parametrize("com_numpy", [True, False])
+def test_recalcular_status_em_lote_igual_ao_original(bot, monkeypatch, com_numpy):
+    if com_numpy and bot.np is None:
+        pytest.skip("NumPy não está instalado")
+    if not com_numpy:
+        monkeypatch.setattr(bot, "np", None)
+    fichas, esperados = fichas_aleatorias(bot, 2)
+    desatualizadas = [user_id for user_id, ficha in fichas.items() if list(ficha.status) != esperados[user_id]]
+
+    assert bot.recalcular_status_em_lote(fichas) == desatualizadas
+    for user_id, ficha in fichas.items():
+        assert list(ficha.status) == esperados[user_id]
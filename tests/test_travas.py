@@ -0,0 +1,87 @@
+"""
+Teste de estresse das travas por ficha: milhares de comandos intercalados (do jogador e de moderadores)
+sobre poucas fichas não podem perder nenhuma alteração.
+"""
+import asyncio
+import random
+
+import pytest
+
+from benchmarks.discord_falso import AutorFalso, CanalFalso, ContextoFalso
+from conftest import carregar_bot
+
+discord = pytest.importorskip("discord")
+
+FICHAS = 30
+COMANDOS = 5000
+PONTOS_INICIAIS = 35 # Pontos livres de uma ficha recém-criada
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def bot(request, tmp_path, monkeypatch):
+    monkeypatch.setenv("FICHAS_BACKEND", request.param)
+    monkeypatch.chdir(tmp_path) # As gravações em segundo plano usam caminhos relativos
+    modulo = carregar_bot(tmp_path)
+    # Cache e travas pequenos: as fichas entram e saem do cache no meio dos comandos
+    modulo.cache_fichas.limite = 5
+    modulo.travas_usuarios.limite = 5
+    modulo.agendador_fichas.janela = 0.001
+    modulo.despachante.chamadas_por_rota = COMANDOS * 10
+    yield modulo
+    modulo.armazenamento.fechar()
+
+
+class MembroFalso(discord.Member):
+    """Um discord.Member só com o que o !addpontos usa, para ele seguir o caminho de um membro."""
+    id = None
+    display_name = None
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f"jogador{user_id}"
+
+
+def test_comandos_intercalados_nao_perdem_pontos(bot):
+    rng = random.Random(8)
+    canais = {canal_id: CanalFalso(canal_id, 0.0005) for canal_id in range(1, 6)}
+    bot.bot.get_channel = canais.get
+    concedidos = dict.fromkeys(range(FICHAS), PONTOS_INICIAIS)
+
+    def contexto(user_id):
+        return ContextoFalso(AutorFalso(user_id), canais[user_id % len(canais) + 1])
+
+    async def executar():
+        bot.carregar_dados()
+        for user_id in range(FICHAS):
+            await bot.criar.callback(contexto(user_id))
+
+        comandos = []
+        for _ in range(COMANDOS):
+            user_id = rng.randrange(FICHAS)
+            atributo = rng.choice(bot.atributos_validos)
+            sorteio = rng.random()
+            if sorteio < 0.4:
+                comandos.append(bot.add.callback(contexto(user_id), atributo, rng.randint(1, 3)))
+            elif sorteio < 0.7:
+                comandos.append(bot.remover.callback(contexto(user_id), atributo, rng.randint(1, 3)))
+            else:
+                valor = rng.randint(1, 5)
+                concedidos[user_id] += valor
+                comandos.append(bot.addpontos.callback(contexto(1000), MembroFalso(user_id), valor))
+        await asyncio.gather(*comandos)
+
+        # Espera as edições agendadas e a última gravação
+        while bot.agendador_fichas.profundidade() or bot.despachante.profundidade():
+            await asyncio.sleep(0.01)
+        await bot.persistencia.descarregar()
+        await bot.registro_eventos.descarregar()
+
+        for user_id, pontos in concedidos.items():
+            chave = bot.chave_ficha(None, user_id)
+            em_memoria = await bot.cache_fichas.obter_sem_bloquear(chave)
+            gravada = bot.Ficha.de_dict(bot.armazenamento.obter(chave))
+            for ficha in (em_memoria, gravada):
+                assert ficha.pontos >= 0
+                assert ficha.pontos + sum(ficha.pts_gastos) == pontos, user_id
+
+    asyncio.run(executar())